@@ -0,0 +1,198 @@
+"""
+Local stand-in for the OpenAI embeddings and chat completion endpoints.
+
+The server speaks just enough of the OpenAI REST API for the `openai` client
+used by this package (embeddings, including the base64 encoding the client
+requests by default, and streamed chat completions).  Latency and a request
+rate limit are configurable so the benchmarks can model the real service
+without a network connection.
+"""
+import base64
+import contextlib
+import json
+import logging
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import openai
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_DIMENSION = 1536
+CANNED_ANSWER = (
+    "Based on the records provided, several organizations match the question. "
+    "This list is representative and not complete."
+)
+
+
+def fake_embedding(text: str, dimension: int = EMBEDDING_DIMENSION) -> np.ndarray:
+    """
+    Deterministic stand-in for a text embedding: a normalized bag of hashed
+    words.  Texts sharing words get similar vectors, so vector search over
+    these embeddings returns plausible neighbors.
+    """
+    vector = np.zeros(dimension, dtype=np.float32)
+    for word in re.findall(r"\w+", text.lower()):
+        vector[zlib.crc32(word.encode()) % dimension] += 1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+class RateLimiter:
+    """Token bucket allowing `requests_per_second` with bursts of the same size."""
+
+    def __init__(self, requests_per_second: float):
+        self.rate = requests_per_second
+        self.tokens = requests_per_second
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        if self.rate <= 0:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    server: "FakeOpenAIServer"
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def send_json(self, status: int, body: dict):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+
+        if not self.server.rate_limiter.allow():
+            self.server.rejected += 1
+            self.send_json(
+                429,
+                {"error": {"message": "Rate limit reached", "type": "requests"}},
+            )
+            return
+
+        if self.path.endswith("/embeddings"):
+            time.sleep(self.server.embedding_latency)
+            self.embeddings(request)
+        elif self.path.endswith("/chat/completions"):
+            time.sleep(self.server.chat_latency)
+            self.chat_completion(request)
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def embeddings(self, request: dict):
+        texts = request["input"]
+        if isinstance(texts, str):
+            texts = [texts]
+
+        data = []
+        for index, text in enumerate(texts):
+            vector = fake_embedding(text, self.server.dimension)
+            if request.get("encoding_format") == "base64":
+                embedding = base64.b64encode(vector.tobytes()).decode()
+            else:
+                embedding = vector.tolist()
+            data.append({"object": "embedding", "index": index, "embedding": embedding})
+
+        token_count = sum(len(text.split()) for text in texts)
+        self.send_json(
+            200,
+            {
+                "object": "list",
+                "model": request["model"],
+                "data": data,
+                "usage": {"prompt_tokens": token_count, "total_tokens": token_count},
+            },
+        )
+
+    def chat_completion(self, request: dict):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+
+        words = CANNED_ANSWER.split(" ")
+        for index, word in enumerate(words):
+            fragment = {
+                "object": "chat.completion.chunk",
+                "model": request["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {"content": word if index == 0 else " " + word},
+                        "finish_reason": None,
+                    }
+                ],
+            }
+            self.wfile.write(f"data: {json.dumps(fragment)}\n\n".encode())
+
+        final = {
+            "object": "chat.completion.chunk",
+            "model": request["model"],
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+        }
+        self.wfile.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode())
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        embedding_latency: float = 0.0,
+        chat_latency: float = 0.0,
+        requests_per_second: float = 0.0,
+        dimension: int = EMBEDDING_DIMENSION,
+        port: int = 0,
+    ):
+        super().__init__(("127.0.0.1", port), FakeOpenAIHandler)
+        self.embedding_latency = embedding_latency
+        self.chat_latency = chat_latency
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.dimension = dimension
+        self.rejected = 0
+
+    @property
+    def api_base(self) -> str:
+        host, port = self.server_address[:2]
+        if isinstance(host, bytes):
+            host = host.decode()
+        return f"http://{host}:{port}/v1"
+
+
+@contextlib.contextmanager
+def fake_openai(**kwargs):
+    """
+    Run a FakeOpenAIServer in a background thread and point the `openai`
+    module at it for the duration of the `with` block.  Keyword arguments
+    are passed to FakeOpenAIServer.
+    """
+    server = FakeOpenAIServer(**kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    saved = openai.api_base, openai.api_key
+    openai.api_base, openai.api_key = server.api_base, "fake-key"
+    try:
+        yield server
+    finally:
+        openai.api_base, openai.api_key = saved
+        server.shutdown()
+        server.server_close()
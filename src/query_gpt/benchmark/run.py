@@ -0,0 +1,544 @@
+"""
+Offline benchmark of the ingest and query paths.
+
+Everything runs locally: returns come from `synthetic_990`, OpenAI is replaced
+by the `fake_openai` server, and Qdrant runs in qdrant-client's in-memory local
+mode.  With `--backend weaviate`, the load and search stages of the Weaviate
+backend are also timed, against the server at WEAVIATE_URL.  Results are
+compared against a stored baseline so that performance regressions show up
+as a non-zero exit status.
+"""
+import contextlib
+import datetime as dt
+import io
+import json
+import logging
+import os
+import platform
+import tempfile
+import time
+from typing import Any
+from glob import glob
+
+import click
+import numpy as np
+import pandas as pd
+
+from query_gpt import doc_store, embedding_providers, lexical_index, reduction
+from query_gpt.benchmark.fake_openai import fake_openai
+from query_gpt.benchmark.startup import (
+    STARTUP_BUDGET_SECONDS,
+    STARTUP_REPEAT,
+    measure_import,
+    unexpected_modules,
+)
+from query_gpt.benchmark.synthetic_990 import make_questions, write_synthetic_returns
+from query_gpt.config import IRS990_SCHEMA
+from query_gpt.databases import BACKENDS, get_vector_store, loading_suffix, qdrant
+
+logger = logging.getLogger(__name__)
+
+BASELINE_FILE = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "../../../benchmarks/baseline.json")
+)
+
+# A stage regresses when its throughput falls more than this fraction below baseline.
+DEFAULT_TOLERANCE = 0.25
+
+# Two-stage search is benchmarked with vectors of (at most) this dimension.
+REDUCED_DIMENSION = reduction.DEFAULT_REDUCED_DIMENSION
+# Sharded search is benchmarked with the documents split into this many shards.
+SHARD_COUNT = 4
+
+
+class StageTimer:
+    """Collect per-call latencies and item counts for named stages."""
+
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = {}
+        self.items: dict[str, int] = {}
+
+    @contextlib.contextmanager
+    def time(self, stage: str, items: int = 1):
+        start = time.perf_counter()
+        yield
+        self.latencies.setdefault(stage, []).append(time.perf_counter() - start)
+        self.items[stage] = self.items.get(stage, 0) + items
+
+    def record(self, stage: str, seconds: float, items: int = 1):
+        self.latencies.setdefault(stage, []).append(seconds)
+        self.items[stage] = self.items.get(stage, 0) + items
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        results = {}
+        for stage, latencies in self.latencies.items():
+            total = sum(latencies)
+            results[stage] = {
+                "calls": len(latencies),
+                "items": self.items[stage],
+                "total_seconds": round(total, 4),
+                "items_per_second": round(self.items[stage] / total, 2)
+                if total > 0
+                else float("inf"),
+                "p50_ms": round(1000 * float(np.percentile(latencies, 50)), 3),
+                "p95_ms": round(1000 * float(np.percentile(latencies, 95)), 3),
+            }
+        return results
+
+
+def benchmark_stages(
+    timer: StageTimer, filenames: list[str], questions: list[str], backend: str
+) -> dict[str, float]:
+    """
+    Time each stage of the ingest and query paths in isolation.
+
+    Returns:
+        Quality metrics: the recall of two-stage search and the mean number of
+        records that fit in a prompt.
+    """
+    from query_gpt.embeddings import embed_chunk, embed_one, fit_if_necessary
+    from query_gpt.irs_data import parse
+    from query_gpt.prompt import doc_to_string, make_prompt
+    from query_gpt.query import RELEVANT_DOCUMENT_COUNT
+
+    docs = []
+    for filename in filenames:
+        with timer.time("parse"):
+            doc = parse(filename)
+        if doc is not None:
+            docs.append(doc)
+
+    for doc in docs:
+        with timer.time("doc_to_string"):
+            doc_to_string(doc)
+
+    context = docs[:RELEVANT_DOCUMENT_COUNT]
+    prompt_records = []
+    for question in questions:
+        with timer.time("make_prompt"):
+            prompt = make_prompt(question, context, 0)
+        prompt_records.append(prompt.count("<record>\n"))
+
+    with timer.time("build_lexical_index", len(docs)):
+        lexical_writer = lexical_index.LexicalIndexWriter(
+            f"stage-benchmark-{IRS990_SCHEMA}"
+        )
+        lexical_writer.add(docs)
+        lexical_writer.commit()
+    lexical_reader = lexical_index.get_lexical_index(f"stage-benchmark-{IRS990_SCHEMA}")
+    assert lexical_reader is not None
+    for question in questions:
+        with timer.time("lexical_search"):
+            lexical_reader.search(question, RELEVANT_DOCUMENT_COUNT)
+    for question in lookup_questions(docs, len(questions)):
+        with timer.time("lexical_lookup"):
+            lexical_reader.confident_matches(question, RELEVANT_DOCUMENT_COUNT)
+
+    provider = embedding_providers.get_embedding_provider()
+    if not provider.is_fitted:
+        with timer.time("fit_embeddings", len(docs)):
+            fit_if_necessary(provider, docs, doc_to_string)
+
+    with redirect_progress():
+        search_data: dict[str, list] = {"doc": [], "embedding": []}
+        for start in range(0, len(docs), qdrant.CHUNK_SIZE * 10):
+            chunk = docs[start : start + qdrant.CHUNK_SIZE * 10]
+            with timer.time("embed_chunk", len(chunk)):
+                result: dict[str, Any] = embed_chunk(chunk, doc_to_string)
+            search_data["doc"].extend(result["doc"])
+            search_data["embedding"].extend(result["embedding"])
+
+        for question in questions:
+            with timer.time("embed_one"):
+                embed_one(question)
+
+        # Not prefixed by IRS990_SCHEMA, so its shards aren't taken for shards
+        # of the collection that `benchmark_ingest` loads.
+        schema = f"stage-benchmark-{IRS990_SCHEMA}"
+        qdrant.remove_and_recreate_schema(schema, provider.dimension)
+        vectors = [np.asarray(vector) for vector in search_data["embedding"]]
+        for start in range(0, len(docs), qdrant.CHUNK_SIZE * 10):
+            rows = slice(start, start + qdrant.CHUNK_SIZE * 10)
+            with timer.time("load_vectors", len(search_data["doc"][rows])):
+                qdrant.load_vectors(schema, search_data["doc"][rows], vectors[rows])
+
+        embedding = embed_one(questions[0])
+        for _ in questions:
+            with timer.time("get_relevant_responses"):
+                qdrant.get_relevant_responses(
+                    schema, embedding, RELEVANT_DOCUMENT_COUNT
+                )
+        qdrant.client_factory().delete_collection(schema)
+
+        with timer.time("fit_reduction", len(vectors)):
+            vector_reduction = reduction.VectorReduction.fit(
+                np.stack(vectors), min(REDUCED_DIMENSION, provider.dimension // 2)
+            )
+        vector_reduction.save(reduction.reduction_path(schema))
+
+        qdrant.remove_and_recreate_schema(
+            schema, provider.dimension, vector_reduction.dimension
+        )
+        for start in range(0, len(docs), qdrant.CHUNK_SIZE * 10):
+            rows = slice(start, start + qdrant.CHUNK_SIZE * 10)
+            with timer.time("load_vectors_reduced", len(search_data["doc"][rows])):
+                qdrant.load_vectors(
+                    schema, search_data["doc"][rows], vectors[rows], vector_reduction
+                )
+
+        for _ in questions:
+            with timer.time("two_stage_search"):
+                qdrant.get_relevant_responses(
+                    schema, embedding, RELEVANT_DOCUMENT_COUNT
+                )
+        recall = qdrant.measure_recall(
+            schema, list(map(embed_one, questions)), RELEVANT_DOCUMENT_COUNT
+        )
+        qdrant.client_factory().delete_collection(schema)
+
+        loading_collections = []
+        for shard_index in range(SHARD_COUNT):
+            shard = f"{schema}-{shard_index}"
+            loading_collection = f"{shard}-{loading_suffix()}"
+            loading_collections.append(loading_collection)
+            qdrant.remove_and_recreate_schema(loading_collection, provider.dimension)
+            qdrant.load_vectors(
+                loading_collection,
+                search_data["doc"][shard_index::SHARD_COUNT],
+                vectors[shard_index::SHARD_COUNT],
+            )
+            qdrant.rename(loading_collection, shard)
+
+        for _ in questions:
+            with timer.time("sharded_search"):
+                qdrant.get_relevant_responses(
+                    schema, embedding, RELEVANT_DOCUMENT_COUNT
+                )
+        for loading_collection in loading_collections:
+            qdrant.client_factory().delete_collection(loading_collection)
+
+        store_writer = doc_store.DocStoreWriter(schema)
+        qdrant.remove_and_recreate_schema(schema, provider.dimension)
+        for start in range(0, len(docs), qdrant.CHUNK_SIZE * 10):
+            rows = slice(start, start + qdrant.CHUNK_SIZE * 10)
+            with timer.time("load_vectors_slim", len(search_data["doc"][rows])):
+                qdrant.load_vectors(
+                    schema,
+                    search_data["doc"][rows],
+                    vectors[rows],
+                    doc_store=store_writer,
+                )
+        store_writer.commit()
+
+        for _ in questions:
+            with timer.time("slim_search"):
+                qdrant.get_relevant_responses(
+                    schema, embedding, RELEVANT_DOCUMENT_COUNT
+                )
+        qdrant.client_factory().delete_collection(schema)
+
+        # The same load and search through the backend interface, as
+        # `load_vector_db` and the REPL use it.
+        store = get_vector_store(backend)
+        store.create(schema, provider.dimension)
+        for start in range(0, len(docs), qdrant.CHUNK_SIZE * 10):
+            rows = slice(start, start + qdrant.CHUNK_SIZE * 10)
+            with timer.time(f"{backend}_load", len(search_data["doc"][rows])):
+                store.load(schema, search_data["doc"][rows], vectors[rows])
+        store.finalize(schema)
+        store.wait_until_ready(schema)
+
+        for _ in questions:
+            with timer.time(f"{backend}_search"):
+                store.search(schema, embedding, RELEVANT_DOCUMENT_COUNT)
+        store.delete(schema)
+
+    logger.info(
+        f"Recall@{RELEVANT_DOCUMENT_COUNT} of two-stage search "
+        f"({vector_reduction.dimension} dimensions): {recall:.3f}"
+    )
+    return {
+        "two_stage_recall": round(recall, 4),
+        "prompt_records": round(float(np.mean(prompt_records)), 1),
+    }
+
+
+def lookup_questions(docs: list[dict], count: int) -> list[str]:
+    """Questions that name an organization, answered by the lexical index."""
+    return [f"Where is {docs[index % len(docs)]['Name']}?" for index in range(count)]
+
+
+def benchmark_ingest(timer: StageTimer, filenames: list[str], work_dir: str):
+    """
+    Time the end-to-end ingest path: parse, embed, write parquet, then load the
+    parquet files into a fresh collection (and the lexical index) and swap the
+    alias, as `load_vector_db` does.
+    """
+    from query_gpt.embeddings import compute_search_embeddings
+    from query_gpt.irs_data import doc_to_string, parse
+
+    embeddings_dir = os.path.join(work_dir, "embeddings")
+    os.makedirs(embeddings_dir, exist_ok=True)
+
+    with redirect_progress(), timer.time("ingest", len(filenames)):
+        docs = [doc for doc in map(parse, filenames) if doc is not None]
+        compute_search_embeddings(
+            docs,
+            doc_to_string,
+            data_dir=embeddings_dir,
+            year=2022,
+            segment="BENCH",
+        )
+
+        loading_collection = f"{IRS990_SCHEMA}-benchmark"
+        qdrant.remove_and_recreate_schema(
+            loading_collection, embedding_providers.get_embedding_provider().dimension
+        )
+        writer = lexical_index.LexicalIndexWriter(IRS990_SCHEMA)
+        for filename in glob(os.path.join(embeddings_dir, "*.parquet")):
+            search_data = pd.read_parquet(filename)
+            qdrant.load_vectors(
+                loading_collection,
+                list(search_data["doc"]),
+                list(search_data["embedding"]),
+            )
+            writer.add(list(search_data["doc"]))
+        qdrant.restore_indexing(loading_collection)
+        qdrant.wait_until_ready(loading_collection, 0)
+        writer.commit()
+        qdrant.rename(loading_collection, IRS990_SCHEMA)
+
+
+def benchmark_restore(timer: StageTimer, work_dir: str):
+    """
+    Time exporting the ingested collection as a snapshot artifact and
+    restoring it, the fast alternative to `benchmark_ingest` for new nodes.
+    """
+    from query_gpt.snapshot import export_collection, restore_collection
+
+    collection = next(
+        alias.collection_name
+        for alias in qdrant.client_factory().get_aliases().aliases
+        if alias.alias_name == IRS990_SCHEMA
+    )
+    point_count = qdrant.client_factory().count(collection).count
+    snapshot_dir = os.path.join(work_dir, "snapshots")
+
+    with timer.time("export_snapshot", point_count):
+        artifact = export_collection(IRS990_SCHEMA, collection, snapshot_dir)
+    with redirect_progress(), timer.time("restore_snapshot", point_count):
+        restore_collection(artifact)
+
+
+def benchmark_streaming_ingest(timer: StageTimer, filenames: list[str], work_dir: str):
+    """
+    Time the streaming ingest pipeline (parse, render, embed, write parquet)
+    on already extracted returns.  The pipeline removes the XML files.
+    """
+    from query_gpt.dedup import Deduplicator
+    from query_gpt.pipeline import Pipeline, make_ingest_stages
+
+    deduplicator = Deduplicator()
+    stages = make_ingest_stages(
+        os.path.join(work_dir, "stream"), download=False, deduplicator=deduplicator
+    )
+    source = [(2022, "BENCH", filename) for filename in filenames]
+    with redirect_progress(), timer.time("streaming_ingest", len(filenames)):
+        Pipeline(stages).run(source)
+    logger.info(deduplicator.report())
+
+
+def benchmark_query(timer: StageTimer, questions: list[str]):
+    """
+    Time the end-to-end query path of the REPL against the ingested collection,
+    for general questions and for lookups of organizations by name.
+    """
+    from query_gpt.query import QueryGPT
+
+    answer_bot = QueryGPT()
+    docs = lexical_index.get_lexical_index(IRS990_SCHEMA).get_docs(  # type:ignore
+        range(len(questions))
+    )
+    with redirect_progress():
+        for question in questions:
+            with timer.time("query"):
+                answer_bot.get_answer(question)
+        for question in lookup_questions(docs, len(questions)):
+            with timer.time("lookup_query"):
+                answer_bot.get_answer(question)
+
+
+@contextlib.contextmanager
+def redirect_progress():
+    """Hide progress bars and streamed answers so the report stays readable."""
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(
+        io.StringIO()
+    ):
+        yield
+
+
+def compare_to_baseline(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Print each stage's throughput next to the baseline and return the names
+    of the stages that regressed by more than `tolerance`.
+    """
+    regressions = []
+    click.echo(
+        f"{'stage':<24}{'items/s':>12}{'baseline':>12}{'ratio':>8}"
+        f"{'p50 ms':>10}{'p95 ms':>10}"
+    )
+    for stage, result in results.items():
+        baseline_rate = baseline.get(stage, {}).get("items_per_second")
+        if baseline_rate:
+            ratio = result["items_per_second"] / baseline_rate
+            comparison = f"{baseline_rate:>12,.1f}{ratio:>8.2f}"
+            if ratio < 1 - tolerance:
+                regressions.append(stage)
+        else:
+            comparison = f"{'-':>12}{'-':>8}"
+        click.echo(
+            f"{stage:<24}{result['items_per_second']:>12,.1f}{comparison}"
+            f"{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}"
+        )
+    return regressions
+
+
+@click.command
+@click.option("--returns", "-n", default=2_000, help="Synthetic returns to ingest")
+@click.option("--queries", "-q", default=20, help="Questions to ask")
+@click.option(
+    "--embedding-latency", default=0.05, help="Fake embeddings latency (seconds)"
+)
+@click.option("--chat-latency", default=0.2, help="Fake chat latency (seconds)")
+@click.option(
+    "--rate-limit", default=0.0, help="Fake OpenAI requests/second (0 = unlimited)"
+)
+@click.option(
+    "--embedding-provider",
+    type=click.Choice(list(embedding_providers.PROVIDERS)),
+    default="openai",
+    help="Embedding provider (openai uses the fake OpenAI endpoint)",
+)
+@click.option(
+    "--backend",
+    type=click.Choice(list(BACKENDS)),
+    default="qdrant",
+    help="Vector database backend to time (weaviate needs a server)",
+)
+@click.option("--baseline", default=BASELINE_FILE, help="Baseline results file")
+@click.option("--save-baseline", is_flag=True, help="Store results as the baseline")
+@click.option("--tolerance", default=DEFAULT_TOLERANCE, help="Allowed slowdown")
+@click.option(
+    "--startup-budget",
+    default=STARTUP_BUDGET_SECONDS,
+    help="Allowed cold import time of the query REPL (seconds)",
+)
+@click.option("--output", "-o", default=None, help="Also write results to this file")
+def benchmark_command(
+    returns,
+    queries,
+    embedding_latency,
+    chat_latency,
+    rate_limit,
+    embedding_provider,
+    backend,
+    baseline,
+    save_baseline,
+    tolerance,
+    startup_budget,
+    output,
+):
+    # Use in-process local mode instead of a Qdrant server.
+    qdrant.QDRANT_LOCATION = ":memory:"
+    embedding_providers.EMBEDDING_PROVIDER = embedding_provider
+
+    timer = StageTimer()
+    questions = make_questions(queries)
+
+    logger.info("Benchmarking query REPL startup")
+    for _ in range(STARTUP_REPEAT):
+        seconds, modules = measure_import()
+        timer.record("startup", seconds)
+
+    with tempfile.TemporaryDirectory() as work_dir, fake_openai(
+        embedding_latency=embedding_latency,
+        chat_latency=chat_latency,
+        requests_per_second=rate_limit,
+    ) as server:
+        logger.info(f"Generating {returns:,d} synthetic returns")
+        filenames = write_synthetic_returns(os.path.join(work_dir, "xml"), returns)
+
+        # Never reuse (or overwrite) a real local embedding model, reduction,
+        # document store, or lexical index.
+        embedding_providers.LOCAL_MODEL_FILE = os.path.join(work_dir, "local.npz")
+        reduction.REDUCTION_DIR = os.path.join(work_dir, "reductions")
+        doc_store.DOC_STORE_DIR = os.path.join(work_dir, "doc_store")
+        lexical_index.LEXICAL_INDEX_DIR = os.path.join(work_dir, "lexical_index")
+
+        logger.info("Benchmarking individual stages")
+        quality = benchmark_stages(timer, filenames, questions, backend)
+
+        logger.info("Benchmarking end-to-end ingest")
+        benchmark_ingest(timer, filenames, work_dir)
+
+        logger.info("Benchmarking snapshot export and restore")
+        benchmark_restore(timer, work_dir)
+
+        logger.info("Benchmarking end-to-end query")
+        benchmark_query(timer, questions)
+
+        logger.info("Benchmarking streaming ingest")
+        benchmark_streaming_ingest(timer, filenames, work_dir)
+
+        if server.rejected:
+            logger.info(f"Fake OpenAI rejected {server.rejected:,d} requests")
+
+    results = timer.summary()
+    report = {
+        "created": str(dt.datetime.now()),
+        "machine": platform.platform(),
+        "parameters": {
+            "returns": returns,
+            "queries": queries,
+            "embedding_latency": embedding_latency,
+            "chat_latency": chat_latency,
+            "rate_limit": rate_limit,
+            "embedding_provider": embedding_provider,
+            "backend": backend,
+        },
+        "stages": results,
+        "quality": quality,
+    }
+
+    baseline_stages = {}
+    if os.path.exists(baseline):
+        with open(baseline) as baseline_file:
+            baseline_report = json.load(baseline_file)
+        if baseline_report["parameters"] != report["parameters"]:
+            logger.warning("Baseline was recorded with different parameters")
+        baseline_stages = baseline_report["stages"]
+
+    regressions = compare_to_baseline(results, baseline_stages, tolerance)
+
+    if results["startup"]["p50_ms"] > 1000 * startup_budget:
+        regressions.append(f"startup (over {startup_budget:.2f}s budget)")
+    unexpected = unexpected_modules(modules)
+    if unexpected:
+        regressions.append(f"startup (imported {', '.join(unexpected)})")
+
+    for filename in filter(None, (output, baseline if save_baseline else None)):
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        with open(filename, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+        logger.info(f"Wrote results to {filename}")
+
+    if regressions and not save_baseline:
+        raise click.ClickException(f"Regressed stages: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    # Per-question logging from the query path would drown out the report.
+    logging.basicConfig(level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+
+    benchmark_command()
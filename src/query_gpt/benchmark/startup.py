@@ -0,0 +1,84 @@
+"""
+Cold-start benchmark for the query REPL.
+
+Each measurement imports the module in a fresh interpreter, so nothing is
+cached in `sys.modules`.  The check fails if the import takes longer than the
+budget or if it pulls in modules that only the ingest path needs.
+"""
+import json
+import subprocess
+import sys
+
+import click
+
+STARTUP_MODULE = "query_gpt.query"
+STARTUP_BUDGET_SECONDS = 1.0
+STARTUP_REPEAT = 5
+
+# Modules that the query path must not import at startup.
+INGEST_ONLY_MODULES = (
+    "pandas",
+    "pyarrow",
+    "scipy",
+    "tqdm",
+    "tiktoken",
+    "openai",
+    "xml.etree.ElementTree",
+    "query_gpt.irs_data",
+    "query_gpt.embeddings",
+)
+
+MEASURE_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "modules": sorted(sys.modules)}}))
+"""
+
+
+def measure_import(module: str = STARTUP_MODULE) -> tuple[float, list[str]]:
+    """
+    Import `module` in a fresh interpreter.
+
+    Returns:
+        The import time in seconds and the names of all modules loaded.
+    """
+    output = subprocess.run(
+        [sys.executable, "-c", MEASURE_SCRIPT.format(module=module)],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    result = json.loads(output.splitlines()[-1])
+    return result["seconds"], result["modules"]
+
+
+def unexpected_modules(modules: list[str]) -> list[str]:
+    return [module for module in INGEST_ONLY_MODULES if module in modules]
+
+
+@click.command
+@click.option("--module", "-m", default=STARTUP_MODULE, help="Module to import")
+@click.option("--repeat", "-r", default=STARTUP_REPEAT, help="Number of imports")
+@click.option(
+    "--budget", default=STARTUP_BUDGET_SECONDS, help="Allowed import time (seconds)"
+)
+def startup_command(module, repeat, budget):
+    timings = []
+    for _ in range(repeat):
+        seconds, modules = measure_import(module)
+        timings.append(seconds)
+    best = min(timings)
+
+    click.echo(f"import {module}: best {best:.3f}s, worst {max(timings):.3f}s")
+
+    unexpected = unexpected_modules(modules)
+    if unexpected:
+        raise click.ClickException(f"Imported ingest modules: {', '.join(unexpected)}")
+    if best > budget:
+        raise click.ClickException(f"Import exceeded budget of {budget:.3f}s")
+
+
+if __name__ == "__main__":
+    startup_command()
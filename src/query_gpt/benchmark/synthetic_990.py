@@ -0,0 +1,289 @@
+"""
+Generate synthetic IRS 990 returns in the IRS efile XML namespace.
+
+The returns only contain the elements that `query_gpt.irs_data.parse` reads,
+plus a sprinkling of returns that `parse` is expected to skip (990PF filers
+and foreign addresses) and of amended returns that duplicate an earlier
+filing, so they exercise the same code paths as real data.
+"""
+import os
+import random
+from xml.sax.saxutils import escape
+
+import click
+
+NAMESPACE = "http://www.irs.gov/efile"
+
+RETURN_TYPES = ["990"] * 6 + ["990EZ"] * 3 + ["990PF"]
+FOREIGN_ADDRESS_RATE = 0.02
+AMENDED_RATE = 0.03
+
+NAME_PREFIXES = [
+    "American",
+    "Community",
+    "Friends of the",
+    "Greater",
+    "National",
+    "United",
+    "Valley",
+    "Riverside",
+    "Northside",
+    "Heritage",
+]
+NAME_SUBJECTS = [
+    "Animal Rescue",
+    "Arts Council",
+    "Food Bank",
+    "Health Alliance",
+    "Housing Partnership",
+    "Literacy Project",
+    "Music Society",
+    "Veterans Association",
+    "Youth Soccer League",
+    "Historical Society",
+    "Literacy Foundation",
+    "Conservation Trust",
+]
+NAME_SUFFIXES = ["Inc", "Foundation", "Association", "Corporation", ""]
+
+STREETS = ["Main St", "Oak Ave", "Elm St", "Park Blvd", "Church St", "Market St"]
+CITIES = [
+    ("Austin", "TX", "787"),
+    ("Boston", "MA", "021"),
+    ("Chicago", "IL", "606"),
+    ("Denver", "CO", "802"),
+    ("Houston", "TX", "770"),
+    ("Miami", "FL", "331"),
+    ("Nashville", "TN", "372"),
+    ("Omaha", "NE", "681"),
+    ("Portland", "OR", "972"),
+    ("Seattle", "WA", "981"),
+]
+
+ACTIVITIES = [
+    "provide meals to families experiencing food insecurity",
+    "operate an animal shelter and adoption program",
+    "offer free after-school tutoring for children",
+    "preserve historic buildings and local archives",
+    "provide affordable housing for low income seniors",
+    "support veterans with job training and counseling",
+    "present concerts and music education programs",
+    "conserve wetlands and protect wildlife habitat",
+    "run youth sports leagues and summer camps",
+    "provide free health screenings and clinics",
+]
+ACCOMPLISHMENTS = [
+    "Served {n:,d} meals through our community pantry network",
+    "Placed {n:,d} animals with adoptive families",
+    "Tutored {n:,d} students in reading and mathematics",
+    "Restored {n:,d} square feet of historic structures",
+    "Provided housing for {n:,d} seniors",
+    "Counseled {n:,d} veterans and their families",
+    "Held {n:,d} concerts attended by local residents",
+    "Protected {n:,d} acres of wetland habitat",
+    "Enrolled {n:,d} children in league play",
+    "Screened {n:,d} uninsured patients",
+]
+REVENUE_CATEGORIES = [
+    "Program service fees",
+    "Ticket sales",
+    "Tuition",
+    "Rental income",
+    "Membership dues",
+    "Event revenue",
+]
+EXPENSE_CATEGORIES = [
+    "Program supplies",
+    "Food purchases",
+    "Veterinary care",
+    "Insurance",
+    "Facility maintenance",
+    "Transportation",
+    "Professional fees",
+]
+
+
+def element(tag: str, text: object) -> str:
+    return f"<{tag}>{escape(str(text))}</{tag}>"
+
+
+def make_return_xml(
+    rng: random.Random, index: int, tax_year: int = 2022, amended: bool = False
+) -> str:
+    """
+    Build the XML for one synthetic return.
+
+    Arguments:
+        rng: random.Random - Source of randomness (seed it for reproducible output)
+        index: int - Sequence number used to make the EIN unique
+        tax_year: int - Tax year of the return
+        amended: bool - Mark the return as amended and file it later.  With
+            an identically seeded `rng`, the contents match the original.
+    Returns:
+        The XML document as a string.
+    """
+    return_type = rng.choice(RETURN_TYPES)
+    ein = f"{10_000_000 + index * 7919 % 89_999_999:09d}"
+    name = " ".join(
+        part
+        for part in (
+            rng.choice(NAME_PREFIXES),
+            rng.choice(NAME_SUBJECTS),
+            rng.choice(NAME_SUFFIXES),
+        )
+        if part
+    )
+    city, state, zip_prefix = rng.choice(CITIES)
+    activity_ids = rng.sample(range(len(ACTIVITIES)), k=rng.randint(1, 3))
+
+    if rng.random() < FOREIGN_ADDRESS_RATE:
+        address = (
+            "<ForeignAddress>"
+            + element("AddressLine1Txt", f"{rng.randint(1, 999)} High Street")
+            + element("CityNm", "London")
+            + element("CountryCd", "UK")
+            + "</ForeignAddress>"
+        )
+    else:
+        address = (
+            "<USAddress>"
+            + element(
+                "AddressLine1Txt", f"{rng.randint(1, 9999)} {rng.choice(STREETS)}"
+            )
+            + element("CityNm", city.upper())
+            + element("StateAbbreviationCd", state)
+            + element("ZIPCd", f"{zip_prefix}{rng.randint(0, 99):02d}")
+            + "</USAddress>"
+        )
+
+    body = [element("AmendedReturnInd", "X")] if amended else []
+    body += [
+        element("WebsiteAddressTxt", f"www.{name.lower().replace(' ', '')}.org"),
+        element("ActivityOrMissionDesc", f"To {ACTIVITIES[activity_ids[0]]}"),
+        element("TotalEmployeeCnt", rng.randint(0, 500)),
+        element("TotalVolunteersCnt", rng.randint(0, 2_000)),
+        element("CYTotalRevenueAmt", rng.randint(10_000, 50_000_000)),
+        element("CYTotalExpensesAmt", rng.randint(10_000, 50_000_000)),
+        element(
+            "MissionDesc",
+            "Our mission is to "
+            + " and to ".join(ACTIVITIES[i] for i in activity_ids)
+            + f" in the {city} area.",
+        ),
+    ]
+    for i in activity_ids:
+        body.append(
+            "<ProgSrvcAccomActyGrp>"
+            + element(
+                "DescriptionProgramSrvcAccomTxt",
+                ACCOMPLISHMENTS[i].format(n=rng.randint(10, 100_000)),
+            )
+            + "</ProgSrvcAccomActyGrp>"
+        )
+    for category in rng.sample(REVENUE_CATEGORIES, k=rng.randint(0, 3)):
+        body.append(
+            "<ProgramServiceRevenueGrp>"
+            + element("Desc", category)
+            + element("TotalRevenueColumnAmt", rng.randint(1_000, 1_000_000))
+            + "</ProgramServiceRevenueGrp>"
+        )
+    for category in rng.sample(EXPENSE_CATEGORIES, k=rng.randint(0, 4)):
+        body.append(
+            "<OtherExpensesGrp>"
+            + element("Desc", category)
+            + element("TotalAmt", rng.randint(1_000, 1_000_000))
+            + "</OtherExpensesGrp>"
+        )
+
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        f'<Return xmlns="{NAMESPACE}" returnVersion="{tax_year}v5.0">'
+        "<ReturnHeader>"
+        + element(
+            "ReturnTs",
+            f"{tax_year + 1}-{11 if amended else 5:02d}-"
+            f"{rng.randint(1, 28):02d}T10:00:00-05:00",
+        )
+        + element("TaxPeriodEndDt", f"{tax_year}-12-31")
+        + element("ReturnTypeCd", return_type)
+        + element("TaxPeriodBeginDt", f"{tax_year}-01-01")
+        + "<Filer>"
+        + element("EIN", ein)
+        + "<BusinessName>"
+        + element("BusinessNameLine1Txt", name.upper())
+        + "</BusinessName>"
+        + address
+        + "</Filer>"
+        + element("TaxYr", tax_year)
+        + "</ReturnHeader>"
+        + f'<ReturnData documentCnt="1"><IRS{return_type}>'
+        + "".join(body)
+        + f"</IRS{return_type}></ReturnData>"
+        + "</Return>\n"
+    )
+
+
+def write_synthetic_returns(
+    directory: str, count: int, seed: int = 42, tax_year: int = 2022
+) -> list[str]:
+    """
+    Write `count` synthetic returns to `directory`, one XML file per return.
+    About AMENDED_RATE of them are amended versions of an earlier return.
+
+    Returns:
+        List of the filenames that were written.
+    """
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+
+    filenames = []
+    for index in range(count):
+        if index > 0 and rng.random() < AMENDED_RATE:
+            original = rng.randrange(index)
+            xml = make_return_xml(
+                random.Random(f"{seed}-{original}"), original, tax_year, amended=True
+            )
+        else:
+            xml = make_return_xml(random.Random(f"{seed}-{index}"), index, tax_year)
+
+        filename = os.path.join(directory, f"{tax_year + 1}{index:08d}_public.xml")
+        with open(filename, "w") as xml_file:
+            xml_file.write(xml)
+        filenames.append(filename)
+    return filenames
+
+
+def make_questions(count: int, seed: int = 42) -> list[str]:
+    """Generate questions resembling those asked of the query REPL."""
+    rng = random.Random(seed)
+    templates = [
+        "Which organizations in {city} {activity}?",
+        "What is the total revenue of non-profits that {activity}?",
+        "List some {subject} organizations in {state}.",
+        "How many employees do organizations that {activity} have?",
+    ]
+    questions = []
+    for _ in range(count):
+        city, state, _ = rng.choice(CITIES)
+        questions.append(
+            rng.choice(templates).format(
+                city=city,
+                state=state,
+                activity=rng.choice(ACTIVITIES),
+                subject=rng.choice(NAME_SUBJECTS).lower(),
+            )
+        )
+    return questions
+
+
+@click.command
+@click.option("--count", "-n", default=1_000, help="Number of returns to generate")
+@click.option("--seed", default=42, help="Random seed")
+@click.option("--tax-year", default=2022, help="Tax year of the generated returns")
+@click.argument("directory")
+def synthetic_990_command(count, seed, tax_year, directory):
+    write_synthetic_returns(directory, count, seed, tax_year)
+
+
+if __name__ == "__main__":
+    synthetic_990_command()
@@ -1,10 +1,9 @@
 import logging
 import time
 
-import openai
 from query_gpt.config import MODEL
 
-from query_gpt.irs_data import make_prompt
+from query_gpt.prompt import make_prompt
 
 MAX_COMPLETION_TOKENS = 1000
 CHUNK_INTERVAL = 16  # Update interval while streaming.
@@ -14,6 +13,10 @@ logger = logging.getLogger(__name__)
 
 
 def openai_completion(messages, update_callback=None):
+    # Importing openai is slow (it also imports pandas if it's installed), so
+    # it's deferred until the first question.
+    import openai
+
     start_time = time.time()
 
     response = openai.ChatCompletion.create(
@@ -8,5 +8,19 @@ MODEL = "gpt-3.5-turbo-16k"  # Or use "text-davinci-003" for GPT-3
 # (Tiktoken typically underestimates the token count by eight.)
 INPUT_TOKEN_GOAL = 14_900
 
+# Which embedding provider to use: "openai" or "local" (see embedding_providers.py).
+# Documents and questions must be embedded by the same provider.
+EMBEDDING_PROVIDER = os.environ.get("EMBEDDING_PROVIDER", "openai")
+
+# Which vector database to use: "qdrant" or "weaviate" (see databases/__init__.py).
+VECTOR_STORE_BACKEND = os.environ.get("VECTOR_STORE_BACKEND", "qdrant")
+
+# How to find the documents for a question: "vector" (vector search), or
+# "hybrid" (vector and lexical search fused by rank; see lexical_index.py).
+# Either way, questions naming an EIN or an organization are answered from
+# the lexical index when there is one.
+RETRIEVAL_MODE = os.environ.get("RETRIEVAL_MODE", "vector")
+
 EMBEDDING_MODEL = "text-embedding-ada-002"
+EMBEDDING_DIMENSION = 1536  # Dimension of EMBEDDING_MODEL embeddings
 EMBEDDING_TOKEN_GOAL = 8_183  # It's supposed to be 8_191 but we allow a bit of headroom
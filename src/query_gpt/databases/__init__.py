@@ -0,0 +1,197 @@
+"""
+Vector database backends.
+
+Each backend module implements VectorStore.  `get_vector_store` returns the
+one selected by VECTOR_STORE_BACKEND; backend modules are only imported
+when they are used.
+"""
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+import datetime as dt
+import heapq
+import importlib
+import itertools
+import json
+from typing import Any, Callable, NamedTuple
+import uuid
+
+from query_gpt.config import VECTOR_STORE_BACKEND
+
+SHARD_SEARCH_WORKERS = 8
+
+# Loading collections are named "<alias>-<timestamp>", with the timestamp
+# from `loading_suffix`.
+LOADING_SUFFIX_PATTERN = r"\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2}(\.\d+)?"
+
+BACKENDS = {
+    "qdrant": "query_gpt.databases.qdrant:QdrantVectorStore",
+    "weaviate": "query_gpt.databases.weaviate:WeaviateVectorStore",
+}
+
+
+class Hit(NamedTuple):
+    id: str
+    score: float
+    payload: dict
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class UnsupportedError(Exception):
+    """Raised by the optional VectorStore methods that a backend lacks."""
+
+
+class VectorStore(ABC):
+    """
+    Interface of a vector database.
+
+    Documents are loaded into a new collection, which is then swapped in
+    behind an alias, so queries never see a partially loaded collection.
+    """
+
+    name = ""
+
+    @abstractmethod
+    def create(self, schema: str, dimension: int, reduced_dimension: int | None = None):
+        """Create an empty collection, replacing any with the same name."""
+
+    @abstractmethod
+    def load(self, schema: str, docs: list[dict], vectors: list, **kwargs):
+        """Bulk load `docs` and their embeddings into `schema`."""
+
+    def finalize(self, schema: str):
+        """Build the indexes that were deferred while loading."""
+
+    def wait_until_ready(self, schema: str):
+        """Wait until `schema` can be searched efficiently."""
+
+    @abstractmethod
+    def swap_alias(self, loading_collection: str, alias: str):
+        """Point `alias` at `loading_collection` and remove its old collections."""
+
+    @abstractmethod
+    def remove_stale_aliases(self, collection: str, sharded: bool):
+        """
+        Remove the aliases (and their collections) left over from loading
+        `collection` the other way: its shard aliases "<collection>-<shard>"
+        after an unsharded load, or the plain alias `collection` after a
+        sharded one.  Otherwise the stale aliases would still be searched.
+        """
+
+    @abstractmethod
+    def delete(self, schema: str):
+        """Remove the collection `schema`."""
+
+    @abstractmethod
+    def search(
+        self, schema: str, embedding, count: int, years: set[str] | None = None
+    ) -> list[dict]:
+        """
+        Return the `count` documents nearest to `embedding`.  If `schema` is
+        sharded, only the shards of the tax `years` are searched.
+        """
+
+    # Only backends that support reduced vectors and snapshots implement these;
+    # the others raise UnsupportedError.
+
+    def measure_recall(self, schema: str, queries: list, count: int) -> float:
+        """Return the recall@`count` of searching `schema` for `queries`."""
+        raise UnsupportedError(f"The {self.name} backend has no reduced vectors")
+
+    def export_snapshot(
+        self,
+        alias: str,
+        collection: str,
+        directory: str | None = None,
+        source: str | None = None,
+    ) -> str:
+        """
+        Export `collection`, served under `alias` (a shard of `source`, if
+        given), and return the artifact.
+        """
+        raise UnsupportedError(f"The {self.name} backend doesn't support snapshots")
+
+    def restore_snapshot(
+        self, artifact: str, alias: str | None = None, verify: bool = True
+    ) -> str:
+        """Restore `artifact` behind `alias` and return the new collection."""
+        raise UnsupportedError(f"The {self.name} backend doesn't support snapshots")
+
+
+def point_id(doc: dict) -> str:
+    # Sort the keys to guarantee uniqueness of the `id`.
+    text = json.dumps(doc, sort_keys=True)
+    return str(uuid.uuid3(uuid.NAMESPACE_OID, text))
+
+
+def loading_suffix() -> str:
+    """Return the suffix of a new loading collection, a timestamp."""
+    return str(dt.datetime.now()).replace(" ", "-").replace(":", "-")
+
+
+def is_stale_alias(alias: str, collection: str, sharded: bool) -> bool:
+    """Whether `alias` is left over from loading `collection` the other way."""
+    if sharded:
+        return alias == collection
+    return alias.startswith(f"{collection}-")
+
+
+def select_shards(collection: str, shards: list[str], years: set[str] | None):
+    """
+    Return the shards of the tax `years`, or all `shards` if there are no year
+    shards for them (or if the shards are segments rather than years).
+    """
+    selected = [
+        shard for shard in shards if years and shard[len(collection) + 1 :] in years
+    ]
+    return selected or shards
+
+
+_executor: ThreadPoolExecutor | None = None
+
+
+def search_shards(search: Callable[[str], list], shards: list[str], count: int) -> list:
+    """
+    Call `search` for each of `shards` concurrently and merge the results
+    (anything with `id` and `score` attributes) by score.
+    """
+    global _executor
+
+    if len(shards) == 1:
+        return search(shards[0])
+
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            SHARD_SEARCH_WORKERS, thread_name_prefix="shard-search"
+        )
+    candidates = heapq.nlargest(
+        count * len(shards),
+        itertools.chain.from_iterable(_executor.map(search, shards)),
+        key=lambda point: point.score,
+    )
+
+    # A document loaded into more than one shard has the same id in each.
+    merged: dict[Any, Any] = {}
+    for point in candidates:
+        merged.setdefault(point.id, point)
+    return list(merged.values())[:count]
+
+
+_stores: dict[str, VectorStore] = {}
+
+
+def get_vector_store(backend: str | None = None) -> VectorStore:
+    """Return the (shared) store of `backend`, by default VECTOR_STORE_BACKEND."""
+    backend = backend or VECTOR_STORE_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(
+            f"Unknown vector store backend {backend!r}; "
+            f"expected one of {', '.join(BACKENDS)}"
+        )
+
+    if backend not in _stores:
+        module_name, class_name = BACKENDS[backend].split(":")
+        _stores[backend] = getattr(importlib.import_module(module_name), class_name)()
+    return _stores[backend]
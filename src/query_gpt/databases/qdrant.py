@@ -1,29 +1,200 @@
 import logging
 import os
-from tqdm import tqdm
+import io
 import json
-import uuid
+import re
 import time
+from typing import BinaryIO, NamedTuple
+import uuid
 
 import numpy as np
 from qdrant_client import QdrantClient
 from qdrant_client.http import models
 
+from query_gpt.config import EMBEDDING_DIMENSION
+from query_gpt.databases import (
+    LOADING_SUFFIX_PATTERN,
+    VectorStore,
+    is_stale_alias,
+    point_id,
+    search_shards as search_shards_concurrently,
+    select_shards,
+)
+from query_gpt.doc_store import DocStoreWriter, resolve_payloads, slim_payload
+from query_gpt.reduction import (
+    VectorReduction,
+    find_reduction,
+    reduction_path,
+    remove_old_reductions,
+)
 from query_gpt.retry import backoff_and_retry
 
 logger = logging.getLogger(__name__)
 
 QDRANT_HOST = os.environ.get("QDRANT_HOST", "localhost")
+QDRANT_PORT = 6333
+# Shards (or any collection) can live on other nodes, e.g.,
+# QDRANT_SHARD_HOSTS="irs990-2022=qdrant-a,irs990-2023=qdrant-b".  Each key
+# applies to the alias with that name and to its loading collections.
+QDRANT_SHARD_HOSTS = dict(
+    item.split("=", 1)
+    for item in os.environ.get("QDRANT_SHARD_HOSTS", "").split(",")
+    if item
+)
+# Set QDRANT_LOCATION to ":memory:" or to a directory to use qdrant-client's
+# in-process local mode instead of a Qdrant server (e.g., for offline benchmarks).
+QDRANT_LOCATION = os.environ.get("QDRANT_LOCATION")
 CHUNK_SIZE = 100
+EXPORT_CHUNK_SIZE = 1_000
 DEFAULT_READY_POLL_TIME_SECONDS = 60
 
+# Collections created with a reduced dimension store two named vectors per
+# point: the full embedding (on disk, unindexed) and its reduced projection
+# (in RAM, indexed).  Searches over-fetch RERANK_OVERFETCH times as many
+# candidates by the reduced vector and re-rank them by the full one.
+FULL_VECTOR = "full"
+REDUCED_VECTOR = "reduced"
+RERANK_OVERFETCH = 4
+
+# A sharded collection is a set of aliases named "<collection>-<shard>", where
+# the shard is a tax year (e.g., "irs990-2022") or a year and segment (e.g.,
+# "irs990-2023-01A").  Each alias points at its own loading collection, so
+# shards are reloaded independently.  The shard list is cached this long.
+SHARD_CACHE_SECONDS = 60
+
+# Clients are created on first use and then shared, which lets the server
+# connections be reused (and local mode keeps its data inside the client).
+_clients: dict[str, QdrantClient] = {}
+
+
+def shard_host(schema: str | None) -> str:
+    """Return the host of `schema`: the longest matching QDRANT_SHARD_HOSTS key."""
+    matches = [
+        name
+        for name in QDRANT_SHARD_HOSTS
+        if schema is not None and (schema == name or schema.startswith(f"{name}-"))
+    ]
+    return QDRANT_SHARD_HOSTS[max(matches, key=len)] if matches else QDRANT_HOST
+
+
+def client_factory(schema: str | None = None) -> QdrantClient:
+    """Return the client for the node that holds `schema`."""
+    # Local mode has a single, in-process "node".
+    host = shard_host(schema) if QDRANT_LOCATION is None else ""
+
+    if host not in _clients:
+        if QDRANT_LOCATION is None:
+            _clients[host] = QdrantClient(host, port=QDRANT_PORT)
+        elif QDRANT_LOCATION == ":memory:":
+            _clients[host] = QdrantClient(location=QDRANT_LOCATION)
+        else:
+            _clients[host] = QdrantClient(path=QDRANT_LOCATION)
+    return _clients[host]
+
+
+class CollectionReduction(NamedTuple):
+    # The collection to search: the one behind the alias if it has reduced
+    # vectors, since the reduction belongs to that collection, else the alias.
+    collection: str
+    reduction: VectorReduction | None
+    # The reduction file and its (inode, modification time) when it was read.
+    filename: str | None = None
+    file_id: tuple[int, int] | None = None
+
+
+# The collection and reduction of each alias or collection searched.
+_reductions: dict[str, CollectionReduction] = {}
+
 
-def client_factory() -> QdrantClient:
-    return QdrantClient(QDRANT_HOST, port=6333)
+def file_id(filename: str) -> tuple[int, int] | None:
+    try:
+        status = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return status.st_ino, status.st_mtime_ns
 
 
-def remove_and_recreate_schema(schema: str):
-    client = client_factory()
+def alias_collection(schema: str) -> str:
+    """Return the collection that the alias `schema` points at, or `schema`."""
+    for alias in client_factory(schema).get_aliases().aliases:
+        if alias.alias_name == schema:
+            return alias.collection_name
+    return schema
+
+
+def get_reduction(schema: str) -> CollectionReduction:
+    """
+    Return the collection behind `schema` (an alias or a collection) and its
+    vector reduction, or None if it has no reduced vectors.  Each loading
+    collection has its own reduction file, which is removed once the alias is
+    switched to a newer one; the alias is then resolved again.
+    """
+    cached = _reductions.get(schema)
+    if cached is not None and (
+        cached.filename is None or file_id(cached.filename) == cached.file_id
+    ):
+        return cached
+
+    collection = alias_collection(schema)
+    vectors = client_factory(schema).get_collection(collection).config.params.vectors
+    if not isinstance(vectors, dict) or REDUCED_VECTOR not in vectors:
+        _reductions[schema] = CollectionReduction(schema, None)
+        return _reductions[schema]
+
+    # Collections loaded by earlier releases use the reduction of their alias
+    # or of the unsharded collection.
+    name = find_reduction(collection)
+    if name is None:
+        raise RuntimeError(f"No vector reduction found for {collection}")
+    filename = reduction_path(name)
+    loaded_file_id = file_id(filename)
+    reduction = VectorReduction.load(filename)
+    for vector_name, dimension in (
+        (FULL_VECTOR, reduction.full_dimension),
+        (REDUCED_VECTOR, reduction.dimension),
+    ):
+        if dimension != vectors[vector_name].size:
+            raise RuntimeError(
+                f"Vector reduction {filename} has {dimension} {vector_name} "
+                f"dimensions but {collection} has {vectors[vector_name].size}"
+            )
+    _reductions[schema] = CollectionReduction(
+        collection, reduction, filename, loaded_file_id
+    )
+    return _reductions[schema]
+
+
+# Shard aliases of each sharded collection: (time listed, aliases).
+_shards: dict[str, tuple[float | None, list[str]]] = {}
+
+
+def get_shards(collection: str) -> list[str]:
+    """Return the shard aliases of `collection` (empty if it isn't sharded)."""
+    listed, shards = _shards.get(collection, (None, []))
+    if listed is None or time.monotonic() - listed > SHARD_CACHE_SECONDS:
+        aliases = set()
+        for schema in {None, *QDRANT_SHARD_HOSTS}:
+            for alias in client_factory(schema).get_aliases().aliases:
+                aliases.add(alias.alias_name)
+        shards = sorted(
+            alias for alias in aliases if alias.startswith(f"{collection}-")
+        )
+        _shards[collection] = (time.monotonic(), shards)
+    return shards
+
+
+def remove_and_recreate_schema(
+    schema: str,
+    dimension: int = EMBEDDING_DIMENSION,
+    reduced_dimension: int | None = None,
+):
+    """
+    Create an empty collection for `dimension`-dimensional embeddings, with a
+    `reduced_dimension`-dimensional vector for two-stage search if given.
+    """
+    client = client_factory(schema)
+    _reductions.clear()
+    _shards.clear()
 
     if client.delete_collection(schema):
         logger.info(f"Removed existing schema: {schema}")
@@ -38,11 +209,27 @@ def remove_and_recreate_schema(schema: str):
     )
     # Setting indexing_threshold to 0 during large uploads is
     # recommended here: https://qdrant.tech/documentation/tutorials/bulk-upload/
+    vectors_config: models.VectorParams | dict[str, models.VectorParams]
+    vectors_config = models.VectorParams(
+        size=dimension, distance=models.Distance.COSINE, on_disk=True
+    )
+    if reduced_dimension:
+        vectors_config = {
+            # The full vectors are only read to re-rank candidates, so they
+            # don't need an index of their own.
+            FULL_VECTOR: models.VectorParams(
+                size=dimension,
+                distance=models.Distance.COSINE,
+                on_disk=True,
+                hnsw_config=models.HnswConfigDiff(m=0),
+            ),
+            REDUCED_VECTOR: models.VectorParams(
+                size=reduced_dimension, distance=models.Distance.COSINE
+            ),
+        }
     client.recreate_collection(
         schema,
-        vectors_config=models.VectorParams(
-            size=1536, distance=models.Distance.COSINE, on_disk=True
-        ),
+        vectors_config=vectors_config,
         optimizers_config=models.OptimizersConfigDiff(indexing_threshold=0),
         hnsw_config=models.HnswConfigDiff(
             on_disk=True,
@@ -52,7 +239,7 @@ def remove_and_recreate_schema(schema: str):
 
 
 def restore_indexing(schema: str):
-    client = client_factory()
+    client = client_factory(schema)
     client.update_collection(
         schema,
         optimizers_config=models.OptimizersConfigDiff(
@@ -62,11 +249,10 @@ def restore_indexing(schema: str):
     )
 
 
-def wait_until_ready(schema: str):
-    wait = DEFAULT_READY_POLL_TIME_SECONDS
+def wait_until_ready(schema: str, wait: float = DEFAULT_READY_POLL_TIME_SECONDS):
     logger.info(f"Waiting {wait} seconds before polling {schema} for status")
 
-    client = client_factory()
+    client = client_factory(schema)
     while True:
         time.sleep(wait)
         collection = client.get_collection(schema)
@@ -79,7 +265,9 @@ def wait_until_ready(schema: str):
 
 
 def rename(loading_collection: str, collection: str):
-    client = client_factory()
+    client = client_factory(collection)
+    _reductions.clear()
+    _shards.clear()
 
     # Remove the alias if it already exists and add the alias to
     # the loading collection.
@@ -100,43 +288,415 @@ def rename(loading_collection: str, collection: str):
     if not result:
         raise RuntimeError("update_collection_aliases failed")
 
-    # Remove any collections left over from the past that resemble this
-    # collectio name but are not the loading collection.
+    # Queries that still use an old reduction notice that its file is gone
+    # and switch to the new collection (see `get_reduction`).
+    remove_old_reductions(collection, keep=loading_collection)
+
+    # Remove any loading collections left over from the past for this alias.
+    # (Other shards' collections also start with this name, but the
+    # timestamp must follow it immediately.)
+    old_collection = re.compile(f"{re.escape(collection)}-{LOADING_SUFFIX_PATTERN}")
     for collection_description in client.get_collections().collections:
         existing_collection = collection_description.name
         if (
-            existing_collection.startswith(collection)
+            old_collection.fullmatch(existing_collection)
             and existing_collection != loading_collection
         ):
             logger.info(f"Removing old collection: {existing_collection}")
             client.delete_collection(existing_collection)
 
 
-def load_vectors(schema: str, docs: list[dict[str, str]], vectors: list[np.ndarray]):
+def remove_stale_aliases(collection: str, sharded: bool):
+    """See `VectorStore.remove_stale_aliases`."""
+    _reductions.clear()
+    _shards.clear()
+
+    for schema in {None, *QDRANT_SHARD_HOSTS}:
+        client = client_factory(schema)
+        for alias in client.get_aliases().aliases:
+            if not is_stale_alias(alias.alias_name, collection, sharded):
+                continue
+            logger.info(
+                f"Removing stale alias {alias.alias_name} "
+                f"and its collection {alias.collection_name}"
+            )
+            client.update_collection_aliases(
+                [
+                    models.DeleteAliasOperation(
+                        delete_alias=models.DeleteAlias(alias_name=alias.alias_name)
+                    )
+                ]
+            )
+            client.delete_collection(alias.collection_name)
+            remove_old_reductions(alias.alias_name)
+
+
+def load_vectors(
+    schema: str,
+    docs: list[dict[str, str]],
+    vectors: list[np.ndarray],
+    reduction: VectorReduction | None = None,
+    doc_store: DocStoreWriter | None = None,
+):
+    """
+    Upsert `docs` and their embeddings.  Pass the collection's `reduction` to
+    load collections created with a reduced dimension.  With a `doc_store`,
+    the documents are written to it and the points get slim payloads.
+    """
+    from tqdm import tqdm
+
     for chunk in tqdm(range(0, len(docs), CHUNK_SIZE)):
         docs_chunk = docs[chunk : chunk + CHUNK_SIZE]
         vectors_chunk = vectors[chunk : chunk + CHUNK_SIZE]
 
+        if reduction is None:
+            point_vectors = [vector.tolist() for vector in vectors_chunk]
+        else:
+            reduced_chunk = reduction.transform(np.stack(vectors_chunk))
+            point_vectors = [
+                {FULL_VECTOR: vector.tolist(), REDUCED_VECTOR: reduced.tolist()}
+                for vector, reduced in zip(vectors_chunk, reduced_chunk)
+            ]
+
         points = []
-        for doc, vector in zip(docs_chunk, vectors_chunk):
-            # Sort the keys to guarantee uniqueness of the `id`.
-            text = json.dumps(doc, sort_keys=True)
-            id = str(uuid.uuid3(uuid.NAMESPACE_OID, text))
-            points.append(
-                models.PointStruct(id=id, vector=vector.tolist(), payload=doc)
-            )
+        for doc, vector in zip(docs_chunk, point_vectors):
+            id = point_id(doc)
+            payload = doc if doc_store is None else slim_payload(doc, doc_store.name)
+            points.append(models.PointStruct(id=id, vector=vector, payload=payload))
+
+        if doc_store is not None:
+            doc_store.add([str(point.id) for point in points], docs_chunk)
 
         def try_once():
-            client = client_factory()
+            client = client_factory(schema)
             client.upsert(schema, points=points)
 
         backoff_and_retry(try_once)
 
 
-def get_relevant_responses(schema, embedding, count):
-    client = client_factory()
+def collection_dimensions(schema: str) -> tuple[int, int | None]:
+    """Return the full and the reduced (or None) vector size of `schema`."""
+    vectors = client_factory(schema).get_collection(schema).config.params.vectors
+    if isinstance(vectors, dict):
+        return vectors[FULL_VECTOR].size, vectors[REDUCED_VECTOR].size
+    return vectors.size, None  # type:ignore
+
+
+def snapshot_url(schema: str, path: str = "") -> str:
+    return f"http://{shard_host(schema)}:{QDRANT_PORT}/collections/{schema}/snapshots{path}"
+
+
+def download_snapshot(schema: str, filename: str):
+    """Create a snapshot of `schema` on its Qdrant node and download it."""
+    import requests
+
+    client = client_factory(schema)
+    snapshot = client.create_snapshot(schema)
+    if snapshot is None:
+        raise RuntimeError(f"Creating a snapshot of {schema} failed")
+
+    with requests.get(
+        snapshot_url(schema, f"/{snapshot.name}"), stream=True
+    ) as response:
+        response.raise_for_status()
+        with open(filename, "wb") as snapshot_file:
+            for block in response.iter_content(chunk_size=2**20):
+                snapshot_file.write(block)
+
+    client.delete_snapshot(schema, snapshot.name)
+
+
+class MultipartFile:
+    """
+    A multipart/form-data body holding `file` as the field `name`.  The body
+    is read in blocks, so the file is never held in memory, and has a length,
+    so requests sends a Content-Length rather than chunks.
+    """
+
+    def __init__(self, name: str, file: BinaryIO):
+        self.boundary = uuid.uuid4().hex
+        head = (
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="{name}"; '
+            f'filename="{os.path.basename(file.name)}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+        ).encode()
+        tail = f"\r\n--{self.boundary}--\r\n".encode()
+        self.parts: list[BinaryIO] = [io.BytesIO(head), file, io.BytesIO(tail)]
+        self.length = len(head) + os.fstat(file.fileno()).st_size + len(tail)
+
+    @property
+    def content_type(self) -> str:
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self) -> int:
+        return self.length
+
+    def read(self, size: int = -1) -> bytes:
+        data = b""
+        while self.parts and (size < 0 or len(data) < size):
+            block = self.parts[0].read(size - len(data) if size >= 0 else -1)
+            if not block:
+                self.parts.pop(0)
+            data += block
+        return data
+
+
+def upload_snapshot(schema: str, filename: str):
+    """Create `schema` on its Qdrant node from a snapshot file."""
+    import requests
+
+    with open(filename, "rb") as snapshot_file:
+        body = MultipartFile("snapshot", snapshot_file)
+        response = requests.post(
+            snapshot_url(schema, "/upload"),
+            params={"priority": "snapshot"},
+            data=body,
+            headers={"Content-Type": body.content_type},
+        )
+    response.raise_for_status()
+
+
+def export_points(schema: str, directory: str) -> int:
+    """
+    Write the points of `schema` to `directory`: ids and payloads to
+    points.jsonl and the vectors (one array per vector name) to vectors.npz.
+    For local mode, which has no snapshots.  The vectors are streamed to a
+    raw file per name first, so they're never all held in memory.
+
+    Returns:
+        The number of points.
+    """
+    client = client_factory(schema)
+
+    # Raw float32 file and dimension of each vector name.
+    vector_files: dict[str, tuple[BinaryIO, int]] = {}
+    count = 0
+    offset = None
+    with open(os.path.join(directory, "points.jsonl"), "w") as points_file:
+        while True:
+            records, offset = client.scroll(
+                schema,
+                limit=EXPORT_CHUNK_SIZE,
+                offset=offset,
+                with_payload=True,
+                with_vectors=True,
+            )
+            for record in records:
+                points_file.write(
+                    json.dumps({"id": str(record.id), "payload": record.payload}) + "\n"
+                )
+                record_vectors = record.vector
+                if not isinstance(record_vectors, dict):
+                    record_vectors = {"": record_vectors or []}
+                for name, vector in record_vectors.items():
+                    if name not in vector_files:
+                        vector_files[name] = (
+                            open(os.path.join(directory, f"vectors.{name}.raw"), "wb"),
+                            len(vector),
+                        )
+                    vector_files[name][0].write(
+                        np.asarray(vector, dtype=np.float32).tobytes()
+                    )
+            count += len(records)
+            if offset is None:
+                break
+
+    vectors = {}
+    for name, (vector_file, dimension) in vector_files.items():
+        vector_file.close()
+        vectors[name] = np.memmap(
+            vector_file.name, dtype=np.float32, mode="r", shape=(count, dimension)
+        )
+    np.savez(os.path.join(directory, "vectors.npz"), **vectors)
+    for name, (vector_file, _) in vector_files.items():
+        del vectors[name]
+        os.remove(vector_file.name)
+    return count
+
+
+def import_points(schema: str, directory: str):
+    """Upsert the points written by `export_points` into `schema`."""
+    from tqdm import tqdm
+
+    with open(os.path.join(directory, "points.jsonl")) as points_file:
+        points = list(map(json.loads, points_file))
+    with np.load(os.path.join(directory, "vectors.npz")) as vector_file:
+        vectors = {name: vector_file[name] for name in vector_file.files}
+
+    for chunk in tqdm(range(0, len(points), CHUNK_SIZE)):
+        point_structs = []
+        for index in range(chunk, min(chunk + CHUNK_SIZE, len(points))):
+            point_vectors = {
+                name: values[index].tolist() for name, values in vectors.items()
+            }
+            point_structs.append(
+                models.PointStruct(
+                    id=points[index]["id"],
+                    vector=point_vectors.get("") or point_vectors,
+                    payload=points[index]["payload"],
+                )
+            )
+
+        def try_once():
+            client_factory(schema).upsert(schema, points=point_structs)
+
+        backoff_and_retry(try_once)
+
+
+def search(schema: str, embedding, count: int) -> list[models.ScoredPoint]:
+    """
+    Return the `count` points nearest to `embedding`, using two-stage search
+    if the collection has reduced vectors.
+    """
+    collection, reduction, *_ = get_reduction(schema)
+    try:
+        return search_collection(collection, reduction, embedding, count)
+    except Exception:
+        # The alias may have been switched (and the collection removed) since
+        # it was resolved; if so, search the new collection.
+        _reductions.pop(schema, None)
+        new_collection, new_reduction, *_ = get_reduction(schema)
+        if (new_collection, new_reduction) == (collection, reduction):
+            raise
+        return search_collection(new_collection, new_reduction, embedding, count)
+
+
+def search_collection(
+    collection: str, reduction: VectorReduction | None, embedding, count: int
+) -> list[models.ScoredPoint]:
+    client = client_factory(collection)
+    if reduction is None:
+        return client.search(collection, embedding, limit=count)
+
+    # Only the payloads of the points that survive re-ranking are fetched.
+    candidates = client.search(
+        collection,
+        models.NamedVector(
+            name=REDUCED_VECTOR, vector=reduction.transform(embedding).tolist()
+        ),
+        limit=count * RERANK_OVERFETCH,
+        with_payload=False,
+        with_vectors=[FULL_VECTOR],
+    )
+    if not candidates:
+        return candidates
+
+    # Qdrant normalizes the stored vectors for cosine distance, so the dot
+    # product with the normalized query is the cosine similarity.
+    query = np.asarray(embedding, dtype=np.float32)
+    query /= np.linalg.norm(query) or 1
+    full_vectors = np.array(
+        [point.vector[FULL_VECTOR] for point in candidates],  # type:ignore
+        dtype=np.float32,
+    )
+    scores = full_vectors @ query
+    for point, score in zip(candidates, scores):
+        point.score = float(score)
+        point.vector = None
+
+    best = [candidates[index] for index in np.argsort(-scores, kind="stable")[:count]]
+    payloads = {
+        record.id: record.payload
+        for record in client.retrieve(
+            collection, [point.id for point in best], with_payload=True
+        )
+    }
+    for point in best:
+        point.payload = payloads.get(point.id)
+    return best
+
+
+def measure_recall(schema: str, queries: list, count: int) -> float:
+    """
+    Return the average fraction of the exact `count` nearest neighbors of each
+    of `queries` that `search` finds.
+    """
+    client = client_factory(schema)
+    exact_vector = FULL_VECTOR if get_reduction(schema).reduction is not None else None
+
+    recalls = []
+    for query in queries:
+        query = list(map(float, query))
+        exact = client.search(
+            schema,
+            (exact_vector, query) if exact_vector else query,
+            limit=count,
+            search_params=models.SearchParams(exact=True),
+            with_payload=False,
+        )
+        found = {point.id for point in search(schema, query, count)}
+        if exact:
+            recalls.append(sum(point.id in found for point in exact) / len(exact))
+    return float(np.mean(recalls)) if recalls else 1.0
+
+
+def search_shards(shards: list[str], embedding, count: int) -> list[models.ScoredPoint]:
+    """Search `shards` concurrently and merge their results by score."""
+    return search_shards_concurrently(
+        lambda shard: search(shard, embedding, count), shards, count
+    )
+
+
+def get_relevant_responses(schema, embedding, count, years: set[str] | None = None):
+    """
+    Return the `count` documents nearest to `embedding`.  If
+    `schema` is sharded, only the shards of the tax `years` are searched.
+    """
     logger.info(f"Querying relevant verbatim responses...")
 
-    query_result = client.search(schema, embedding, limit=count)
-    relevant_documents = [point.payload for point in query_result]
+    shards = get_shards(schema)
+    if shards:
+        shards = select_shards(schema, shards, years)
+        logger.info(f"Searching shards: {', '.join(shards)}")
+        query_result = search_shards(shards, embedding, count)
+    else:
+        query_result = search(schema, embedding, count)
+    relevant_documents = resolve_payloads(
+        [str(point.id) for point in query_result],
+        [point.payload or {} for point in query_result],
+    )
     return relevant_documents
+
+
+class QdrantVectorStore(VectorStore):
+    name = "qdrant"
+
+    def create(self, schema, dimension, reduced_dimension=None):
+        remove_and_recreate_schema(schema, dimension, reduced_dimension)
+
+    def load(self, schema, docs, vectors, reduction=None, doc_store=None):
+        load_vectors(schema, docs, vectors, reduction, doc_store)
+
+    def finalize(self, schema):
+        restore_indexing(schema)
+
+    def wait_until_ready(self, schema):
+        wait_until_ready(schema)
+
+    def swap_alias(self, loading_collection, alias):
+        rename(loading_collection, alias)
+
+    def remove_stale_aliases(self, collection, sharded):
+        remove_stale_aliases(collection, sharded)
+
+    def delete(self, schema):
+        client_factory(schema).delete_collection(schema)
+
+    def search(self, schema, embedding, count, years=None):
+        return get_relevant_responses(schema, embedding, count, years)
+
+    def measure_recall(self, schema, queries, count):
+        return measure_recall(schema, queries, count)
+
+    def export_snapshot(self, alias, collection, directory=None, source=None):
+        from query_gpt import snapshot
+
+        return snapshot.export_collection(
+            alias, collection, directory or snapshot.SNAPSHOT_DIR, source
+        )
+
+    def restore_snapshot(self, artifact, alias=None, verify=True):
+        from query_gpt import snapshot
+
+        return snapshot.restore_collection(artifact, alias, verify)
@@ -1,49 +1,343 @@
 import logging
 import os
-from tqdm import tqdm
-import json
+import re
+import time
 
 import weaviate
 
+from query_gpt.databases import (
+    LOADING_SUFFIX_PATTERN,
+    Hit,
+    VectorStore,
+    is_stale_alias,
+    point_id,
+    search_shards,
+    select_shards,
+)
+from query_gpt.doc_store import (
+    DOC_STORE_KEY,
+    DocStoreWriter,
+    resolve_payloads,
+    slim_payload,
+)
+from query_gpt.prompt import ORDERED_FIELDS
+
 WEAVIATE_URL = os.environ.get("WEAVIATE_URL", "http://localhost:8080")
-CHUNK_SIZE = 50
+# Initial batch size; with dynamic batching the client adjusts it to how fast
+# Weaviate creates the objects.
+BATCH_SIZE = 100
+IMPORT_WORKERS = int(os.environ.get("WEAVIATE_IMPORT_WORKERS", 4))
+READY_POLL_SECONDS = 5
+
+# Weaviate has no aliases, so they're emulated by objects of this class,
+# one per alias, naming the class that the alias points at.  The alias list
+# is cached this long.
+ALIAS_CLASS = "VectorStoreAlias"
+ALIAS_CACHE_SECONDS = 60
+ALIAS_LIMIT = 10_000
+
+# Weaviate data type of each document field.  Fields are stored as native
+# properties named by `property_name`.
+FIELD_TYPES = {field: "text" for field in ORDERED_FIELDS} | {
+    "Total Revenue": "number",
+    "Total Expenses": "number",
+    "Employee Count": "int",
+    "Volunteer Count": "int",
+    "Return Timestamp": "text",
+    "Amended Return": "boolean",
+    DOC_STORE_KEY: "text",
+}
+# Fields that are matched as a whole rather than word by word.
+EXACT_FIELDS = ("EIN", "Tax Year", DOC_STORE_KEY)
+CONVERTERS = {"text": str, "number": float, "int": int, "boolean": bool}
+
+# Loading classes are named like "<alias>-<timestamp>", but `class_name`
+# replaces the "-" and "." of the timestamp by "_".
+LOADING_CLASS_SUFFIX_PATTERN = re.sub(r"-|\\\.", "_", LOADING_SUFFIX_PATTERN)
 
 logger = logging.getLogger(__name__)
 
+_client: weaviate.Client | None = None
+
+
+def client_factory() -> weaviate.Client:
+    global _client
+
+    if _client is None:
+        _client = weaviate.Client(url=WEAVIATE_URL)
+    return _client
+
 
-def client_factory():
-    return weaviate.Client(url=WEAVIATE_URL)
+def class_name(schema: str) -> str:
+    """Weaviate class names are capitalized and can't contain "-", ".", etc."""
+    name = re.sub(r"\W", "_", schema)
+    return name[0].upper() + name[1:]
+
+
+def property_name(field: str) -> str:
+    return re.sub(r"\W+", "_", field).strip("_").lower()
+
+
+FIELD_NAMES = {property_name(field): field for field in FIELD_TYPES}
+
+
+def to_properties(doc: dict) -> dict:
+    return {
+        property_name(field): CONVERTERS[FIELD_TYPES[field]](value)
+        for field, value in doc.items()
+        if field in FIELD_TYPES and value is not None
+    }
+
+
+def from_properties(properties: dict) -> dict:
+    return {
+        FIELD_NAMES[name]: value
+        for name, value in properties.items()
+        if name in FIELD_NAMES and value is not None
+    }
 
 
 def remove_if_exists(schema: str):
     client = client_factory()
+    name = class_name(schema)
 
-    if client.schema.exists(schema):
-        logger.info(f"Removing existing Weaviate class: {schema}")
-        client.schema.delete_class(schema)
+    if client.schema.exists(name):
+        logger.info(f"Removing existing Weaviate class: {name}")
+        client.schema.delete_class(name)
 
-    logger.info(f"Creating Weaviate class: {schema}")
+    logger.info(f"Creating Weaviate class: {name}")
     class_obj = {
-        "class": schema,
+        "class": name,
         "vectorizer": "none",
         "vectorIndexType": "hnsw",
         "vectorIndexConfig": {
+            "distance": "cosine",
             "vectorCacheMaxObjects": 25_000,
         },
+        "properties": [
+            {
+                "name": property_name(field),
+                "dataType": [data_type],
+                **({"tokenization": "field"} if field in EXACT_FIELDS else {}),
+            }
+            for field, data_type in FIELD_TYPES.items()
+        ],
     }
     client.schema.create_class(class_obj)
 
 
-def load_vectors(schema: str, docs: list[str], vectors: list[list[float]]):
+def load_vectors(
+    schema: str,
+    docs: list[dict],
+    vectors: list,
+    doc_store: DocStoreWriter | None = None,
+):
+    """
+    Import `docs` and their embeddings with IMPORT_WORKERS concurrent,
+    dynamically sized batches.  With a `doc_store`, the documents are written
+    to it and the objects only get the slim payload properties.
+    """
+    from tqdm import tqdm
+
+    client = client_factory()
+    name = class_name(schema)
+
+    errors = []
+
+    def check_batch_result(results):
+        for result in results or []:
+            result_errors = result.get("result", {}).get("errors")
+            if result_errors:
+                errors.append(result_errors)
+
+    client.batch.configure(
+        batch_size=BATCH_SIZE,
+        dynamic=True,
+        num_workers=IMPORT_WORKERS,
+        timeout_retries=3,
+        connection_error_retries=3,
+        callback=check_batch_result,
+    )
+
+    ids = [point_id(doc) for doc in docs]
+    with client.batch as batch:
+        for id, doc, vector in tqdm(zip(ids, docs, vectors), total=len(docs)):
+            payload = doc if doc_store is None else slim_payload(doc, doc_store.name)
+            batch.add_data_object(
+                data_object=to_properties(payload),
+                class_name=name,
+                uuid=id,
+                vector=[float(value) for value in vector],
+            )
+
+    if doc_store is not None:
+        doc_store.add(ids, docs)
+
+    if errors:
+        raise RuntimeError(
+            f"Importing into {name} failed for {len(errors):,d} objects: {errors[0]}"
+        )
+
+
+def wait_until_ready(schema: str, wait: float = READY_POLL_SECONDS):
     client = client_factory()
+    name = class_name(schema)
+    while True:
+        shards = client.schema.get_class_shards(name)
+        if all(shard["status"] == "READY" for shard in shards):
+            logger.info(f"Class {name} is ready.")
+            break
+        logger.info(f"Class {name} is not ready.  Waiting {wait} seconds...")
+        time.sleep(wait)
+
+
+# Map from alias to the class it points at: (time listed, aliases).
+_aliases: tuple[float | None, dict[str, str]] = (None, {})
+
+
+def get_aliases() -> dict[str, str]:
+    global _aliases
+
+    listed, aliases = _aliases
+    if listed is None or time.monotonic() - listed > ALIAS_CACHE_SECONDS:
+        client = client_factory()
+        aliases = {}
+        if client.schema.exists(ALIAS_CLASS):
+            result = (
+                client.query.get(ALIAS_CLASS, ["alias", "target"])
+                .with_limit(ALIAS_LIMIT)
+                .do()
+            )
+            for alias in result["data"]["Get"][ALIAS_CLASS]:
+                aliases[alias["alias"]] = alias["target"]
+        _aliases = (time.monotonic(), aliases)
+    return aliases
+
+
+def rename(loading_collection: str, collection: str):
+    """Point the alias `collection` at `loading_collection`."""
+    global _aliases
+
+    client = client_factory()
+    if not client.schema.exists(ALIAS_CLASS):
+        client.schema.create_class(
+            {
+                "class": ALIAS_CLASS,
+                "vectorizer": "none",
+                "properties": [
+                    {"name": "alias", "dataType": ["text"], "tokenization": "field"},
+                    {"name": "target", "dataType": ["text"], "tokenization": "field"},
+                ],
+            }
+        )
+
+    alias_id = weaviate.util.generate_uuid5(collection)
+    alias = {"alias": collection, "target": class_name(loading_collection)}
+    if client.data_object.exists(alias_id, class_name=ALIAS_CLASS):
+        client.data_object.replace(alias, ALIAS_CLASS, alias_id)
+    else:
+        client.data_object.create(alias, ALIAS_CLASS, alias_id)
+    _aliases = (None, {})
+
+    # Remove any loading classes left over from the past for this alias.
+    old_class = re.compile(
+        f"{re.escape(class_name(collection))}_{LOADING_CLASS_SUFFIX_PATTERN}"
+    )
+    for class_description in client.schema.get()["classes"]:
+        existing_class = class_description["class"]
+        if old_class.fullmatch(existing_class) and existing_class != class_name(
+            loading_collection
+        ):
+            logger.info(f"Removing old class: {existing_class}")
+            client.schema.delete_class(existing_class)
+
+
+def remove_stale_aliases(collection: str, sharded: bool):
+    """See `VectorStore.remove_stale_aliases`."""
+    global _aliases
+
+    client = client_factory()
+    _aliases = (None, {})
+    for alias, target in get_aliases().items():
+        if not is_stale_alias(alias, collection, sharded):
+            continue
+        logger.info(f"Removing stale alias {alias} and its class {target}")
+        client.data_object.delete(
+            weaviate.util.generate_uuid5(alias), class_name=ALIAS_CLASS
+        )
+        if client.schema.exists(target):
+            client.schema.delete_class(target)
+    _aliases = (None, {})
+
+
+def search(schema: str, embedding, count: int) -> list[Hit]:
+    """Return the `count` objects of class `schema` nearest to `embedding`."""
+    name = class_name(schema)
+    result = (
+        client_factory()
+        .query.get(name, list(FIELD_NAMES))
+        .with_near_vector({"vector": [float(value) for value in embedding]})
+        .with_limit(count)
+        .with_additional(["id", "distance"])
+        .do()
+    )
+    if "errors" in result:
+        raise RuntimeError(f"Searching {name} failed: {result['errors']}")
+
+    return [
+        Hit(
+            id=item["_additional"]["id"],
+            score=1 - item["_additional"]["distance"],
+            payload=from_properties(item),
+        )
+        for item in result["data"]["Get"][name]
+    ]
+
+
+def get_relevant_responses(schema, embedding, count, years: set[str] | None = None):
+    """
+    Return the `count` documents nearest to `embedding`.  If `schema` is
+    sharded, only the shards of the tax `years` are searched.
+    """
+    logger.info(f"Querying relevant verbatim responses...")
+
+    aliases = get_aliases()
+    shards = sorted(alias for alias in aliases if alias.startswith(f"{schema}-"))
+    if shards:
+        shards = select_shards(schema, shards, years)
+        logger.info(f"Searching shards: {', '.join(shards)}")
+        hits = search_shards(
+            lambda shard: search(aliases[shard], embedding, count), shards, count
+        )
+    else:
+        hits = search(aliases.get(schema, schema), embedding, count)
+
+    return resolve_payloads([hit.id for hit in hits], [hit.payload for hit in hits])
+
+
+class WeaviateVectorStore(VectorStore):
+    name = "weaviate"
+
+    def create(self, schema, dimension, reduced_dimension=None):
+        # Weaviate takes the dimension from the first vector.
+        if reduced_dimension:
+            raise ValueError("The Weaviate backend doesn't support reduced vectors")
+        remove_if_exists(schema)
+
+    def load(self, schema, docs, vectors, reduction=None, doc_store=None):
+        load_vectors(schema, docs, vectors, doc_store)
+
+    def wait_until_ready(self, schema):
+        wait_until_ready(schema)
+
+    def swap_alias(self, loading_collection, alias):
+        rename(loading_collection, alias)
+
+    def remove_stale_aliases(self, collection, sharded):
+        remove_stale_aliases(collection, sharded)
 
-    for chunk in tqdm(range(0, len(docs), CHUNK_SIZE)):
-        docs_chunk = docs[chunk : chunk + CHUNK_SIZE]
-        vectors_chunk = vectors[chunk : chunk + CHUNK_SIZE]
+    def delete(self, schema):
+        client_factory().schema.delete_class(class_name(schema))
 
-        with client.batch() as batch:
-            for doc, vector in zip(docs_chunk, vectors_chunk):
-                object = {"doc": json.dumps(doc)}
-                batch.add_data_object(
-                    data_object=object, class_name=schema, vector=vector
-                )
+    def search(self, schema, embedding, count, years=None):
+        return get_relevant_responses(schema, embedding, count, years)
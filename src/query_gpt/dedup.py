@@ -0,0 +1,151 @@
+"""
+Deduplication of repeated and amended returns.
+
+The same organization files in several segments and years, and amended
+returns are separate XML files, so `parse` can produce several documents for
+one filing.  A Deduplicator keeps one document per key according to a policy.
+"""
+import datetime as dt
+import hashlib
+import logging
+
+from query_gpt.prompt import doc_to_string
+
+logger = logging.getLogger(__name__)
+
+# "filing" identifies a filing by EIN and Tax Period; "content" by a hash of
+# the rendered document (i.e., only exact duplicates are removed).
+DEDUP_KEYS = ("filing", "content")
+
+# "latest" keeps the most recently filed return (amended returns win ties),
+# "amended" prefers amended returns and then the most recent one, and
+# "first" keeps whichever return was seen first.
+DEDUP_POLICIES = ("latest", "amended", "first")
+
+DEFAULT_DEDUP_KEY = "filing"
+DEFAULT_DEDUP_POLICY = "latest"
+
+
+# Sorts before any real timestamp.
+UNKNOWN_TIMESTAMP = dt.datetime.min.replace(tzinfo=dt.timezone.utc)
+
+
+def filing_key(doc: dict) -> str | None:
+    """Return the EIN and Tax Period of `doc`, or None if either is missing."""
+    if doc.get("EIN") and doc.get("Tax Period") not in (None, "None to None"):
+        return f"{doc.get('EIN')}|{doc.get('Tax Period')}"
+    return None
+
+
+def dedup_key(doc: dict, key: str = DEFAULT_DEDUP_KEY) -> str:
+    if key == "filing":
+        # A return without an EIN or tax period can't be matched to other
+        # filings, so only exact duplicates of it are removed.
+        filing = filing_key(doc)
+        if filing is not None:
+            return filing
+        key = "content"
+    if key == "content":
+        return hashlib.sha1(doc_to_string(doc).encode()).hexdigest()
+    raise ValueError(f"Unknown dedup key {key!r}")
+
+
+def return_timestamp(doc: dict) -> dt.datetime:
+    """
+    Parse the "Return Timestamp" (ISO 8601, usually with a UTC offset) so
+    that timestamps with different offsets compare correctly.  Timestamps
+    without an offset are taken as UTC.
+    """
+    timestamp = doc.get("Return Timestamp")
+    if not timestamp:
+        return UNKNOWN_TIMESTAMP
+    try:
+        parsed = dt.datetime.fromisoformat(str(timestamp).replace("Z", "+00:00"))
+    except ValueError:
+        logger.warning(f"Unparseable return timestamp {timestamp!r}")
+        return UNKNOWN_TIMESTAMP
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=dt.timezone.utc)
+    return parsed
+
+
+def rank(doc: dict, policy: str = DEFAULT_DEDUP_POLICY) -> tuple:
+    """Documents with a higher rank replace those with a lower rank."""
+    # Documents parsed before these fields existed rank lowest.
+    timestamp = return_timestamp(doc)
+    amended = bool(doc.get("Amended Return"))
+
+    if policy == "latest":
+        return timestamp, amended
+    elif policy == "amended":
+        return amended, timestamp
+    elif policy == "first":
+        return ()
+    raise ValueError(f"Unknown dedup policy {policy!r}")
+
+
+class Deduplicator:
+    """
+    Track the best document seen so far for each key.
+
+    `offer` is used in a single pass (e.g., streaming before embedding): a
+    document is kept if it beats every earlier document with the same key.
+    A later, better document can still supersede one that was already kept,
+    so a second pass can use `is_winner` to keep exactly one document per key.
+    """
+
+    def __init__(
+        self, key: str = DEFAULT_DEDUP_KEY, policy: str = DEFAULT_DEDUP_POLICY
+    ):
+        if key not in DEDUP_KEYS:
+            raise ValueError(f"Unknown dedup key {key!r}")
+        if policy not in DEDUP_POLICIES:
+            raise ValueError(f"Unknown dedup policy {policy!r}")
+
+        self.key = key
+        self.policy = policy
+        self.winners: dict[str, tuple[tuple, object]] = {}
+        self.seen = 0
+        self.dropped = 0
+        self.superseded = 0
+
+    def offer(self, doc: dict, ref: object = None) -> bool:
+        """
+        Record `doc` (identified by `ref`, if a second pass will follow).
+
+        Returns:
+            True if `doc` is the best document for its key so far.
+        """
+        self.seen += 1
+        key = dedup_key(doc, self.key)
+        doc_rank = rank(doc, self.policy)
+
+        current = self.winners.get(key)
+        if current is not None and doc_rank <= current[0]:
+            self.dropped += 1
+            return False
+
+        if current is not None:
+            self.superseded += 1
+        self.winners[key] = (doc_rank, ref)
+        return True
+
+    def retract(self):
+        """
+        Count a document that won when it was offered, but was replaced
+        before it was used, as dropped rather than replaced.
+        """
+        self.superseded -= 1
+        self.dropped += 1
+
+    def is_winner(self, doc: dict, ref: object) -> bool:
+        """After all documents were offered, is `ref` the one to keep?"""
+        return self.winners[dedup_key(doc, self.key)][1] == ref
+
+    def report(self) -> str:
+        return (
+            f"Deduplication ({self.key}, {self.policy}): "
+            f"{self.seen:,d} documents, {len(self.winners):,d} unique, "
+            f"{self.dropped:,d} duplicates dropped, "
+            f"{self.superseded:,d} replaced by a later filing"
+        )
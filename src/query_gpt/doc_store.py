@@ -0,0 +1,204 @@
+"""
+Local, read-only document store for collections loaded with slim payloads.
+
+With slim payloads, Qdrant only stores the fields used for filtering plus the
+name of the store that holds the full document.  The documents themselves
+are kept in a SQLite file (read through mmap) keyed by point id, with an
+in-process LRU cache for frequently returned documents.  Each loading
+collection gets its own store, named after it, so the live collection's
+store is untouched until the new collection has replaced it.
+"""
+from collections import OrderedDict, defaultdict
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+from query_gpt.config import DATA_DIR
+from query_gpt.databases import LOADING_SUFFIX_PATTERN
+
+logger = logging.getLogger(__name__)
+
+DOC_STORE_DIR = os.path.join(DATA_DIR, "doc_store")
+DOC_STORE_CACHE_SIZE = 10_000
+DOC_STORE_MMAP_SIZE = 2**30
+# Stay well below SQLite's limit on the number of query parameters.
+SELECT_CHUNK_SIZE = 500
+
+# Payload key naming the store with the full document; slim payloads only
+# keep SLIM_PAYLOAD_FIELDS besides it.
+DOC_STORE_KEY = "doc_store"
+SLIM_PAYLOAD_FIELDS = ("EIN", "Tax Year")
+
+
+class DocStoreError(Exception):
+    pass
+
+
+def doc_store_path(name: str) -> str:
+    return os.path.join(DOC_STORE_DIR, f"{name}.sqlite")
+
+
+def slim_payload(doc: dict, name: str) -> dict:
+    payload = {field: doc.get(field) for field in SLIM_PAYLOAD_FIELDS}
+    payload[DOC_STORE_KEY] = name
+    return payload
+
+
+def remove_old_stores(alias: str, keep: str):
+    """Remove the stores of the loading collections of `alias` other than `keep`."""
+    old_store = re.compile(f"{re.escape(alias)}-{LOADING_SUFFIX_PATTERN}\\.sqlite")
+    if not os.path.isdir(DOC_STORE_DIR):
+        return
+    for filename in os.listdir(DOC_STORE_DIR):
+        if old_store.fullmatch(filename) and filename != f"{keep}.sqlite":
+            logger.info(f"Removing old document store: {filename}")
+            os.remove(os.path.join(DOC_STORE_DIR, filename))
+
+
+class DocStoreWriter:
+    """
+    Build the store `name` in a temporary file, which replaces the store on
+    `commit`, so readers never see a partially written store.  If the load
+    fails, `discard` removes the temporary file.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.filename = doc_store_path(name)
+        self.temporary_filename = f"{self.filename}.{os.getpid()}.tmp"
+
+        os.makedirs(DOC_STORE_DIR, exist_ok=True)
+        if os.path.exists(self.temporary_filename):
+            os.remove(self.temporary_filename)
+
+        self.connection: sqlite3.Connection | None = sqlite3.connect(
+            self.temporary_filename
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS docs (id TEXT PRIMARY KEY, doc TEXT NOT NULL)"
+            " WITHOUT ROWID"
+        )
+
+    def add(self, ids: list[str], docs: list[dict]):
+        self.connection.executemany(  # type:ignore
+            "INSERT OR REPLACE INTO docs VALUES (?, ?)",
+            [(id, json.dumps(doc)) for id, doc in zip(ids, docs)],
+        )
+
+    def commit(self):
+        self.connection.commit()  # type:ignore
+        self.connection.close()  # type:ignore
+        self.connection = None
+        os.replace(self.temporary_filename, self.filename)
+        logger.info(f"Wrote document store {self.filename}")
+
+    def discard(self):
+        """Remove the temporary file unless the store was committed."""
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+            os.remove(self.temporary_filename)
+
+
+class DocStore:
+    """Read documents by point id, caching the DOC_STORE_CACHE_SIZE most recent."""
+
+    def __init__(self, name: str, cache_size: int = DOC_STORE_CACHE_SIZE):
+        self.filename = doc_store_path(name)
+        self.cache_size = cache_size
+        self.cache: OrderedDict[str, dict] = OrderedDict()
+        # Shard searches run in several threads.
+        self.lock = threading.Lock()
+        self.connection: sqlite3.Connection | None = None
+        # Identifies the file that is open, to notice when it is replaced.
+        self.file_id: tuple[int, int] | None = None
+
+    def connect(self):
+        if self.connection is not None:
+            self.connection.close()
+        status = os.stat(self.filename)
+        self.file_id = (status.st_ino, status.st_mtime_ns)
+        self.connection = sqlite3.connect(
+            f"file:{self.filename}?mode=ro", uri=True, check_same_thread=False
+        )
+        self.connection.execute(f"PRAGMA mmap_size={DOC_STORE_MMAP_SIZE}")
+
+    def replaced(self) -> bool:
+        try:
+            status = os.stat(self.filename)
+        except FileNotFoundError:
+            return False
+        return (status.st_ino, status.st_mtime_ns) != self.file_id
+
+    def select(self, ids: list[str]) -> list[tuple[str, str]]:
+        if self.connection is None:
+            self.connect()
+
+        rows: list[tuple[str, str]] = []
+        for start in range(0, len(ids), SELECT_CHUNK_SIZE):
+            chunk = ids[start : start + SELECT_CHUNK_SIZE]
+            rows += self.connection.execute(  # type:ignore
+                f"SELECT id, doc FROM docs WHERE id IN ({', '.join('?' * len(chunk))})",
+                chunk,
+            ).fetchall()
+        return rows
+
+    def get_many(self, ids: list[str]) -> dict[str, dict]:
+        """Return the documents with the given `ids` that are in the store."""
+        with self.lock:
+            found = {}
+            missing = []
+            for id in ids:
+                if id in self.cache:
+                    self.cache.move_to_end(id)
+                    found[id] = self.cache[id]
+                else:
+                    missing.append(id)
+
+            if missing:
+                rows = self.select(missing)
+                if len(rows) < len(set(missing)) and self.replaced():
+                    # A snapshot restore has replaced the store since it was
+                    # opened.
+                    self.connect()
+                    rows = self.select(missing)
+
+                for id, text in rows:
+                    found[id] = self.cache[id] = json.loads(text)
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+            return found
+
+
+_stores: dict[str, DocStore] = {}
+
+
+def get_doc_store(name: str) -> DocStore:
+    if name not in _stores:
+        _stores[name] = DocStore(name)
+    return _stores[name]
+
+
+def resolve_payloads(ids: list[str], payloads: list[dict]) -> list[dict]:
+    """Replace slim payloads by the full documents from their stores."""
+    slim_ids = defaultdict(list)
+    for id, payload in zip(ids, payloads):
+        if DOC_STORE_KEY in payload:
+            slim_ids[payload[DOC_STORE_KEY]].append(id)
+
+    docs = {}
+    for name, store_ids in slim_ids.items():
+        docs.update(get_doc_store(name).get_many(store_ids))
+
+    missing = [
+        id for store_ids in slim_ids.values() for id in store_ids if id not in docs
+    ]
+    if missing:
+        raise DocStoreError(
+            f"{len(missing)} documents are missing from the document store, "
+            f"e.g., {missing[0]}"
+        )
+    return [docs.get(id, payload) for id, payload in zip(ids, payloads)]
@@ -0,0 +1,280 @@
+"""
+Embedding providers used by `embed_chunk` and `embed_one`.
+
+"openai" calls the OpenAI embeddings API.  "local" is fitted on the corpus
+itself (hashed TF-IDF followed by a randomized SVD projection) and runs
+entirely on the CPU, so it works without network access.
+"""
+from abc import ABC, abstractmethod
+from functools import lru_cache
+import logging
+import os
+import re
+import threading
+import zlib
+
+import numpy as np
+
+from query_gpt.config import (
+    DATA_DIR,
+    EMBEDDING_DIMENSION,
+    EMBEDDING_MODEL,
+    EMBEDDING_PROVIDER,
+    EMBEDDING_TOKEN_GOAL,
+)
+from query_gpt.retry import backoff_and_retry
+
+logger = logging.getLogger(__name__)
+
+# How many documents to pass to OpenAPI at one time.
+OPENAI_BATCH_SIZE = 100
+
+LOCAL_MODEL_FILE = os.path.join(DATA_DIR, "embeddings", "local_embedding_model.npz")
+LOCAL_FEATURE_COUNT = 2**16  # Size of the hashed vocabulary
+LOCAL_DIMENSION = 256
+LOCAL_BATCH_SIZE = 5_000
+# The projection is fitted on (at most) this many documents.
+LOCAL_FIT_SAMPLE_SIZE = 50_000
+LOCAL_OVERSAMPLING = 16
+LOCAL_POWER_ITERATIONS = 2
+
+TOKEN_PATTERN = re.compile(r"\b\w\w+\b")
+
+
+@lru_cache(maxsize=None)
+def get_embedding_encoder():
+    import tiktoken
+
+    return tiktoken.encoding_for_model(EMBEDDING_MODEL)
+
+
+def truncate_at_token_limit(s: str):
+    encoder = get_embedding_encoder()
+    return encoder.decode(encoder.encode(s)[:EMBEDDING_TOKEN_GOAL])
+
+
+class EmbeddingProvider(ABC):
+    """
+    Interface for turning text into embeddings.
+
+    `batch_size` is the number of texts a caller should pass to `embed` at once.
+    Providers that learn from the corpus report `is_fitted == False` until
+    `fit` has been called (or a fitted model was loaded).
+    """
+
+    name = ""
+    dimension = 0
+    batch_size = 1
+    is_fitted = True
+    # Running total of billable tokens, for providers that charge for them.
+    usage = 0
+
+    @abstractmethod
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        """Return the embedding of each of `texts`."""
+
+    def fit(self, texts: list[str]):
+        pass
+
+    def save(self):
+        pass
+
+
+class OpenAIEmbeddingProvider(EmbeddingProvider):
+    name = "openai"
+    dimension = EMBEDDING_DIMENSION
+    batch_size = OPENAI_BATCH_SIZE
+    # `embed` is called from several threads of the ingest pipeline.
+    usage_lock = threading.Lock()
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        import openai
+
+        batch = list(map(truncate_at_token_limit, texts))
+
+        # OpenAI calls can fail.  Wrap in a retry loop.
+        def try_once():
+            result = openai.Embedding.create(
+                input=batch,
+                model=EMBEDDING_MODEL,
+            )
+            return result
+
+        result = backoff_and_retry(try_once)
+        with self.usage_lock:
+            self.usage += result["usage"]["total_tokens"]  # type:ignore
+        return [e["embedding"] for e in result["data"]]  # type:ignore
+
+
+class HashedTfidfEmbeddingProvider(EmbeddingProvider):
+    """
+    Local embeddings: words are hashed into LOCAL_FEATURE_COUNT buckets,
+    weighted by sublinear TF-IDF, and projected onto the top singular vectors
+    of the corpus term matrix (i.e., latent semantic analysis).  The IDF
+    weights and the projection are fitted once and stored in `model_file`.
+
+    The model is fitted on the first documents embedded without one (with
+    `query_gpt.pipeline`, a single segment), so its vocabulary and projection
+    favor that segment's tax year.  To fit it on another sample, delete
+    `model_file` and re-embed.
+    """
+
+    name = "local"
+    batch_size = LOCAL_BATCH_SIZE
+
+    def __init__(
+        self,
+        model_file: str | None = None,
+        dimension: int = LOCAL_DIMENSION,
+        feature_count: int = LOCAL_FEATURE_COUNT,
+    ):
+        self.model_file = model_file or LOCAL_MODEL_FILE
+        self.dimension = dimension
+        self.feature_count = feature_count
+        self.idf: np.ndarray | None = None
+        self.projection: np.ndarray | None = None
+        self.feature_index = _FeatureIndex(feature_count)
+
+        if os.path.exists(self.model_file):
+            self.load()
+
+    @property
+    def is_fitted(self):
+        return self.projection is not None
+
+    def term_matrix(self, texts: list[str]):
+        """Return the (len(texts), feature_count) sparse matrix of term counts."""
+        from scipy import sparse
+
+        indptr = [0]
+        indices: list[int] = []
+        for text in texts:
+            indices.extend(
+                map(self.feature_index.__getitem__, TOKEN_PATTERN.findall(text.lower()))
+            )
+            indptr.append(len(indices))
+
+        counts = sparse.csr_matrix(
+            (np.ones(len(indices), dtype=np.float32), indices, indptr),
+            shape=(len(texts), self.feature_count),
+        )
+        counts.sum_duplicates()
+        return counts
+
+    def fit(self, texts: list[str]):
+        logger.info(f"Fitting local embedding model on {len(texts):,d} documents")
+        counts = self.term_matrix(texts)
+
+        document_frequency = np.bincount(counts.indices, minlength=self.feature_count)
+        self.idf = (np.log((1 + len(texts)) / (1 + document_frequency)) + 1).astype(
+            np.float32
+        )
+
+        weights = self._weight(counts)
+
+        # Randomized SVD (Halko, Martinsson & Tropp): find an orthonormal basis
+        # for the range of `weights` from a random sketch, then take the exact
+        # SVD of the small matrix projected onto that basis.  Only the
+        # document-side basis is re-orthonormalized during power iterations;
+        # that's much cheaper than orthonormalizing the feature side and
+        # accurate enough for a handful of iterations.
+        rng = np.random.default_rng(42)
+        sketch_size = min(self.dimension + LOCAL_OVERSAMPLING, *weights.shape)
+        basis = weights @ rng.standard_normal((self.feature_count, sketch_size))
+        basis, _ = np.linalg.qr(basis)
+        for _ in range(LOCAL_POWER_ITERATIONS):
+            basis, _ = np.linalg.qr(weights @ (weights.T @ basis))
+
+        # SVD of the short, wide matrix `projected` via the eigendecomposition
+        # of its (sketch_size x sketch_size) Gram matrix.
+        projected = np.asarray(weights.T @ basis).T
+        eigenvalues, eigenvectors = np.linalg.eigh(projected @ projected.T)
+        top = np.argsort(eigenvalues)[::-1][: self.dimension]
+        singular_values = np.sqrt(np.maximum(eigenvalues[top], 1e-12))
+        right_vectors = (eigenvectors[:, top].T @ projected) / singular_values[:, None]
+
+        # Stored as (feature_count, dimension) so that sparse @ projection
+        # doesn't need to copy it.
+        self.projection = np.ascontiguousarray(right_vectors.T, dtype=np.float32)
+        self.dimension = self.projection.shape[1]
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        if not self.is_fitted:
+            raise RuntimeError(
+                f"Local embedding model has not been fitted ({self.model_file})"
+            )
+        vectors = self._weight(self.term_matrix(texts)) @ self.projection
+        return _normalize(vectors).tolist()
+
+    def _weight(self, counts):
+        """Apply sublinear TF and IDF weighting and normalize each row."""
+        weights = counts.copy()
+        np.log(weights.data, out=weights.data)
+        weights.data += 1
+        weights = weights.multiply(self.idf).tocsr()
+
+        norms = np.sqrt(np.asarray(weights.multiply(weights).sum(axis=1))).ravel()
+        norms[norms == 0] = 1
+        return weights.multiply(1 / norms[:, np.newaxis]).tocsr()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.model_file), exist_ok=True)
+        np.savez(
+            self.model_file,
+            idf=self.idf,
+            projection=self.projection,
+            feature_count=self.feature_count,
+        )
+        logger.info(f"Saved local embedding model to {self.model_file}")
+
+    def load(self):
+        with np.load(self.model_file) as model:
+            self.idf = model["idf"]
+            self.projection = model["projection"]
+            self.feature_count = int(model["feature_count"])
+        self.dimension = self.projection.shape[1]
+        self.feature_index = _FeatureIndex(self.feature_count)
+
+
+class _FeatureIndex(dict):
+    """Memoized map from a word to its hashed feature index."""
+
+    def __init__(self, feature_count: int):
+        super().__init__()
+        self.feature_count = feature_count
+
+    def __missing__(self, word: str) -> int:
+        index = self[word] = zlib.crc32(word.encode()) % self.feature_count
+        return index
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+PROVIDERS = {
+    OpenAIEmbeddingProvider.name: OpenAIEmbeddingProvider,
+    HashedTfidfEmbeddingProvider.name: HashedTfidfEmbeddingProvider,
+}
+
+_provider: EmbeddingProvider | None = None
+
+
+def get_embedding_provider() -> EmbeddingProvider:
+    """Return the (shared) provider selected by EMBEDDING_PROVIDER."""
+    global _provider
+
+    if _provider is None or _provider.name != EMBEDDING_PROVIDER:
+        if EMBEDDING_PROVIDER not in PROVIDERS:
+            raise ValueError(
+                f"Unknown embedding provider {EMBEDDING_PROVIDER!r}; "
+                f"expected one of {', '.join(PROVIDERS)}"
+            )
+        _provider = PROVIDERS[EMBEDDING_PROVIDER]()
+    return _provider
+
+
+def embed_one(text: str):
+    return get_embedding_provider().embed([text])[0]
@@ -1,21 +1,25 @@
 import gc
 import logging
+import math
 import os
 from typing import Callable
 
-import openai
 import pandas as pd
-import tiktoken
 from tqdm import tqdm
-from query_gpt.config import EMBEDDING_MODEL, EMBEDDING_TOKEN_GOAL
 
-from query_gpt.retry import backoff_and_retry
+from query_gpt.embedding_providers import (
+    LOCAL_FIT_SAMPLE_SIZE,
+    EmbeddingProvider,
+    embed_one,
+    get_embedding_provider,
+)
 
 logger = logging.getLogger(__name__)
 
 VECTOR_SEARCH_FILE_TEMPLATE = (
     "irs_form_990_embeddings_{year}_{segment}_{chunk_id}.parquet"
 )
+VECTOR_SEARCH_FILE_GLOB = "irs_form_990_embeddings*.parquet"
 
 # How many embeddings to store in a single file?
 # We limit it because the chunks in these files get generated in memory and
@@ -23,20 +27,11 @@ VECTOR_SEARCH_FILE_TEMPLATE = (
 
 CHUNK_SIZE = 5_000
 
-# How many documents to pass to OpenAPI at one time.
-OPENAI_BATCH_SIZE = 100
-
-EMBEDDING_ENCODER = tiktoken.encoding_for_model(EMBEDDING_MODEL)
-
-
-def truncate_at_token_limit(s: str):
-    return EMBEDDING_ENCODER.decode(EMBEDDING_ENCODER.encode(s)[:EMBEDDING_TOKEN_GOAL])
-
 
 def embed_chunk(chunk_of_docs, doc_to_string) -> dict[str, object]:
     """
-    Use OpenAI to Compute the embeddings for the documents in `docs`
-    and return a dictionary containing the documents that were embedded
+    Use the configured embedding provider to compute the embeddings for the
+    documents in `docs` and return a dictionary containing the documents that were embedded
     along with the associated embeddings.
 
     Arguments:
@@ -49,36 +44,22 @@ def embed_chunk(chunk_of_docs, doc_to_string) -> dict[str, object]:
         The value of "embedding" is a list of embeddigns matching the list of `chunk_of_docs`
     """
 
+    provider = get_embedding_provider()
+    initial_usage = provider.usage
+
     embeddings = []
-    usage = 0
-    for batch_index in tqdm(range(0, len(chunk_of_docs), OPENAI_BATCH_SIZE)):
+    for batch_index in tqdm(range(0, len(chunk_of_docs), provider.batch_size)):
         # Convert list of documents to embeddable text
         batch = list(
             map(
-                truncate_at_token_limit,
-                map(
-                    doc_to_string,
-                    chunk_of_docs[batch_index : batch_index + OPENAI_BATCH_SIZE],
-                ),
+                doc_to_string,
+                chunk_of_docs[batch_index : batch_index + provider.batch_size],
             )
         )
+        embeddings.extend(provider.embed(batch))
 
-        # OpenAI calls can fail.  Wrap in a retry loop  Try the batch up to
-        # RETRY_LIMIT times
-
-        def try_once():
-            result = openai.Embedding.create(
-                input=batch,
-                model=EMBEDDING_MODEL,
-            )
-            return result
-
-        result = backoff_and_retry(try_once)
-
-        embeddings.extend([e["embedding"] for e in result["data"]])  # type:ignore
-        usage += result["usage"]["total_tokens"]  # type:ignore
-
-    logger.info(f"Total tokens used: {usage}")
+    if provider.usage > initial_usage:
+        logger.info(f"Total tokens used: {provider.usage - initial_usage}")
 
     assert len(embeddings) == len(chunk_of_docs)
 
@@ -90,12 +71,20 @@ def embed_chunk(chunk_of_docs, doc_to_string) -> dict[str, object]:
     return search_data
 
 
-def embed_one(text: str):
-    api_result = openai.Embedding.create(
-        input=[text],
-        model=EMBEDDING_MODEL,
-    )
-    return api_result["data"][0]["embedding"]  # type:ignore
+def fit_if_necessary(
+    provider: EmbeddingProvider, docs: list[dict], doc_to_string: Callable[[dict], str]
+):
+    """
+    Fit `provider` on a sample of `docs` if it learns from the corpus and
+    hasn't been fitted yet.  The fitted model is saved so that later segments
+    and query-time embeddings use the same model.
+    """
+    if provider.is_fitted:
+        return
+
+    step = max(1, math.ceil(len(docs) / LOCAL_FIT_SAMPLE_SIZE))
+    provider.fit(list(map(doc_to_string, docs[::step])))
+    provider.save()
 
 
 def compute_search_embeddings(
@@ -135,6 +124,8 @@ def compute_search_embeddings(
 
     logger.info(f"Embedding {len(docs_to_embed):,d} documents")
 
+    fit_if_necessary(get_embedding_provider(), docs_to_embed, doc_to_string)
+
     for chunk_id, chunk_index in enumerate(
         tqdm(range(0, len(docs_to_embed), CHUNK_SIZE))
     ):
@@ -1,25 +1,19 @@
 from collections import Counter
-from glob import glob
 import logging
-import os
-import numpy as np
-import requests
-import tempfile
+import re
+import threading
 
-import tiktoken
 import xml.etree.ElementTree as ET
 
 
-from tqdm import tqdm
-from query_gpt.config import DATA_DIR, MODEL, INPUT_TOKEN_GOAL
-from query_gpt.embeddings import compute_search_embeddings
+from query_gpt.prompt import doc_to_string
 from query_gpt.retry import backoff_and_retry
 
 
 logger = logging.getLogger(__name__)
-counters = Counter()
-
-COMPUTE_EMBEDDINGS = True
+counters: Counter[str] = Counter()
+# `parse` runs in several threads of the ingest pipeline.
+counters_lock = threading.Lock()
 
 YEAR_LIST = (2022, 2023)
 
@@ -52,27 +46,10 @@ FILENAME_GLOB = "2023*_public.xml"
 NS = {"irs": "http://www.irs.gov/efile"}
 RETURN_TYPES_TO_SKIP = ("990PF", "990T", "990N")
 
-# Encoder to use to pre-check the token count when building the prompt
-ENCODER = tiktoken.encoding_for_model(MODEL)
-
-
-def download_and_parse_segment(year, segment):
-    docs = []
-    url = IRS_FILE_TEMPLATE.format(year=year, segment=segment)
-    request_result = requests.get(url)
-
-    with tempfile.NamedTemporaryFile("wb") as zip_file:
-        zip_file.write(request_result.content)
-
-        with tempfile.TemporaryDirectory() as extract_dir:
-            # Python zipfile cannot handle several IRS files so use command line :(
-            os.system(f"unzip -d {extract_dir} {zip_file.name} > /dev/null ")
-            for filename in glob(os.path.join(extract_dir, "*.xml")):
-                doc = parse(filename)
-                if doc is not None:
-                    docs.append(doc)
-
-    return docs
+RETURN_HEADER_TAG = f"{{{NS['irs']}}}ReturnHeader"
+FOREIGN_ADDRESS_PATTERN = re.compile(rb"<(\w+:)?ForeignAddress\b")
+AMENDED_RETURN_PATTERN = re.compile(rb"<(\w+:)?AmendedReturnInd\b")
+RETURN_HEADER_END_PATTERN = re.compile(rb"</(\w+:)?ReturnHeader>")
 
 
 def combine(items):
@@ -108,6 +85,46 @@ def get_all_fields(root: ET.Element, path: str):
     return [element.text for element in elements]
 
 
+def parse_header(filename) -> dict | None:
+    """
+    Return the fields of the return in `filename` that identify its filing
+    (see `query_gpt.dedup`), as `parse` would, or None if `parse` would skip
+    it.  Only the ReturnHeader is parsed, so this is much cheaper than `parse`.
+    """
+    with open(filename, "rb") as xml_file:
+        data = xml_file.read()
+    if FOREIGN_ADDRESS_PATTERN.search(data):
+        return None
+
+    # Only the header is fed to the parser.
+    header_end = RETURN_HEADER_END_PATTERN.search(data)
+    parser: ET.XMLPullParser[ET.Element] = ET.XMLPullParser(["end"])
+    parser.feed(data[: header_end.end()] if header_end else data)
+    for event in parser.read_events():
+        # Only "end" events, which are (event, element) pairs, are requested.
+        element = event[-1]
+        if isinstance(element, ET.Element) and element.tag == RETURN_HEADER_TAG:
+            header = element
+            break
+    else:
+        return None
+
+    return_type = get_field(header, "ReturnTypeCd")
+    if isinstance(return_type, str) and return_type in RETURN_TYPES_TO_SKIP:
+        return None
+
+    tax_period_start = get_field(header, "TaxPeriodBeginDt")
+    tax_period_end = get_field(header, "TaxPeriodEndDt")
+    fields = {
+        "EIN": get_field(header, "Filer/EIN"),
+        "Tax Period": f"{tax_period_start} to {tax_period_end}",
+        "Return Timestamp": get_field(header, "ReturnTs"),
+    }
+    if AMENDED_RETURN_PATTERN.search(data):
+        fields["Amended Return"] = True
+    return fields
+
+
 def parse(filename):
     root = ET.parse(filename).getroot()
 
@@ -116,7 +133,8 @@ def parse(filename):
     if return_type is not None and return_type in RETURN_TYPES_TO_SKIP:
         return
 
-    counters[return_type] += 1
+    with counters_lock:
+        counters[return_type] += 1
 
     # Skip non US addresses
     foreign_address = get_field(root, "ForeignAddress")
@@ -134,6 +152,11 @@ def parse(filename):
     tax_period_end = get_field(root, "TaxPeriodEndDt")
     doc["Tax Period"] = f"{tax_period_start} to {tax_period_end}"
 
+    # Not rendered in prompts; used to pick among duplicate filings (dedup.py).
+    doc["Return Timestamp"] = get_field(root, "ReturnTs")
+    if get_field(root, "AmendedReturnInd") is not None:
+        doc["Amended Return"] = True
+
     name1 = get_field(root, "BusinessName/BusinessNameLine1Txt")
     name2 = get_field(root, "BusinessName/BusinessNameLine2Txt")
     doc["Name"] = f"{name1}{' ' + str(name2) if name2 is not None else '' }"
@@ -193,105 +216,9 @@ def parse(filename):
     return doc
 
 
-ORDERED_FIELDS = [
-    "Return Type",
-    "EIN",
-    "Tax Year",
-    "Tax Period",
-    "Name",
-    "Address",
-    "Purpose",
-    "Activities",
-    "Website",
-    "Accomplishments",
-    "Revenue Categories",
-    "Expense Categories",
-    "Total Revenue",
-    "Total Expenses",
-    "Employee Count",
-    "Volunteer Count",
-]
-
-
-# Even though the dictionary is ordered, we persist these documents as JSON in the vector
-# database which destroys order.  If we care about the order, we need to specify it explicitly.
-def doc_to_string(doc):
-    return "".join(
-        [f"{key}: {doc[key]}\n" for key in ORDERED_FIELDS if doc.get(key) is not None]
-    )
-
-
-def make_prompt(question: str, items: list[dict[str, str]], failures: int) -> str:
-    """
-    Given a question about the survey data, design a prompt for
-    openai that should produce an answer to the question.
-    The context is the additional information to provide.
-    Arguments:
-        question: str - Question about the survey data
-        items: list[dict[str,str]] - Documents to be queried
-        failures: int - Number of API calls that have failed because of reponse length.
-    """
-
-    prefix = (
-        "The following records contain information taken from tax records "
-        "for non-profit organizations operating in the US. "
-        "The data for a single organization is delimited by <record> and </record>. "
-        "At the end of these records, there is a question for you to answer about "
-        "these non-profit organizations."
-        "Try to keep the total response below 500 words.\n"
-    )
-
-    instruction = (
-        "Please answer the question below about non-profit organizations.  "
-        "Some of the records above may not be relevant to the question.  Pleas ignore "
-        "any irrelevant records.  The most relevant ones may be near the top of the list. "
-        "Remember to keep "
-        "the response below 500 words. If you are asked to provide a list, you may "
-        "need to omit some items from the list.  "
-        "If so, state the the list is represntative and not complete. "
-        "Capitalize any responses appropriately, even if the source data was presented in ALL CAPS. "
-        f"{'Be *EXTREMELY* BRIEF in your answer. ' if failures > 0 else ''}"
-        "Answer the question precisely and exclude any records that are not relevant to the question. "
-        "The answer should be responsive. "
-        " It's better to provide no response than to provide a response with irrelevant information. "
-        "Base your answer primarily on the records above, but you may fill in "
-        "holes based on any prior knowledge you have of these organizations.\n"
-        f"Question: {question}\n"
-        "Answer: "
-    )
-    formatted_items = [f"<record>\n{doc_to_string(item)}</record>\n" for item in items]
-
-    # When counting fixed strings, two for the separators we'll add later.
-    fixed_count = len(ENCODER.encode(prefix)) + len(ENCODER.encode(instruction)) + 2
-
-    # When counting item tokens, add one for the separator we'll add later.
-    variable_counts = [len(ENCODER.encode(item)) + 1 for item in formatted_items]
-    allowed_item_count = sum(
-        np.cumsum(variable_counts) < (INPUT_TOKEN_GOAL / (2**failures) - fixed_count)
-    )
-
-    context = "\n".join(formatted_items[:allowed_item_count])
-    prompt = f"{prefix}\n{context}\n{instruction}"
-    token_count = len(ENCODER.encode(prompt))
-    logger.info(f"tiktoken token estimate: {token_count}")
-    return prompt
-
-
 if __name__ == "__main__":
-    for year in YEAR_LIST:
-        logger.info(f"Processing year: {year}")
-        for segment in tqdm(IRS_FILE_SEGMENTS[year]):
-            logger.info(f"Downloading segment: {segment} ({year})")
-            docs = download_and_parse_segment(year, segment)
-            logger.info(f"Parsed {len(docs):,d} documents in segment {segment}")
-
-            if COMPUTE_EMBEDDINGS:
-                compute_search_embeddings(
-                    docs,
-                    doc_to_string,
-                    data_dir=os.path.join(DATA_DIR, "embeddings"),
-                    year=year,
-                    segment=segment,
-                )
-            logger.info(f"{counters}")
-            logger.info("done")
+    # Ingest now streams through query_gpt.pipeline.
+    from query_gpt.pipeline import ingest_command
+
+    logging.basicConfig(level=logging.INFO)
+    ingest_command()
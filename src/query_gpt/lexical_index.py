@@ -0,0 +1,399 @@
+"""
+Local inverted index for lexical and EIN lookups.
+
+Dense vectors are poor at exact matches, and embedding a question costs a
+round trip to OpenAI.  The index scores the Name, Address, Purpose and
+Activities of each document with BM25 and maps EINs to documents exactly.
+It is built by `load_vector_db` from the same documents as the collection
+and stored as flat arrays (plus the documents as JSON lines) that are
+memory-mapped when queried, so opening it is cheap whatever its size.  The
+vocabulary, too, is a sorted array of terms, searched by bisection.
+
+Questions naming an EIN or the exact name of an organization are answered
+from the index alone (`confident_matches`); with RETRIEVAL_MODE=hybrid, the
+lexical and vector rankings of other questions are fused by reciprocal rank.
+"""
+from array import array
+import bisect
+import json
+import logging
+import mmap
+import os
+import re
+import shutil
+
+import numpy as np
+
+from query_gpt.config import DATA_DIR
+from query_gpt.dedup import dedup_key
+
+logger = logging.getLogger(__name__)
+
+LEXICAL_INDEX_DIR = os.path.join(DATA_DIR, "lexical_index")
+
+# Indexed fields and the weight of their terms; names are short, so a
+# matching name term counts more.
+INDEXED_FIELDS = {"Name": 3.0, "Address": 1.0, "Purpose": 1.0, "Activities": 1.0}
+BM25_K1 = 1.2
+BM25_B = 0.75
+STOP_WORDS = frozenset(
+    "a about an and are as at be by do does for from has have how in inc is it "
+    "its of on or that the their this to was what which who with".split()
+)
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+EIN_PATTERN = re.compile(r"(?<!\d)(\d{2})-?(\d{7})(?!\d)")
+
+# A name must have at least this many terms for a question containing it to
+# be taken as a lookup of that organization.
+MIN_NAME_TERMS = 2
+# Generic names ("Food Bank") also appear in broad questions, so the name
+# must also make up this share of the question's terms, or its documents
+# must outscore every other name by this factor.
+NAME_COVERAGE = 0.75
+NAME_SCORE_MARGIN = 1.5
+# Names are checked among this many of the best lexical matches.
+LOOKUP_CANDIDATES = 20
+# Constant of reciprocal rank fusion: higher values flatten the rank weights.
+RRF_K = 60
+
+
+def lexical_index_path(name: str) -> str:
+    return os.path.join(LEXICAL_INDEX_DIR, name)
+
+
+def tokenize(text) -> list[str]:
+    return [
+        token
+        for token in TOKEN_PATTERN.findall(str(text).lower())
+        if len(token) > 1 and token not in STOP_WORDS
+    ]
+
+
+def remove_lexical_index(name: str):
+    directory = lexical_index_path(name)
+    if os.path.exists(directory):
+        logger.info(f"Removing lexical index {directory}")
+        shutil.rmtree(directory)
+
+
+def ein_number(ein) -> int | None:
+    digits = re.sub(r"\D", "", str(ein or ""))
+    return int(digits) if digits else None
+
+
+def tax_year(doc: dict) -> int:
+    year = str(doc.get("Tax Year") or "")
+    return int(year) if year.isdigit() else 0
+
+
+class Vocabulary:
+    """
+    Sorted terms, stored as their concatenated UTF-8 bytes (`terms`) and the
+    offset of each term in them (`offsets`).  A term's id is its position.
+    """
+
+    def __init__(self, terms: np.ndarray, offsets: np.ndarray):
+        # Slicing memory views (of the same mapped memory) is much faster than
+        # slicing memmap arrays.
+        self.terms = terms.data
+        self.offsets = offsets.data
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, term_id: int) -> bytes:
+        return bytes(self.terms[self.offsets[term_id] : self.offsets[term_id + 1]])
+
+    def get(self, term: str) -> int | None:
+        """Return the id of `term`, or None if it isn't in the vocabulary."""
+        key = term.encode()
+        term_id = bisect.bisect_left(self, key)
+        if term_id < len(self) and self[term_id] == key:
+            return term_id
+        return None
+
+
+def index_file_id(directory: str) -> tuple[int, int]:
+    """Identify the index in `directory`, which a rebuild replaces."""
+    status = os.stat(directory)
+    return status.st_ino, status.st_mtime_ns
+
+
+class LexicalIndexWriter:
+    """
+    Build the index `name` in a temporary directory, which replaces the index
+    on `commit`, so readers never see a partially written index.
+    """
+
+    def __init__(self, name: str):
+        self.directory = lexical_index_path(name)
+        self.temporary_directory = f"{self.directory}.{os.getpid()}.tmp"
+
+        shutil.rmtree(self.temporary_directory, ignore_errors=True)
+        os.makedirs(self.temporary_directory)
+        self.docs_file = open(
+            os.path.join(self.temporary_directory, "docs.jsonl"), "wb"
+        )
+        self.doc_offsets = array("q", [0])
+
+        self.vocabulary: dict[str, int] = {}
+        # Postings, in document order.
+        self.term_ids = array("i")
+        self.doc_ids = array("i")
+        self.term_freqs = array("f")
+
+        self.doc_lengths = array("f")
+        self.tax_years = array("h")
+        self.eins = array("q")
+        self.ein_docs = array("i")
+
+    def add(self, docs: list[dict]):
+        for doc in docs:
+            doc_id = len(self.doc_lengths)
+            counts: dict[int, float] = {}
+            for field, weight in INDEXED_FIELDS.items():
+                if doc.get(field) is None:
+                    continue
+                for token in tokenize(doc[field]):
+                    term_id = self.vocabulary.setdefault(token, len(self.vocabulary))
+                    counts[term_id] = counts.get(term_id, 0.0) + weight
+
+            self.term_ids.extend(counts)
+            self.doc_ids.extend([doc_id] * len(counts))
+            self.term_freqs.extend(counts.values())
+            self.doc_lengths.append(sum(counts.values()))
+            self.tax_years.append(tax_year(doc))
+
+            ein = ein_number(doc.get("EIN"))
+            if ein is not None:
+                self.eins.append(ein)
+                self.ein_docs.append(doc_id)
+
+            line = json.dumps(doc).encode() + b"\n"
+            self.docs_file.write(line)
+            self.doc_offsets.append(self.doc_offsets[-1] + len(line))
+
+    def save(self, filename: str, values):
+        np.save(os.path.join(self.temporary_directory, filename), values)
+
+    def commit(self):
+        self.docs_file.close()
+
+        # Number the terms in sorted order, as the readers look them up.
+        terms = sorted(self.vocabulary)
+        encoded = [term.encode() for term in terms]
+        term_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        term_offsets[1:] = np.cumsum([len(term) for term in encoded])
+        self.save("terms.npy", np.frombuffer(b"".join(encoded), dtype=np.uint8))
+        self.save("term_offsets.npy", term_offsets)
+        sorted_ids = np.zeros(len(terms), dtype=np.int32)
+        sorted_ids[[self.vocabulary[term] for term in terms]] = np.arange(len(terms))
+
+        # Group the postings by term; the sort is stable, so each term's
+        # documents stay in order.
+        term_ids = sorted_ids[np.frombuffer(self.term_ids, dtype=np.int32)]
+        order = np.argsort(term_ids, kind="stable")
+        offsets = np.zeros(len(self.vocabulary) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(term_ids, minlength=len(self.vocabulary)))
+        self.save("offsets.npy", offsets)
+        self.save("doc_ids.npy", np.frombuffer(self.doc_ids, dtype=np.int32)[order])
+        self.save(
+            "term_freqs.npy", np.frombuffer(self.term_freqs, dtype=np.float32)[order]
+        )
+
+        self.save("doc_lengths.npy", np.frombuffer(self.doc_lengths, dtype=np.float32))
+        self.save("tax_years.npy", np.frombuffer(self.tax_years, dtype=np.int16))
+        self.save("doc_offsets.npy", np.frombuffer(self.doc_offsets, dtype=np.int64))
+
+        eins = np.frombuffer(self.eins, dtype=np.int64)
+        order = np.argsort(eins, kind="stable")
+        self.save("eins.npy", eins[order])
+        self.save("ein_docs.npy", np.frombuffer(self.ein_docs, dtype=np.int32)[order])
+
+        # Readers keep the files of the old index open (mapped) until they
+        # reopen the index.
+        old_directory = f"{self.directory}.{os.getpid()}.old"
+        if os.path.exists(self.directory):
+            os.replace(self.directory, old_directory)
+        os.replace(self.temporary_directory, self.directory)
+        shutil.rmtree(old_directory, ignore_errors=True)
+        logger.info(
+            f"Wrote lexical index {self.directory} ({len(self.doc_lengths):,d} "
+            f"documents, {len(self.vocabulary):,d} terms)"
+        )
+
+
+class LexicalIndex:
+    """Read-only, memory-mapped index written by LexicalIndexWriter."""
+
+    def __init__(self, name: str):
+        self.directory = lexical_index_path(name)
+        self.file_id = index_file_id(self.directory)
+        self.vocabulary = Vocabulary(
+            self.load("terms.npy"), self.load("term_offsets.npy")
+        )
+
+        self.offsets = self.load("offsets.npy")
+        self.doc_ids = self.load("doc_ids.npy")
+        self.term_freqs = self.load("term_freqs.npy")
+        self.doc_lengths = self.load("doc_lengths.npy")
+        self.tax_years = self.load("tax_years.npy")
+        self.doc_offsets = self.load("doc_offsets.npy")
+        self.eins = self.load("eins.npy")
+        self.ein_docs = self.load("ein_docs.npy")
+        self.average_length = float(self.doc_lengths.mean()) if len(self) else 1.0
+
+        with open(os.path.join(self.directory, "docs.jsonl"), "rb") as docs_file:
+            self.docs = (
+                mmap.mmap(docs_file.fileno(), 0, access=mmap.ACCESS_READ)
+                if os.fstat(docs_file.fileno()).st_size
+                else b""
+            )
+
+    def load(self, filename: str) -> np.ndarray:
+        return np.load(os.path.join(self.directory, filename), mmap_mode="r")
+
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+
+    def get_docs(self, doc_ids) -> list[dict]:
+        return [
+            json.loads(
+                self.docs[self.doc_offsets[doc_id] : self.doc_offsets[doc_id + 1]]
+            )
+            for doc_id in doc_ids
+        ]
+
+    def select_years(self, doc_ids: np.ndarray, years: set[str] | None) -> np.ndarray:
+        """
+        Return the `doc_ids` of the tax `years`, or all of them if none are of
+        those years (as with year shards).
+        """
+        if not years:
+            return np.ones(len(doc_ids), dtype=bool)
+        selected = np.isin(
+            self.tax_years[doc_ids], [int(year) for year in years if year.isdigit()]
+        )
+        return selected if selected.any() else np.ones(len(doc_ids), dtype=bool)
+
+    def lookup_eins(self, eins: list[int]) -> np.ndarray:
+        """Return the ids of the documents with any of `eins`."""
+        doc_ids = [
+            self.ein_docs[
+                np.searchsorted(self.eins, ein, "left") : np.searchsorted(
+                    self.eins, ein, "right"
+                )
+            ]
+            for ein in eins
+        ]
+        return np.concatenate(doc_ids) if doc_ids else np.zeros(0, dtype=np.int32)
+
+    def search(
+        self, text: str, count: int, years: set[str] | None = None
+    ) -> list[tuple[int, float]]:
+        """Return the ids and BM25 scores of the `count` best matches of `text`."""
+        term_ids = {
+            term_id
+            for term_id in map(self.vocabulary.get, tokenize(text))
+            if term_id is not None
+        }
+        if not term_ids:
+            return []
+
+        candidates = []
+        contributions = []
+        for term_id in term_ids:
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            doc_ids = self.doc_ids[start:end]
+            term_freqs = self.term_freqs[start:end]
+            idf = np.log(1 + (len(self) - (end - start) + 0.5) / (end - start + 0.5))
+            norms = BM25_K1 * (
+                1 - BM25_B + BM25_B * self.doc_lengths[doc_ids] / self.average_length
+            )
+            candidates.append(doc_ids)
+            contributions.append(
+                idf * term_freqs * (BM25_K1 + 1) / (term_freqs + norms)
+            )
+
+        doc_ids, positions = np.unique(np.concatenate(candidates), return_inverse=True)
+        scores = np.bincount(positions, weights=np.concatenate(contributions))
+        selected = self.select_years(doc_ids, years)
+        doc_ids, scores = doc_ids[selected], scores[selected]
+
+        best = np.argsort(-scores, kind="stable")[:count]
+        return [(int(doc_ids[index]), float(scores[index])) for index in best]
+
+    def confident_matches(
+        self, question: str, count: int, years: set[str] | None = None
+    ) -> list[dict] | None:
+        """
+        Return the documents that `question` asks about if it names them by
+        EIN or by their full name, or None if the question isn't a lookup.
+        """
+        eins = [int("".join(match)) for match in EIN_PATTERN.findall(question)]
+        doc_ids = self.lookup_eins(eins)
+        doc_ids = doc_ids[self.select_years(doc_ids, years)]
+        if len(doc_ids):
+            return self.get_docs(doc_ids[:count])
+
+        # The name must appear as a phrase in the question.  Of several names
+        # that do (e.g., "X Foundation" and "X Inc", since "inc" is a stop
+        # word), the longest wins.
+        question_terms = tokenize(question)
+        question_text = f" {' '.join(question_terms)} "
+        matches = self.search(question, LOOKUP_CANDIDATES, years)
+        docs = self.get_docs([doc_id for doc_id, _ in matches])
+        names = [" ".join(tokenize(doc.get("Name") or "")) for doc in docs]
+        named = {
+            name
+            for name in names
+            if len(name.split()) >= MIN_NAME_TERMS and f" {name} " in question_text
+        }
+        if not named:
+            return None
+        longest = max(len(name.split()) for name in named)
+        named = {name for name in named if len(name.split()) == longest}
+
+        # Years and amounts don't count as terms of the question.
+        content_terms = {term for term in question_terms if not term.isdigit()}
+        coverage = max(len(set(name.split())) for name in named) / max(
+            len(content_terms), 1
+        )
+        best = max(score for (_, score), name in zip(matches, names) if name in named)
+        runner_up = max(
+            (score for (_, score), name in zip(matches, names) if name not in named),
+            default=0.0,
+        )
+        if coverage < NAME_COVERAGE and best < NAME_SCORE_MARGIN * runner_up:
+            return None
+        return [doc for doc, name in zip(docs, names) if name in named][:count]
+
+
+def reciprocal_rank_fusion(rankings: list[list[dict]], count: int) -> list[dict]:
+    """
+    Merge rankings of documents by the sum of 1 / (RRF_K + rank) over the
+    rankings that contain each filing.
+    """
+    scores: dict[str, float] = {}
+    docs: dict[str, dict] = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking, 1):
+            key = dedup_key(doc, "filing")
+            scores[key] = scores.get(key, 0.0) + 1 / (RRF_K + rank)
+            docs.setdefault(key, doc)
+    best = sorted(scores, key=scores.__getitem__, reverse=True)[:count]
+    return [docs[key] for key in best]
+
+
+_indexes: dict[str, LexicalIndex] = {}
+
+
+def get_lexical_index(name: str) -> LexicalIndex | None:
+    """Return the index `name`, reopened if it was rebuilt, or None if there's none."""
+    try:
+        file_id = index_file_id(lexical_index_path(name))
+    except FileNotFoundError:
+        return None
+    if name not in _indexes or _indexes[name].file_id != file_id:
+        _indexes[name] = LexicalIndex(name)
+    return _indexes[name]
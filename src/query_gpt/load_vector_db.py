@@ -1,50 +1,209 @@
-import datetime as dt
 import gc
 from glob import glob
 import logging
 import os
 import random
+import re
 
 import click
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
-from query_gpt.config import DATA_DIR, IRS990_SCHEMA
-
-# from query_gpt.databases.weaviate import load_weaviate, remove_if_exists_weaviate
-from query_gpt.databases.qdrant import (
-    load_vectors,
-    remove_and_recreate_schema,
-    restore_indexing,
-    wait_until_ready,
-    rename,
+from query_gpt.config import DATA_DIR, IRS990_SCHEMA, VECTOR_STORE_BACKEND
+from query_gpt.databases import BACKENDS, get_vector_store, loading_suffix
+from query_gpt.dedup import (
+    DEDUP_KEYS,
+    DEDUP_POLICIES,
+    DEFAULT_DEDUP_KEY,
+    DEFAULT_DEDUP_POLICY,
+    Deduplicator,
+)
+from query_gpt.doc_store import DocStoreWriter, remove_old_stores
+from query_gpt.embeddings import VECTOR_SEARCH_FILE_GLOB
+from query_gpt.lexical_index import LexicalIndexWriter, remove_lexical_index
+from query_gpt.reduction import (
+    DEFAULT_REDUCTION_METHOD,
+    REDUCTION_FIT_SAMPLE_SIZE,
+    REDUCTION_METHODS,
+    VectorReduction,
+    latest_reduction,
+    reduction_path,
 )
 
 CHUNK_SIZE = 50
-FILENAME_TEMPLATE = "irs_form_990_embeddings*.parquet"
+FILENAME_TEMPLATE = VECTOR_SEARCH_FILE_GLOB
 
 FILE_LIMIT_QUICK = 10
 RECORD_LIMIT_QUICK = 500
 
+# Recall of two-stage search is measured with this many stored embeddings as
+# queries, against the RECALL_COUNT nearest neighbors of exact search.
+RECALL_QUERY_COUNT = 50
+RECALL_COUNT = 100
+
+# "year" builds one collection per tax year, "segment" one per IRS download
+# segment (year and segment of the parquet file), behind "<collection>-<shard>"
+# aliases.  See query_gpt.databases.qdrant.
+SHARD_BY = ("none", "year", "segment")
+SEGMENT_PATTERN = re.compile(r"irs_form_990_embeddings_(\d+)_([^_]+)_\d+\.parquet")
+
 logger = logging.getLogger("query_gpt")
 
 
+def read_search_data(filename: str, full: bool, columns: list[str] | None = None):
+    search_data = pd.read_parquet(filename, columns=columns)
+    if not full:
+        # The sample only depends on the number of rows, so it picks the
+        # same rows whichever columns were read.
+        record_limit = min(RECORD_LIMIT_QUICK, len(search_data))
+        search_data = search_data.sample(n=record_limit, random_state=42)
+    return search_data
+
+
+def shard_key(doc: dict, filename: str, shard_by: str) -> str:
+    if shard_by == "year":
+        return str(doc.get("Tax Year") or "unknown")
+    match = SEGMENT_PATTERN.fullmatch(os.path.basename(filename))
+    return "-".join(match.groups()) if match else "unknown"
+
+
+def load_or_fit_reduction(
+    collection: str,
+    filenames: list[str],
+    full_dimension: int,
+    dimension: int,
+    method: str,
+    refit: bool,
+) -> VectorReduction:
+    """
+    Load the latest stored vector reduction of `collection`, or fit a new one
+    from the embeddings in `filenames` if there is none with the same
+    parameters.  The caller stores it for each loading collection.
+    """
+    filename = None if refit else latest_reduction(collection)
+    if filename is not None:
+        reduction = VectorReduction.load(filename)
+        if (reduction.full_dimension, reduction.dimension, reduction.method) == (
+            full_dimension,
+            dimension,
+            method,
+        ):
+            logger.info(f"Using the vector reduction in {filename}")
+            return reduction
+
+    sample = []
+    sample_size = 0
+    for filename in filenames:
+        embeddings = pd.read_parquet(filename, columns=["embedding"])["embedding"]
+        sample.append(np.stack(embeddings))
+        sample_size += len(embeddings)
+        if sample_size >= REDUCTION_FIT_SAMPLE_SIZE:
+            break
+
+    return VectorReduction.fit(
+        np.concatenate(sample)[:REDUCTION_FIT_SAMPLE_SIZE], dimension, method
+    )
+
+
 @click.command
 @click.option(
     "--full", is_flag=True, help="Load the full dataset (default is partial dataset"
 )
 @click.option("--collection", "-c", default=IRS990_SCHEMA, help="Collection nane")
-def load_vector_db_command(full, collection):
+@click.option(
+    "--backend",
+    type=click.Choice(list(BACKENDS)),
+    default=VECTOR_STORE_BACKEND,
+    help="Vector database to load",
+)
+@click.option("--dedup/--no-dedup", default=True, help="Drop duplicate returns")
+@click.option(
+    "--dedup-key",
+    type=click.Choice(DEDUP_KEYS),
+    default=DEFAULT_DEDUP_KEY,
+    help="filing: EIN and Tax Period; content: hash of the rendered document",
+)
+@click.option(
+    "--dedup-policy",
+    type=click.Choice(DEDUP_POLICIES),
+    default=DEFAULT_DEDUP_POLICY,
+    help="Which of several duplicate returns to keep",
+)
+@click.option(
+    "--reduce-dimension",
+    default=0,
+    help="Also store vectors of this dimension (e.g., 128-256) for two-stage search",
+)
+@click.option(
+    "--reduction-method",
+    type=click.Choice(REDUCTION_METHODS),
+    default=DEFAULT_REDUCTION_METHOD,
+    help="How to reduce the dimension",
+)
+@click.option(
+    "--refit-reduction", is_flag=True, help="Refit the stored vector reduction"
+)
+@click.option(
+    "--shard-by",
+    type=click.Choice(SHARD_BY),
+    default="none",
+    help="Build one collection per tax year or per segment",
+)
+@click.option(
+    "--shard",
+    "only_shards",
+    multiple=True,
+    help="Only (re)load this shard, e.g., 2023 (repeatable)",
+)
+@click.option(
+    "--slim-payloads",
+    is_flag=True,
+    help="Keep documents in a local store and only filter fields in the database",
+)
+@click.option(
+    "--lexical-index/--no-lexical-index",
+    default=True,
+    help="Also build the local lexical (BM25 and EIN) index",
+)
+@click.option(
+    "--export-snapshot",
+    is_flag=True,
+    help="Export each loaded collection as an artifact for restore-vector-db",
+)
+@click.option(
+    "--snapshot-dir",
+    default=None,
+    help="Where to export artifacts (default is data/snapshots)",
+)
+def load_vector_db_command(
+    full,
+    collection,
+    backend,
+    dedup,
+    dedup_key,
+    dedup_policy,
+    reduce_dimension,
+    reduction_method,
+    refit_reduction,
+    shard_by,
+    only_shards,
+    slim_payloads,
+    lexical_index,
+    export_snapshot,
+    snapshot_dir,
+):
     random_state = random.Random(42)
+    if only_shards and shard_by == "none":
+        raise click.ClickException("--shard requires --shard-by")
+    if backend != "qdrant" and (reduce_dimension or export_snapshot):
+        raise click.ClickException(
+            "--reduce-dimension and --export-snapshot require the qdrant backend"
+        )
+    store = get_vector_store(backend)
 
-    logger.info(f"Loading data into {collection}")
-    loading_collection_suffix = (
-        str(dt.datetime.now()).replace(" ", "-").replace(":", "-")
-    )
-
-    loading_collection = f"{collection}-{loading_collection_suffix}"
-    logger.info(f"Creating temporary schema: {loading_collection}")
-    remove_and_recreate_schema(loading_collection)
+    logger.info(f"Loading data into {collection} ({backend})")
+    loading_collection_suffix = loading_suffix()
 
     filenames = glob(os.path.join(DATA_DIR, "embeddings", FILENAME_TEMPLATE))
 
@@ -53,27 +212,153 @@ def load_vector_db_command(full, collection):
         filenames = random_state.sample(filenames, file_limit)
 
     logger.info(f"Found {len(filenames):,d} files to load")
+    if not filenames:
+        raise click.ClickException("No embedding files found")
+
+    # The vector size depends on which embedding provider computed the embeddings.
+    dimension = len(
+        pd.read_parquet(filenames[0], columns=["embedding"])["embedding"][0]
+    )
+
+    reduction = None
+    if reduce_dimension:
+        if not 0 < reduce_dimension < dimension:
+            raise click.ClickException(
+                f"--reduce-dimension must be less than the embedding size {dimension}"
+            )
+        reduction = load_or_fit_reduction(
+            collection,
+            filenames,
+            dimension,
+            reduce_dimension,
+            reduction_method,
+            refit_reduction,
+        )
+
+    # Loading collection of each alias (just `collection` unless sharded),
+    # created when the first document for it is found.
+    loading_collections: dict[str, str] = {}
+    # With slim payloads, the document store of each loading collection.
+    doc_stores: dict[str, DocStoreWriter] = {}
+
+    def get_loading_collection(alias: str) -> str:
+        if alias not in loading_collections:
+            loading_collection = f"{alias}-{loading_collection_suffix}"
+            logger.info(
+                f"Creating temporary schema: {loading_collection} ({dimension=})"
+            )
+            store.create(loading_collection, dimension, reduce_dimension)
+            if reduction is not None:
+                # Switched with the alias; see query_gpt.reduction.
+                reduction.save(reduction_path(loading_collection))
+            loading_collections[alias] = loading_collection
+            if slim_payloads:
+                doc_stores[alias] = DocStoreWriter(loading_collection)
+        return loading_collections[alias]
+
+    # Embedding files computed by separate ingest runs (or before a better
+    # filing was seen) can still contain duplicates.  The first pass finds the
+    # document to keep for each filing; the second pass loads only those.
+    deduplicator = Deduplicator(dedup_key, dedup_policy) if dedup else None
+    if deduplicator is not None:
+        logger.info("Finding duplicate returns")
+        for filename in tqdm(filenames):
+            docs = read_search_data(filename, full, columns=["doc"])["doc"]
+            for index, doc in docs.items():
+                deduplicator.offer(doc, (filename, index))
+        logger.info(deduplicator.report())
+
+    # The index covers all shards, so it's only rebuilt when all are loaded.
+    if lexical_index and only_shards:
+        logger.info("Not rebuilding the lexical index for a partial reload")
+    lexical_index_writer = (
+        LexicalIndexWriter(collection) if lexical_index and not only_shards else None
+    )
+
+    try:
+        for filename in tqdm(filenames):
+            search_data = read_search_data(filename, full)
+            if deduplicator is not None:
+                search_data = search_data[
+                    [
+                        deduplicator.is_winner(doc, (filename, index))
+                        for index, doc in search_data["doc"].items()
+                    ]
+                ]
+
+            if shard_by == "none":
+                shards = pd.Series(collection, index=search_data.index)
+            else:
+                shards = search_data["doc"].map(
+                    lambda doc: shard_key(doc, filename, shard_by)
+                )
+                if only_shards:
+                    search_data = search_data[shards.isin(only_shards)]
+                    shards = shards[search_data.index]
+                shards = f"{collection}-" + shards
+
+            if lexical_index_writer is not None:
+                lexical_index_writer.add(list(search_data["doc"]))
+
+            for alias, shard_data in search_data.groupby(shards, sort=False):
+                docs = list(shard_data["doc"])
+                data = list(shard_data["embedding"])
+
+                store.load(
+                    get_loading_collection(alias),
+                    docs,
+                    data,
+                    reduction=reduction,
+                    doc_store=doc_stores.get(alias),
+                )
+
+            # Try to free up some memory
+            del search_data, shards
+            gc.collect()
+
+        if not loading_collections:
+            raise click.ClickException("No documents to load")
 
-    for filename in tqdm(filenames):
-        search_data = pd.read_parquet(filename)
-        if not full:
-            record_limit = min(RECORD_LIMIT_QUICK, len(search_data))
-            search_data = search_data.sample(n=record_limit, random_state=42)
+        logger.info("Recreating indexes as necessary")
+        for loading_collection in loading_collections.values():
+            store.finalize(loading_collection)
 
-        docs = list(search_data["doc"])
-        data = list(search_data["embedding"])
+        for alias, loading_collection in loading_collections.items():
+            store.wait_until_ready(loading_collection)
 
-        load_vectors(loading_collection, docs, data)
+            if reduction is not None:
+                embeddings = read_search_data(
+                    filenames[0], False, columns=["embedding"]
+                )
+                queries = list(embeddings["embedding"][:RECALL_QUERY_COUNT])
+                recall = store.measure_recall(loading_collection, queries, RECALL_COUNT)
+                logger.info(
+                    f"Recall@{RECALL_COUNT} of two-stage search in {alias}: {recall:.3f}"
+                )
 
-        # Try to free up some memory
-        del docs, data, search_data
-        gc.collect()
+        # The documents must be in the stores before the aliases are switched.
+        for doc_store in doc_stores.values():
+            doc_store.commit()
+        if lexical_index_writer is not None:
+            lexical_index_writer.commit()
+        elif not lexical_index and not only_shards:
+            # An index of an earlier load would no longer match the collection.
+            remove_lexical_index(collection)
 
-    logger.info("Recreating indexes as necessary")
-    restore_indexing(loading_collection)
+        for alias, loading_collection in loading_collections.items():
+            store.swap_alias(loading_collection, alias)
+            remove_old_stores(alias, keep=loading_collection)
+        store.remove_stale_aliases(collection, sharded=shard_by != "none")
+    finally:
+        # Unless the stores were committed, remove their temporary files.
+        for doc_store in doc_stores.values():
+            doc_store.discard()
 
-    wait_until_ready(loading_collection)
-    rename(loading_collection, collection)
+    if export_snapshot:
+        for alias, loading_collection in loading_collections.items():
+            store.export_snapshot(
+                alias, loading_collection, snapshot_dir, source=collection
+            )
 
     logger.info("done")
 
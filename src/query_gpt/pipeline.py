@@ -0,0 +1,638 @@
+"""
+Streaming ingest: download, parse, render, embed, and write parquet.
+
+Each stage runs in its own thread(s) and stages are connected by bounded
+queues, each holding at most `queue_size` documents (fewer items if they are
+batches).  A stage that falls behind fills its input queue, which blocks the
+stages upstream of it (backpressure), so memory use depends on the queue
+sizes and not on the size of a segment.  Per-stage statistics show where the
+time goes.
+"""
+from glob import glob
+import logging
+import os
+import pickle
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Iterable
+
+import click
+import pandas as pd
+import requests
+
+from query_gpt.config import DATA_DIR
+from query_gpt.dedup import (
+    DEDUP_KEYS,
+    DEDUP_POLICIES,
+    DEFAULT_DEDUP_KEY,
+    DEFAULT_DEDUP_POLICY,
+    Deduplicator,
+    filing_key,
+)
+from query_gpt.embedding_providers import (
+    LOCAL_FIT_SAMPLE_SIZE,
+    get_embedding_provider,
+)
+from query_gpt.embeddings import (
+    CHUNK_SIZE,
+    VECTOR_SEARCH_FILE_GLOB,
+    VECTOR_SEARCH_FILE_TEMPLATE,
+)
+from query_gpt import irs_data
+from query_gpt.prompt import doc_to_string
+from query_gpt.retry import backoff_and_retry
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_SIZE = 1_000
+DEFAULT_PARSE_WORKERS = 2
+DEFAULT_EMBED_WORKERS = 4
+REPORT_INTERVAL_SECONDS = 60
+DOWNLOAD_BLOCK_SIZE = 1 << 20
+
+# How long a blocked worker waits before checking whether the pipeline failed.
+POLL_SECONDS = 0.1
+
+_DONE = object()
+
+
+class Stage:
+    """
+    One step of a pipeline.
+
+    Arguments:
+        name: str - Name used in the statistics
+        process: Callable - Called with each input item; returns an iterable
+            of zero or more output items
+        workers: int - Number of threads calling `process`
+        finish: Callable - Called once after the last input item; returns an
+            iterable of any remaining output items (e.g., a partial batch)
+        close: Callable - Called once after the whole pipeline has stopped,
+            whether or not it succeeded (e.g., to remove temporary files)
+        size: Callable - Number of documents represented by an output item
+            (for stages that emit batches)
+        batch_size: int - Most documents in an output item, used to bound the
+            output queue in documents rather than items
+    """
+
+    def __init__(
+        self,
+        name: str,
+        process: Callable[[object], Iterable],
+        workers: int = 1,
+        finish: Callable[[], Iterable] | None = None,
+        close: Callable[[], None] | None = None,
+        size: Callable[[Any], int] = lambda item: 1,
+        batch_size: int = 1,
+    ):
+        self.name = name
+        self.process = process
+        self.workers = workers
+        self.finish = finish
+        self.close = close
+        self.size = size
+        self.batch_size = batch_size
+
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.start_time: float | None = None
+        self.end_time: float | None = None
+        self.active_workers = 0
+        self.lock = threading.Lock()
+
+    def stats(self) -> dict[str, float]:
+        end = self.end_time if self.end_time is not None else time.monotonic()
+        elapsed = end - self.start_time if self.start_time is not None else 0.0
+        return {
+            "items": self.items,
+            "seconds": elapsed,
+            "items_per_second": self.items / elapsed if elapsed > 0 else 0.0,
+            # Fraction of the stage's worker time spent doing work rather than
+            # waiting on its queues.  The bottleneck is the busiest stage.
+            "utilization": self.busy_seconds / (elapsed * self.workers)
+            if elapsed > 0
+            else 0.0,
+        }
+
+
+class Pipeline:
+    def __init__(self, stages: list[Stage], queue_size: int = DEFAULT_QUEUE_SIZE):
+        """
+        Connect `stages` by queues that hold at most `queue_size` documents:
+        a queue of batches holds `queue_size // batch_size` of them (but at
+        least one).
+        """
+        self.stages = stages
+        self.queues: list[queue.Queue] = [queue.Queue(maxsize=queue_size)] + [
+            queue.Queue(maxsize=max(1, queue_size // stage.batch_size))
+            for stage in stages
+        ]
+        self.failed = threading.Event()
+        self.error: BaseException | None = None
+
+    def _put(self, q: queue.Queue, item):
+        while not self.failed.is_set():
+            try:
+                q.put(item, timeout=POLL_SECONDS)
+                return
+            except queue.Full:
+                pass
+        raise _Stopped()
+
+    def _get(self, q: queue.Queue):
+        while not self.failed.is_set():
+            try:
+                return q.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                pass
+        raise _Stopped()
+
+    def _emit(self, stage: Stage, outputs: Iterable, output_queue: queue.Queue):
+        # Time spent blocked on a full output queue doesn't count as busy.
+        iterator = iter(outputs)
+        while True:
+            start = time.monotonic()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                with stage.lock:
+                    stage.busy_seconds += time.monotonic() - start
+                return
+            with stage.lock:
+                stage.busy_seconds += time.monotonic() - start
+                stage.items += stage.size(item)
+            self._put(output_queue, item)
+
+    def _worker(
+        self, stage: Stage, input_queue: queue.Queue, output_queue: queue.Queue
+    ):
+        try:
+            while True:
+                item = self._get(input_queue)
+                if item is _DONE:
+                    # Let the other workers of this stage see the end marker too.
+                    self._put(input_queue, _DONE)
+                    break
+                self._emit(stage, stage.process(item), output_queue)
+
+            with stage.lock:
+                stage.active_workers -= 1
+                last_worker = stage.active_workers == 0
+            if last_worker:
+                if stage.finish is not None:
+                    self._emit(stage, stage.finish(), output_queue)
+                stage.end_time = time.monotonic()
+                self._put(output_queue, _DONE)
+        except _Stopped:
+            pass
+        except BaseException as e:
+            logger.exception(f"Stage {stage.name} failed")
+            self.error = e
+            self.failed.set()
+
+    def _sink(self, output_queue: queue.Queue):
+        try:
+            while self._get(output_queue) is not _DONE:
+                pass
+        except _Stopped:
+            pass
+
+    def log_stats(self):
+        for stage in self.stages:
+            stats = stage.stats()
+            logger.info(
+                f"{stage.name:>10}: {stats['items']:>9,d} items "
+                f"{stats['items_per_second']:>9,.1f}/s "
+                f"utilization {stats['utilization']:>4.0%}"
+            )
+
+    def run(self, source: Iterable, report_interval: float = REPORT_INTERVAL_SECONDS):
+        """
+        Feed the items from `source` through all stages and wait until the
+        pipeline has drained.  Raises the first exception raised by any stage.
+        """
+        threads = []
+        for index, stage in enumerate(self.stages):
+            stage.start_time = time.monotonic()
+            stage.active_workers = stage.workers
+            for _ in range(stage.workers):
+                threads.append(
+                    threading.Thread(
+                        target=self._worker,
+                        args=(stage, self.queues[index], self.queues[index + 1]),
+                        name=f"{stage.name}-worker",
+                        daemon=True,
+                    )
+                )
+        threads.append(
+            threading.Thread(target=self._sink, args=(self.queues[-1],), daemon=True)
+        )
+        for thread in threads:
+            thread.start()
+
+        try:
+            for item in source:
+                self._put(self.queues[0], item)
+            self._put(self.queues[0], _DONE)
+        except _Stopped:
+            pass
+
+        try:
+            last_report = time.monotonic()
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(timeout=1)
+                    if time.monotonic() - last_report > report_interval:
+                        self.log_stats()
+                        last_report = time.monotonic()
+        finally:
+            self.failed.set()  # Stop any workers that are still running
+            for stage in self.stages:
+                if stage.close is not None:
+                    stage.close()
+
+        self.log_stats()
+        if self.error is not None:
+            raise self.error
+
+
+class _Stopped(Exception):
+    """Raised in a worker when another stage has failed."""
+
+
+class DownloadSegments:
+    """
+    Download each (year, segment) zip file from the IRS and extract it to a
+    temporary directory.  Emits (year, segment, filename) for each return.
+    The parse stage removes each file once it has been parsed.
+    """
+
+    def __init__(self):
+        self.directories: list[str] = []
+
+    def __call__(self, item):
+        year, segment = item
+        url = irs_data.IRS_FILE_TEMPLATE.format(year=year, segment=segment)
+        logger.info(f"Downloading segment: {segment} ({year})")
+
+        extract_dir = tempfile.mkdtemp(prefix=f"irs990-{year}-{segment}-")
+        self.directories.append(extract_dir)
+
+        with tempfile.NamedTemporaryFile("wb", suffix=".zip") as zip_file:
+
+            def try_once():
+                zip_file.seek(0)
+                zip_file.truncate()
+                with requests.get(url, stream=True) as response:
+                    response.raise_for_status()
+                    for block in response.iter_content(DOWNLOAD_BLOCK_SIZE):
+                        zip_file.write(block)
+                zip_file.flush()
+
+            backoff_and_retry(try_once)
+
+            # Python zipfile cannot handle several IRS files so use command line :(
+            subprocess.run(
+                ["unzip", "-q", "-d", extract_dir, zip_file.name], check=True
+            )
+
+        for filename in glob(os.path.join(extract_dir, "*.xml")):
+            yield year, segment, filename
+
+    def close(self):
+        for directory in self.directories:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def parse_return(item):
+    year, segment, filename = item
+    doc = irs_data.parse(filename)
+    os.remove(filename)
+    if doc is not None:
+        yield year, segment, doc
+
+
+class PreScan:
+    """
+    Pick the filing to keep for each EIN and Tax Period from the return
+    headers, before the returns are parsed and embedded.  The returns of a
+    segment (only their filenames) are held until the next segment starts,
+    so an original that arrives before its amendment is dropped too.  The
+    returns that lose are removed; the ones whose header has no EIN or tax
+    period are passed on to `Deduplicate`.
+    """
+
+    def __init__(self, deduplicator: Deduplicator):
+        self.deduplicator = deduplicator
+        self.segment: tuple | None = None
+        # Each held return, its header (None if it can't be matched), and
+        # whether it was the best so far when it was offered.
+        self.held: list[tuple[tuple, dict | None, bool]] = []
+
+    def __call__(self, item):
+        year, segment, filename = item
+        if (year, segment) != self.segment:
+            yield from self.finish()
+            self.segment = (year, segment)
+
+        header = irs_data.parse_header(filename)
+        if header is not None and filing_key(header) is None:
+            header = None
+        won = header is not None and self.deduplicator.offer(header, filename)
+        self.held.append((item, header, won))
+
+    def finish(self):
+        held, self.held = self.held, []
+        for item, header, won in held:
+            filename = item[2]
+            if header is None or self.deduplicator.is_winner(header, filename):
+                yield item
+                continue
+            if won:
+                self.deduplicator.retract()
+            os.remove(filename)
+
+
+class Deduplicate:
+    """
+    Drop documents that don't beat an earlier document with the same key,
+    before we pay to embed them.  With `prescanned`, the filings were already
+    picked by PreScan, so only documents without a filing key are offered.
+    """
+
+    def __init__(self, deduplicator: Deduplicator, prescanned: bool = False):
+        self.deduplicator = deduplicator
+        self.prescanned = prescanned
+
+    def __call__(self, item):
+        year, segment, doc = item
+        if self.prescanned and filing_key(doc) is not None:
+            yield item
+        elif self.deduplicator.offer(doc):
+            yield item
+
+    def seed(self, filenames: list[str]):
+        """Offer the documents in existing parquet files (from earlier runs)."""
+        for filename in filenames:
+            for doc in pd.read_parquet(filename, columns=["doc"])["doc"]:
+                self.deduplicator.offer(doc)
+
+
+def render(item):
+    year, segment, doc = item
+    yield year, segment, doc, doc_to_string(doc)
+
+
+class Batch:
+    """
+    Group rendered documents into batches of the embedding provider's batch
+    size.  If the provider still needs to be fitted, the first
+    LOCAL_FIT_SAMPLE_SIZE documents are held back in a temporary file, used
+    to fit it, and then batched.
+    """
+
+    def __init__(self):
+        self.provider = get_embedding_provider()
+        self.pending: list = []
+        self.held_back = None
+        self.held_back_count = 0
+
+    def __call__(self, item):
+        if not self.provider.is_fitted:
+            self.hold_back(item)
+            if self.held_back_count >= LOCAL_FIT_SAMPLE_SIZE:
+                yield from self.fit()
+            return
+
+        self.pending.append(item)
+        yield from self.full_batches()
+
+    def full_batches(self):
+        while len(self.pending) >= self.provider.batch_size:
+            yield self.pending[: self.provider.batch_size]
+            del self.pending[: self.provider.batch_size]
+
+    def hold_back(self, item):
+        if self.held_back is None:
+            self.held_back = tempfile.TemporaryFile()
+        pickle.dump(item, self.held_back)
+        self.held_back_count += 1
+
+    def read_held_back(self):
+        self.held_back.seek(0)  # type:ignore
+        for _ in range(self.held_back_count):
+            yield pickle.load(self.held_back)  # type:ignore
+
+    def fit(self):
+        """Fit the provider on the held back documents, then batch them."""
+        self.provider.fit([text for _, _, _, text in self.read_held_back()])
+        self.provider.save()
+        for item in self.read_held_back():
+            self.pending.append(item)
+            yield from self.full_batches()
+        self.close()
+
+    def finish(self):
+        if self.held_back_count and not self.provider.is_fitted:
+            yield from self.fit()
+        for index in range(0, len(self.pending), self.provider.batch_size):
+            yield self.pending[index : index + self.provider.batch_size]
+        self.pending = []
+
+    def close(self):
+        if self.held_back is not None:
+            self.held_back.close()
+            self.held_back = None
+            self.held_back_count = 0
+
+
+def embed(batch):
+    embeddings = get_embedding_provider().embed([text for _, _, _, text in batch])
+    yield [
+        (year, segment, doc, embedding)
+        for (year, segment, doc, _), embedding in zip(batch, embeddings)
+    ]
+
+
+class WriteParquet:
+    """
+    Collect embedded documents per (year, segment) and write them to parquet
+    files of CHUNK_SIZE rows named by VECTOR_SEARCH_FILE_TEMPLATE.  Emits
+    (filename, row count) for each file written.
+    """
+
+    def __init__(self, data_dir: str, chunk_size: int = CHUNK_SIZE):
+        self.data_dir = data_dir
+        self.chunk_size = chunk_size
+        self.pending: dict[tuple, dict[str, list]] = {}
+        self.chunk_ids: dict[tuple, int] = {}
+        os.makedirs(data_dir, exist_ok=True)
+
+    def __call__(self, batch):
+        for year, segment, doc, embedding in batch:
+            search_data = self.pending.setdefault(
+                (year, segment), {"doc": [], "embedding": []}
+            )
+            search_data["doc"].append(doc)
+            search_data["embedding"].append(embedding)
+            if len(search_data["doc"]) >= self.chunk_size:
+                yield self.write(year, segment)
+
+    def write(self, year, segment) -> tuple[str, int]:
+        search_data = self.pending.pop((year, segment))
+        chunk_id = self.chunk_ids.get((year, segment), 0)
+        self.chunk_ids[(year, segment)] = chunk_id + 1
+
+        vector_search_filename = os.path.join(
+            self.data_dir,
+            VECTOR_SEARCH_FILE_TEMPLATE.format(
+                year=year, segment=segment, chunk_id=chunk_id
+            ),
+        )
+        pd.DataFrame(data=search_data).to_parquet(vector_search_filename)
+        logger.info(f"Wrote {vector_search_filename}")
+        return vector_search_filename, len(search_data["doc"])
+
+    def finish(self):
+        for year, segment in list(self.pending):
+            yield self.write(year, segment)
+
+
+def make_ingest_stages(
+    data_dir: str,
+    download: bool = True,
+    parse_workers: int = DEFAULT_PARSE_WORKERS,
+    embed_workers: int = DEFAULT_EMBED_WORKERS,
+    deduplicator: Deduplicator | None = None,
+) -> list[Stage]:
+    """
+    Build the ingest stages.  With `download=True` the pipeline's source
+    items are (year, segment) pairs; otherwise they are
+    (year, segment, filename) tuples of already extracted returns (which are
+    removed once parsed).  If a `deduplicator` is passed, duplicate returns
+    are dropped before they are embedded (for the "filing" key, before they
+    are even parsed).
+    """
+    stages = []
+    if download:
+        download_segments = DownloadSegments()
+        stages.append(
+            Stage("download", download_segments, close=download_segments.close)
+        )
+
+    batch = Batch()
+    write_parquet = WriteParquet(data_dir)
+    # Filings can be told apart from their headers, before they're parsed.
+    prescan = False
+    if deduplicator is not None and deduplicator.key == "filing":
+        pre_scan = PreScan(deduplicator)
+        stages.append(Stage("prescan", pre_scan, finish=pre_scan.finish))
+        prescan = True
+    stages.append(Stage("parse", parse_return, workers=parse_workers))
+    if deduplicator is not None:
+        stages.append(Stage("dedup", Deduplicate(deduplicator, prescanned=prescan)))
+    stages.extend(
+        [
+            Stage("render", render),
+            Stage(
+                "batch",
+                batch,
+                finish=batch.finish,
+                close=batch.close,
+                size=len,
+                batch_size=batch.provider.batch_size,
+            ),
+            Stage(
+                "embed",
+                embed,
+                workers=embed_workers,
+                size=len,
+                batch_size=batch.provider.batch_size,
+            ),
+            Stage(
+                "write",
+                write_parquet,
+                finish=write_parquet.finish,
+                size=lambda item: item[1],
+            ),
+        ]
+    )
+    return stages
+
+
+@click.command
+@click.option(
+    "--year", "-y", "years", multiple=True, type=int, help="Year(s) to ingest"
+)
+@click.option("--segment", "-s", "segments", multiple=True, help="Segment(s) to ingest")
+@click.option("--parse-workers", default=DEFAULT_PARSE_WORKERS)
+@click.option("--embed-workers", default=DEFAULT_EMBED_WORKERS)
+@click.option(
+    "--queue-size", default=DEFAULT_QUEUE_SIZE, help="Documents each queue may hold"
+)
+@click.option("--dedup/--no-dedup", default=True, help="Drop duplicate returns")
+@click.option(
+    "--dedup-key",
+    type=click.Choice(DEDUP_KEYS),
+    default=DEFAULT_DEDUP_KEY,
+    help="filing: EIN and Tax Period; content: hash of the rendered document",
+)
+@click.option(
+    "--dedup-policy",
+    type=click.Choice(DEDUP_POLICIES),
+    default=DEFAULT_DEDUP_POLICY,
+    help="Which of several duplicate returns to keep",
+)
+@click.option(
+    "--dedup-existing",
+    is_flag=True,
+    help="Also treat documents in existing embedding files as duplicates",
+)
+def ingest_command(
+    years,
+    segments,
+    parse_workers,
+    embed_workers,
+    queue_size,
+    dedup,
+    dedup_key,
+    dedup_policy,
+    dedup_existing,
+):
+    """Download IRS 990 returns and compute their embeddings."""
+    source = [
+        (year, segment)
+        for year in years or irs_data.YEAR_LIST
+        for segment in irs_data.IRS_FILE_SEGMENTS[year]
+        if not segments or segment in segments
+    ]
+    logger.info(f"Ingesting {len(source)} segments")
+
+    data_dir = os.path.join(DATA_DIR, "embeddings")
+    deduplicator = Deduplicator(dedup_key, dedup_policy) if dedup else None
+    if deduplicator is not None and dedup_existing:
+        existing = glob(os.path.join(data_dir, VECTOR_SEARCH_FILE_GLOB))
+        logger.info(f"Reading {len(existing):,d} existing embedding files")
+        Deduplicate(deduplicator).seed(existing)
+
+    stages = make_ingest_stages(
+        data_dir,
+        parse_workers=parse_workers,
+        embed_workers=embed_workers,
+        deduplicator=deduplicator,
+    )
+    Pipeline(stages, queue_size).run(source)
+
+    if deduplicator is not None:
+        logger.info(deduplicator.report())
+    logger.info(f"{irs_data.counters}")
+    logger.info("done")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    ingest_command()
@@ -0,0 +1,249 @@
+"""
+Prompt construction for the query path.
+
+This module is imported by the query REPL, so it must not import the XML
+parsing or embedding (ingest) code.
+"""
+from functools import lru_cache
+from itertools import accumulate
+import logging
+import re
+
+from query_gpt.config import MODEL, INPUT_TOKEN_GOAL
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def get_encoder():
+    """
+    Encoder to use to pre-check the token count when building the prompt.
+    Building it takes a while, so it's built on first use.
+    """
+    import tiktoken
+
+    return tiktoken.encoding_for_model(MODEL)
+
+
+ORDERED_FIELDS = [
+    "Return Type",
+    "EIN",
+    "Tax Year",
+    "Tax Period",
+    "Name",
+    "Address",
+    "Purpose",
+    "Activities",
+    "Website",
+    "Accomplishments",
+    "Revenue Categories",
+    "Expense Categories",
+    "Total Revenue",
+    "Total Expenses",
+    "Employee Count",
+    "Volunteer Count",
+]
+
+
+# The prompt only includes the fields that a question is about, so that more
+# records fit in INPUT_TOKEN_GOAL.  These fields identify the organization,
+# where it is and what it does, and are always included.
+ALWAYS_INCLUDED_FIELDS = ("EIN", "Tax Year", "Name", "Address", "Purpose")
+# Fields included for questions that don't mention any of FIELD_KEYWORDS.
+DEFAULT_FIELDS = ("Activities", "Total Revenue")
+# Questions containing any of the keywords of a field include it.  Keywords
+# match whole words, or word prefixes if they end in "*".
+FIELD_KEYWORDS = {
+    "Return Type": ("990*", "return type", "foundation*", "filer*", "filing*"),
+    "Tax Period": ("tax period*", "fiscal", "month*"),
+    "Activities": (
+        "activit*",
+        "program*",
+        "does",
+        "doing",
+        "work*",
+        "serve",
+        "serves",
+        "serving",
+        "service*",
+        "provid*",
+    ),
+    "Website": ("website*", "web site*", "url*", "online", "internet", "contact*"),
+    "Accomplishments": (
+        "accomplish*",
+        "achiev*",
+        "impact*",
+        "result*",
+        "outcome*",
+        "success*",
+        "program*",
+        "served",
+    ),
+    "Revenue Categories": (
+        "revenue*",
+        "income",
+        "earn*",
+        "fees",
+        "sales",
+        "funding",
+        "funded",
+    ),
+    "Expense Categories": (
+        "expens*",
+        "spend*",
+        "spent",
+        "cost*",
+        "pay",
+        "pays",
+        "paid",
+        "payroll",
+        "salar*",
+        "wages",
+    ),
+    "Total Revenue": (
+        "revenue*",
+        "income",
+        "budget*",
+        "money",
+        "raise*",
+        "raising",
+        "funding",
+        "largest",
+        "biggest",
+        "smallest",
+        "size",
+        "dollar*",
+        "million*",
+    ),
+    "Total Expenses": ("expens*", "spend*", "spent", "cost*", "budget*"),
+    "Employee Count": ("employ*", "staff*", "workers", "largest", "size"),
+    "Volunteer Count": ("volunteer*",),
+}
+
+
+def keyword_pattern(keyword: str) -> str:
+    if keyword.endswith("*"):
+        return rf"(?<!\w){re.escape(keyword[:-1])}"
+    return rf"(?<!\w){re.escape(keyword)}(?!\w)"
+
+
+FIELD_PATTERNS = {
+    field: re.compile("|".join(map(keyword_pattern, keywords)))
+    for field, keywords in FIELD_KEYWORDS.items()
+}
+# Longer fields are truncated to this many tokens in the prompt.
+FIELD_TOKEN_CAP = 150
+
+
+def select_fields(question: str) -> list[str]:
+    """
+    Return the fields (in ORDERED_FIELDS order) to include in the prompt for
+    `question`, by matching it against FIELD_KEYWORDS.
+    """
+    text = question.lower()
+    matched = {
+        field for field, pattern in FIELD_PATTERNS.items() if pattern.search(text)
+    }
+    selected = set(ALWAYS_INCLUDED_FIELDS) | (matched or set(DEFAULT_FIELDS))
+    return [field for field in ORDERED_FIELDS if field in selected]
+
+
+def truncate(value, token_cap: int) -> str:
+    text = str(value)
+    # Every token decodes to at least one byte, so text of at most `token_cap`
+    # UTF-8 bytes can't be over the cap.
+    if len(text.encode()) <= token_cap:
+        return text
+    encoder = get_encoder()
+    tokens = encoder.encode(text)
+    if len(tokens) <= token_cap:
+        return text
+    return f"{encoder.decode(tokens[:token_cap])}..."
+
+
+# Even though the dictionary is ordered, we persist these documents as JSON in the vector
+# database which destroys order.  If we care about the order, we need to specify it explicitly.
+def doc_to_string(
+    doc, fields: list[str] = ORDERED_FIELDS, token_cap: int | None = None
+):
+    """
+    Render `fields` of `doc`, one per line.  With `token_cap`, longer values
+    are truncated to that many tokens.
+    """
+    if token_cap is None:
+        return "".join(
+            [f"{key}: {doc[key]}\n" for key in fields if doc.get(key) is not None]
+        )
+    return "".join(
+        [
+            f"{key}: {truncate(doc[key], token_cap)}\n"
+            for key in fields
+            if doc.get(key) is not None
+        ]
+    )
+
+
+def make_prompt(question: str, items: list[dict[str, str]], failures: int) -> str:
+    """
+    Given a question about the survey data, design a prompt for
+    openai that should produce an answer to the question.
+    The context is the additional information to provide.
+    Arguments:
+        question: str - Question about the survey data
+        items: list[dict[str,str]] - Documents to be queried
+        failures: int - Number of API calls that have failed because of reponse length.
+    """
+
+    prefix = (
+        "The following records contain information taken from tax records "
+        "for non-profit organizations operating in the US. "
+        "The data for a single organization is delimited by <record> and </record>. "
+        "At the end of these records, there is a question for you to answer about "
+        "these non-profit organizations."
+        "Try to keep the total response below 500 words.\n"
+    )
+
+    instruction = (
+        "Please answer the question below about non-profit organizations.  "
+        "Some of the records above may not be relevant to the question.  Pleas ignore "
+        "any irrelevant records.  The most relevant ones may be near the top of the list. "
+        "Remember to keep "
+        "the response below 500 words. If you are asked to provide a list, you may "
+        "need to omit some items from the list.  "
+        "If so, state the the list is represntative and not complete. "
+        "Capitalize any responses appropriately, even if the source data was presented in ALL CAPS. "
+        f"{'Be *EXTREMELY* BRIEF in your answer. ' if failures > 0 else ''}"
+        "Answer the question precisely and exclude any records that are not relevant to the question. "
+        "The answer should be responsive. "
+        " It's better to provide no response than to provide a response with irrelevant information. "
+        "Base your answer primarily on the records above, but you may fill in "
+        "holes based on any prior knowledge you have of these organizations.\n"
+        f"Question: {question}\n"
+        "Answer: "
+    )
+    fields = select_fields(question)
+    logger.info(f"Fields included in the prompt: {', '.join(fields)}")
+    formatted_items = [
+        f"<record>\n{doc_to_string(item, fields, FIELD_TOKEN_CAP)}</record>\n"
+        for item in items
+    ]
+
+    # When counting fixed strings, two for the separators we'll add later.
+    encoder = get_encoder()
+    fixed_count = len(encoder.encode(prefix)) + len(encoder.encode(instruction)) + 2
+
+    # When counting item tokens, add one for the separator we'll add later.
+    variable_counts = [len(encoder.encode(item)) + 1 for item in formatted_items]
+    allowed_item_count = sum(
+        total < (INPUT_TOKEN_GOAL / (2**failures) - fixed_count)
+        for total in accumulate(variable_counts)
+    )
+
+    context = "\n".join(formatted_items[:allowed_item_count])
+    prompt = f"{prefix}\n{context}\n{instruction}"
+    token_count = len(encoder.encode(prompt))
+    logger.info(
+        f"tiktoken token estimate: {token_count} "
+        f"({allowed_item_count} of {len(items)} records)"
+    )
+    return prompt
@@ -1,15 +1,22 @@
 import json
 import logging
+import re
 import readline
 
 logger = logging.getLogger(__name__)
 
 RELEVANT_DOCUMENT_COUNT = 100
+YEAR_PATTERN = re.compile(r"\b(?:19|20)\d{2}\b")
 
-from query_gpt.config import IRS990_SCHEMA
+from query_gpt.config import IRS990_SCHEMA, RETRIEVAL_MODE
 from query_gpt.completion import answer_question
-from query_gpt.databases.qdrant import get_relevant_responses
-from query_gpt.embeddings import embed_one
+from query_gpt.databases import get_vector_store
+from query_gpt.embedding_providers import embed_one
+
+
+def question_years(question: str) -> set[str]:
+    """Return the years mentioned in `question` (used to pick year shards)."""
+    return set(YEAR_PATTERN.findall(question))
 
 
 class QueryGPT:
@@ -24,17 +31,51 @@ class QueryGPT:
                   'embeddings': list[list[float]] - embeddings
                   'docs': list[str] - List of documents whose embeddings are in the tree.
         """
+        # The backend is chosen by VECTOR_STORE_BACKEND.
+        self.store = get_vector_store()
+
+    def get_relevant_documents(self, question: str) -> list[dict]:
+        # The index is optional, and is reopened when a load rebuilds it.  (It
+        # imports numpy, so it's only imported here.)
+        from query_gpt.lexical_index import get_lexical_index
+
+        lexical_index = get_lexical_index(IRS990_SCHEMA)
+        years = question_years(question)
+
+        if lexical_index is not None:
+            matches = lexical_index.confident_matches(
+                question, RELEVANT_DOCUMENT_COUNT, years
+            )
+            if matches is not None:
+                logger.info(f"Found {len(matches)} lexical matches; skipping embedding")
+                return matches
 
-    def get_answer(self, question):
-        logger.info(f"Processing new question: {question}")
         logger.info("Getting embedding")
         embedding = embed_one(question)
 
         logger.info("Getting relevant responses")
-        relevant_documents = get_relevant_responses(
-            IRS990_SCHEMA, embedding, RELEVANT_DOCUMENT_COUNT
+        relevant_documents = self.store.search(
+            IRS990_SCHEMA, embedding, RELEVANT_DOCUMENT_COUNT, years=years
         )
 
+        if RETRIEVAL_MODE == "hybrid" and lexical_index is not None:
+            from query_gpt.lexical_index import reciprocal_rank_fusion
+
+            lexical_documents = lexical_index.get_docs(
+                doc_id
+                for doc_id, _ in lexical_index.search(
+                    question, RELEVANT_DOCUMENT_COUNT, years
+                )
+            )
+            relevant_documents = reciprocal_rank_fusion(
+                [relevant_documents, lexical_documents], RELEVANT_DOCUMENT_COUNT
+            )
+        return relevant_documents
+
+    def get_answer(self, question):
+        logger.info(f"Processing new question: {question}")
+        relevant_documents = self.get_relevant_documents(question)
+
         logger.info(f"Top 3 relevant documents:")
         for document in relevant_documents[:3]:
             logger.info(json.dumps(document))
@@ -0,0 +1,171 @@
+"""
+Reduced-dimension vectors for two-stage search.
+
+The first stage of a search compares short vectors (a PCA or random
+projection of the full embeddings), which are small enough to keep in RAM.
+The second stage re-ranks the candidates by their full embeddings, which stay
+on disk.  The projection is fitted from the stored embeddings and is applied
+both to the documents and to the questions.  Each loading collection gets its
+own copy, named after it, so the live collection's projection is untouched
+until the new collection has replaced it.
+"""
+import logging
+import os
+import re
+
+import numpy as np
+
+from query_gpt.config import DATA_DIR
+from query_gpt.databases import LOADING_SUFFIX_PATTERN
+
+logger = logging.getLogger(__name__)
+
+REDUCTION_DIR = os.path.join(DATA_DIR, "embeddings")
+# "pca" projects onto the principal components of the embeddings; "random"
+# onto random orthonormal directions, which needs no fitting data but loses
+# more recall at the same dimension.
+REDUCTION_METHODS = ("pca", "random")
+DEFAULT_REDUCTION_METHOD = "pca"
+DEFAULT_REDUCED_DIMENSION = 192
+# The projection is fitted on (at most) this many embeddings.
+REDUCTION_FIT_SAMPLE_SIZE = 50_000
+
+
+def reduction_path(collection: str) -> str:
+    return os.path.join(REDUCTION_DIR, f"vector_reduction.{collection}.npz")
+
+
+def find_reduction(schema: str) -> str | None:
+    """
+    Return the name of the collection whose reduction `schema` uses, or None
+    if there is none.  `schema` may also be one of its shards or loading
+    collections ("<collection>-..."), so the longest such prefix wins.
+    """
+    parts = schema.split("-")
+    for end in range(len(parts), 0, -1):
+        collection = "-".join(parts[:end])
+        if os.path.exists(reduction_path(collection)):
+            return collection
+    return None
+
+
+def latest_reduction(collection: str) -> str | None:
+    """
+    Return the filename of the most recently stored reduction of `collection`
+    (or of its shards), or None if there is none.
+    """
+    if not os.path.isdir(REDUCTION_DIR):
+        return None
+    # Loading collections of `collection` or of its shards, or (as stored by
+    # earlier releases) `collection` itself.
+    pattern = re.compile(
+        f"vector_reduction\\.{re.escape(collection)}"
+        f"((-.+)?-{LOADING_SUFFIX_PATTERN})?\\.npz"
+    )
+    filenames = [
+        os.path.join(REDUCTION_DIR, filename)
+        for filename in os.listdir(REDUCTION_DIR)
+        if pattern.fullmatch(filename)
+    ]
+    return max(filenames, key=os.path.getmtime, default=None)
+
+
+def remove_old_reductions(alias: str, keep: str | None = None):
+    """
+    Remove the reductions of the loading collections of `alias` other than
+    `keep`.
+    """
+    old_reduction = re.compile(
+        f"vector_reduction\\.{re.escape(alias)}-{LOADING_SUFFIX_PATTERN}\\.npz"
+    )
+    if not os.path.isdir(REDUCTION_DIR):
+        return
+    for filename in os.listdir(REDUCTION_DIR):
+        if old_reduction.fullmatch(filename) and (
+            keep is None or filename != os.path.basename(reduction_path(keep))
+        ):
+            logger.info(f"Removing old vector reduction: {filename}")
+            os.remove(os.path.join(REDUCTION_DIR, filename))
+
+
+class VectorReduction:
+    """Project embeddings onto `components` after subtracting `mean`."""
+
+    def __init__(self, mean: np.ndarray, components: np.ndarray, method: str):
+        self.mean = mean.astype(np.float32)
+        # Stored as (full dimension, reduced dimension).
+        self.components = np.ascontiguousarray(components, dtype=np.float32)
+        self.method = method
+
+    @property
+    def dimension(self) -> int:
+        return self.components.shape[1]
+
+    @property
+    def full_dimension(self) -> int:
+        return self.components.shape[0]
+
+    @classmethod
+    def fit(
+        cls,
+        vectors: np.ndarray,
+        dimension: int = DEFAULT_REDUCED_DIMENSION,
+        method: str = DEFAULT_REDUCTION_METHOD,
+    ) -> "VectorReduction":
+        """
+        Fit a projection of `vectors` (one embedding per row) onto `dimension`
+        dimensions.
+        """
+        vectors = np.asarray(vectors, dtype=np.float64)
+        full_dimension = vectors.shape[1]
+        if not 0 < dimension < full_dimension:
+            raise ValueError(
+                f"Reduced dimension must be between 1 and {full_dimension - 1}"
+            )
+
+        logger.info(
+            f"Fitting {method} reduction from {full_dimension} to {dimension} "
+            f"dimensions on {len(vectors):,d} embeddings"
+        )
+        if method == "pca":
+            mean = vectors.mean(axis=0)
+            centered = vectors - mean
+            # The covariance matrix is only (full_dimension x full_dimension),
+            # so its eigendecomposition is cheap whatever the sample size.
+            eigenvalues, eigenvectors = np.linalg.eigh(centered.T @ centered)
+            top = np.argsort(eigenvalues)[::-1][:dimension]
+            components = eigenvectors[:, top]
+
+            explained = eigenvalues[top].sum() / max(eigenvalues.sum(), 1e-12)
+            logger.info(f"The reduced vectors explain {explained:.1%} of the variance")
+        elif method == "random":
+            rng = np.random.default_rng(42)
+            mean = np.zeros(full_dimension)
+            components, _ = np.linalg.qr(
+                rng.standard_normal((full_dimension, dimension))
+            )
+        else:
+            raise ValueError(f"Unknown reduction method {method!r}")
+
+        return cls(mean, components, method)
+
+    def transform(self, vectors) -> np.ndarray:
+        """Return the normalized reduced vectors of `vectors` (one per row)."""
+        reduced = (np.asarray(vectors, dtype=np.float32) - self.mean) @ self.components
+        norms = np.linalg.norm(reduced, axis=-1, keepdims=True)
+        norms[norms == 0] = 1
+        return reduced / norms
+
+    def save(self, filename: str):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        np.savez(
+            filename, mean=self.mean, components=self.components, method=self.method
+        )
+        logger.info(f"Saved vector reduction to {filename}")
+
+    @classmethod
+    def load(cls, filename: str) -> "VectorReduction":
+        with np.load(filename) as reduction:
+            return cls(
+                reduction["mean"], reduction["components"], str(reduction["method"])
+            )
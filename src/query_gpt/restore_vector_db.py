@@ -0,0 +1,65 @@
+from glob import glob
+import logging
+import os
+
+import click
+
+from query_gpt.databases import SnapshotError, UnsupportedError, get_vector_store
+from query_gpt.snapshot import newest_artifacts, read_manifest
+
+logger = logging.getLogger("query_gpt")
+
+
+@click.command
+@click.argument("artifact")
+@click.option(
+    "--collection",
+    "-c",
+    default=None,
+    help="Alias to restore into (default is the alias that was exported)",
+)
+@click.option("--verify/--no-verify", default=True, help="Check the artifact checksum")
+def restore_vector_db_command(artifact, collection, verify):
+    """
+    Restore a collection exported by `load-vector-db --export-snapshot`.
+    ARTIFACT is an artifact file or a directory of them (e.g., one per shard),
+    of which only the newest of each alias is restored.
+    """
+    try:
+        if os.path.isdir(artifact):
+            artifacts = newest_artifacts(sorted(glob(os.path.join(artifact, "*.tar"))))
+        else:
+            artifacts = [artifact]
+
+        logger.info(f"Found {len(artifacts):,d} artifacts to restore")
+        if not artifacts:
+            raise click.ClickException("No artifacts found")
+        if collection is not None and len(artifacts) > 1:
+            raise click.ClickException("--collection requires a single artifact")
+
+        store = get_vector_store()
+        # Collections (with their sharding) that the artifacts were loaded as.
+        sources = set()
+        for filename in artifacts:
+            store.restore_snapshot(filename, collection, verify)
+            manifest = read_manifest(filename)
+            if collection is None and "source" in manifest:
+                sources.add((manifest["source"], manifest["sharded"]))
+
+        # As after a load, remove the aliases of the other sharding scheme.
+        for source, sharded in sorted(sources):
+            store.remove_stale_aliases(source, sharded)
+    except (SnapshotError, UnsupportedError) as e:
+        raise click.ClickException(str(e))
+
+    logger.info("done")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    # Raise the log level for the 'httpx' logger.
+    # We don't need to see HTTP return codes.
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    restore_vector_db_command()
@@ -0,0 +1,288 @@
+"""
+Versioned snapshot artifacts of loaded collections.
+
+An artifact is a tar file holding a manifest and everything a query node
+needs to serve the collection: a Qdrant snapshot (or, in local mode, the
+exported points), plus the vector reduction and the document store if the
+collection uses them.  The manifest records the SHA-256 of each file, and
+the SHA-256 of the whole artifact is written next to it
+("<artifact>.sha256", in `sha256sum` format).
+
+An export removes the artifacts in its directory that it supersedes, and a
+restore of a directory only restores the newest artifact of each alias, so
+older exports never come back.
+"""
+import datetime as dt
+from glob import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tarfile
+import tempfile
+
+from query_gpt import doc_store, reduction
+from query_gpt.config import DATA_DIR
+from query_gpt.databases import SnapshotError, is_stale_alias, loading_suffix, qdrant
+
+logger = logging.getLogger(__name__)
+
+ARTIFACT_FORMAT_VERSION = 1
+SNAPSHOT_DIR = os.path.join(DATA_DIR, "snapshots")
+MANIFEST_FILE = "manifest.json"
+SNAPSHOT_FILE = "collection.snapshot"
+REDUCTION_FILE = "vector_reduction.npz"
+DOC_STORE_FILE = "doc_store.sqlite"
+# Restored collections are ready soon, so poll them often.
+RESTORE_POLL_SECONDS = 1
+
+
+def sha256(filename: str) -> str:
+    digest = hashlib.sha256()
+    with open(filename, "rb") as input_file:
+        for block in iter(lambda: input_file.read(2**20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_manifest(artifact: str) -> dict:
+    try:
+        with tarfile.open(artifact) as tar:
+            manifest_file = tar.extractfile(MANIFEST_FILE)
+            if manifest_file is None:
+                raise KeyError(MANIFEST_FILE)
+            return json.load(manifest_file)
+    except (OSError, tarfile.TarError, KeyError, ValueError) as e:
+        raise SnapshotError(f"Can't read the manifest of {artifact}: {e}")
+
+
+def supersedes(manifest: dict, other: dict) -> bool:
+    """
+    Whether the artifact of `manifest` replaces the older one of `other`: it
+    has the same alias, or `other` has an alias that loading the source of
+    `manifest` removes (see `VectorStore.remove_stale_aliases`).
+    """
+    if other["alias"] == manifest["alias"]:
+        return True
+    # Artifacts of earlier releases don't record their source.
+    return "source" in manifest and is_stale_alias(
+        other["alias"], manifest["source"], manifest["sharded"]
+    )
+
+
+def remove_superseded_artifacts(artifact: str, manifest: dict):
+    for filename in glob(os.path.join(os.path.dirname(artifact), "*.tar")):
+        if filename == artifact:
+            continue
+        try:
+            other = read_manifest(filename)
+        except SnapshotError as e:
+            logger.warning(str(e))
+            continue
+        if supersedes(manifest, other):
+            logger.info(f"Removing superseded artifact {filename}")
+            os.remove(filename)
+            if os.path.exists(f"{filename}.sha256"):
+                os.remove(f"{filename}.sha256")
+
+
+def newest_artifacts(artifacts: list[str]) -> list[str]:
+    """Return the `artifacts` that no newer one of them supersedes."""
+    manifests = {artifact: read_manifest(artifact) for artifact in artifacts}
+    return [
+        artifact
+        for artifact, manifest in manifests.items()
+        if not any(
+            other["created"] > manifest["created"] and supersedes(other, manifest)
+            for other in manifests.values()
+        )
+    ]
+
+
+def export_collection(
+    alias: str,
+    collection: str,
+    directory: str = SNAPSHOT_DIR,
+    source: str | None = None,
+) -> str:
+    """
+    Write an artifact for `collection`, which is served under `alias`, a shard
+    of the collection `source` (by default `alias` isn't a shard), and remove
+    the artifacts in `directory` that it supersedes.
+
+    Returns:
+        The filename of the artifact.
+    """
+    source = source or alias
+    os.makedirs(directory, exist_ok=True)
+    dimension, reduced_dimension = qdrant.collection_dimensions(collection)
+
+    with tempfile.TemporaryDirectory(dir=directory) as staging:
+        if qdrant.QDRANT_LOCATION is None:
+            kind = "qdrant-snapshot"
+            qdrant.download_snapshot(collection, os.path.join(staging, SNAPSHOT_FILE))
+            point_count = qdrant.client_factory(collection).count(collection).count
+        else:
+            kind = "points"
+            point_count = qdrant.export_points(collection, staging)
+
+        if reduced_dimension is not None:
+            reduction_collection = reduction.find_reduction(collection)
+            if reduction_collection is None:
+                raise SnapshotError(f"No vector reduction found for {collection}")
+            shutil.copyfile(
+                reduction.reduction_path(reduction_collection),
+                os.path.join(staging, REDUCTION_FILE),
+            )
+
+        # Collections loaded with slim payloads name their document store.
+        store_name = None
+        records, _ = qdrant.client_factory(collection).scroll(collection, limit=1)
+        if records and doc_store.DOC_STORE_KEY in (records[0].payload or {}):
+            store_name = records[0].payload[doc_store.DOC_STORE_KEY]  # type:ignore
+            shutil.copyfile(
+                doc_store.doc_store_path(store_name),
+                os.path.join(staging, DOC_STORE_FILE),
+            )
+
+        files = {
+            filename: sha256(os.path.join(staging, filename))
+            for filename in sorted(os.listdir(staging))
+        }
+        manifest = {
+            "format_version": ARTIFACT_FORMAT_VERSION,
+            "created": str(dt.datetime.now()),
+            "alias": alias,
+            "source": source,
+            "sharded": alias != source,
+            "collection": collection,
+            "kind": kind,
+            "points": point_count,
+            "dimension": dimension,
+            "reduced_dimension": reduced_dimension,
+            "doc_store": store_name,
+            "files": files,
+        }
+        with open(os.path.join(staging, MANIFEST_FILE), "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+
+        artifact = os.path.join(
+            directory, f"{collection}.v{ARTIFACT_FORMAT_VERSION}.tar"
+        )
+        with tarfile.open(artifact, "w") as tar:
+            for filename in [MANIFEST_FILE, *files]:
+                tar.add(os.path.join(staging, filename), arcname=filename)
+
+    with open(f"{artifact}.sha256", "w") as checksum_file:
+        checksum_file.write(f"{sha256(artifact)}  {os.path.basename(artifact)}\n")
+
+    logger.info(f"Exported {point_count:,d} points of {alias} to {artifact}")
+    remove_superseded_artifacts(artifact, manifest)
+    return artifact
+
+
+def verify_artifact(artifact: str):
+    checksum_filename = f"{artifact}.sha256"
+    if not os.path.exists(checksum_filename):
+        raise SnapshotError(f"Checksum file {checksum_filename} not found")
+    with open(checksum_filename) as checksum_file:
+        expected = checksum_file.read().split()[0]
+    if sha256(artifact) != expected:
+        raise SnapshotError(f"Checksum of {artifact} does not match")
+
+
+def extract_artifact(tar: tarfile.TarFile, directory: str):
+    """
+    Extract `tar` into `directory`.  Python releases before 3.10.12 and 3.11.4
+    have no extraction filters, so the members are checked here instead.
+    """
+    if hasattr(tarfile, "data_filter"):
+        tar.extractall(directory, filter="data")
+        return
+
+    for member in tar.getmembers():
+        path = os.path.normpath(member.name)
+        if not (member.isfile() or member.isdir()):
+            raise SnapshotError(f"Unexpected member {member.name} in the artifact")
+        if os.path.isabs(path) or path.split(os.sep)[0] == os.pardir:
+            raise SnapshotError(f"Member {member.name} is outside the artifact")
+    tar.extractall(directory)
+
+
+def restore_collection(
+    artifact: str, alias: str | None = None, verify: bool = True
+) -> str:
+    """
+    Restore the collection in `artifact` into a new collection and point
+    `alias` (by default, the alias it was exported from) at it.
+
+    Returns:
+        The name of the new collection.
+    """
+    if verify:
+        verify_artifact(artifact)
+
+    with tempfile.TemporaryDirectory() as staging:
+        with tarfile.open(artifact) as tar:
+            extract_artifact(tar, staging)
+
+        with open(os.path.join(staging, MANIFEST_FILE)) as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest["format_version"] != ARTIFACT_FORMAT_VERSION:
+            raise SnapshotError(
+                f"Unsupported artifact format {manifest['format_version']} "
+                f"(expected {ARTIFACT_FORMAT_VERSION})"
+            )
+        for filename, checksum in manifest["files"].items():
+            if sha256(os.path.join(staging, filename)) != checksum:
+                raise SnapshotError(
+                    f"Checksum of {filename} in {artifact} does not match"
+                )
+
+        is_local = qdrant.QDRANT_LOCATION is not None
+        if (manifest["kind"] == "points") != is_local:
+            raise SnapshotError(
+                f"A {manifest['kind']} artifact can't be restored "
+                f"{'in local mode' if is_local else 'to a Qdrant server'}"
+            )
+
+        alias = alias or manifest["alias"]
+        collection = f"{alias}-{loading_suffix()}"
+        logger.info(f"Restoring {manifest['points']:,d} points into {collection}")
+
+        # The reduction and the document store must be in place before the
+        # alias is switched.
+        if manifest["reduced_dimension"] is not None:
+            reduction_filename = reduction.reduction_path(collection)
+            os.makedirs(os.path.dirname(reduction_filename), exist_ok=True)
+            shutil.copyfile(os.path.join(staging, REDUCTION_FILE), reduction_filename)
+        if manifest["doc_store"] is not None:
+            store_filename = doc_store.doc_store_path(manifest["doc_store"])
+            os.makedirs(os.path.dirname(store_filename), exist_ok=True)
+            shutil.copyfile(
+                os.path.join(staging, DOC_STORE_FILE), f"{store_filename}.tmp"
+            )
+            os.replace(f"{store_filename}.tmp", store_filename)
+
+        if is_local:
+            qdrant.remove_and_recreate_schema(
+                collection, manifest["dimension"], manifest["reduced_dimension"]
+            )
+            qdrant.import_points(collection, staging)
+            qdrant.restore_indexing(collection)
+        else:
+            qdrant.upload_snapshot(collection, os.path.join(staging, SNAPSHOT_FILE))
+
+    client = qdrant.client_factory(collection)
+    if client.get_collection(collection).status != "green":
+        qdrant.wait_until_ready(collection, RESTORE_POLL_SECONDS)
+    count = client.count(collection).count
+    if count != manifest["points"]:
+        raise SnapshotError(
+            f"{collection} has {count:,d} points; expected {manifest['points']:,d}"
+        )
+
+    qdrant.rename(collection, alias)
+    logger.info(f"Restored {alias} from {artifact}")
+    return collection
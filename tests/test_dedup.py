@@ -0,0 +1,115 @@
+import datetime as dt
+
+import pytest
+
+from query_gpt.dedup import (
+    UNKNOWN_TIMESTAMP,
+    Deduplicator,
+    dedup_key,
+    filing_key,
+    rank,
+    return_timestamp,
+)
+
+
+def make_doc(timestamp, amended=False, ein="12-3456789", **fields):
+    doc = {
+        "EIN": ein,
+        "Name": "CLEVELAND FOODBANK INC",
+        "Tax Period": "2022-01-01 to 2022-12-31",
+        "Return Timestamp": timestamp,
+        **fields,
+    }
+    if amended:
+        doc["Amended Return"] = True
+    return doc
+
+
+ORIGINAL = make_doc("2023-05-01T10:00:00-05:00")
+AMENDED = make_doc("2023-11-01T10:00:00-05:00", amended=True)
+
+
+def test_filing_key():
+    assert filing_key(ORIGINAL) == "12-3456789|2022-01-01 to 2022-12-31"
+    assert filing_key(make_doc(None, ein=None)) is None
+    assert filing_key({"EIN": "1", "Tax Period": "None to None"}) is None
+
+
+def test_dedup_key_falls_back_to_content_without_an_ein():
+    doc = make_doc(None, ein=None)
+    assert dedup_key(doc, "filing") == dedup_key(doc, "content")
+    assert dedup_key(doc, "filing") != dedup_key(make_doc(None, ein=None, Name="X"))
+    with pytest.raises(ValueError):
+        dedup_key(doc, "name")
+
+
+def test_return_timestamp_compares_offsets():
+    # 10:00 in California is later than 12:00 in New York.
+    assert return_timestamp(make_doc("2023-05-01T10:00:00-08:00")) > return_timestamp(
+        make_doc("2023-05-01T12:00:00-05:00")
+    )
+    assert return_timestamp(make_doc("2023-05-01T10:00:00Z")) == dt.datetime(
+        2023, 5, 1, 10, tzinfo=dt.timezone.utc
+    )
+    assert return_timestamp(make_doc("2023-05-01T10:00:00")).tzinfo is not None
+    assert return_timestamp(make_doc(None)) == UNKNOWN_TIMESTAMP
+    assert return_timestamp(make_doc("yesterday")) == UNKNOWN_TIMESTAMP
+
+
+def test_rank_policies():
+    late_original = make_doc("2023-12-01T10:00:00-05:00")
+    assert rank(late_original, "latest") > rank(AMENDED, "latest")
+    assert rank(late_original, "amended") < rank(AMENDED, "amended")
+    assert rank(late_original, "first") == rank(AMENDED, "first")
+    with pytest.raises(ValueError):
+        rank(AMENDED, "best")
+
+
+@pytest.mark.parametrize(
+    "policy, order, kept",
+    [
+        ("latest", [ORIGINAL, AMENDED], AMENDED),
+        ("latest", [AMENDED, ORIGINAL], AMENDED),
+        ("first", [ORIGINAL, AMENDED], ORIGINAL),
+        ("first", [AMENDED, ORIGINAL], AMENDED),
+    ],
+)
+def test_deduplicator_keeps_one_document_per_filing(policy, order, kept):
+    deduplicator = Deduplicator("filing", policy)
+    for index, doc in enumerate(order):
+        deduplicator.offer(doc, index)
+    assert [deduplicator.is_winner(doc, index) for index, doc in enumerate(order)] == [
+        doc is kept for doc in order
+    ]
+    assert len(deduplicator.winners) == 1
+
+
+def test_deduplicator_counts():
+    deduplicator = Deduplicator()
+    assert deduplicator.offer(ORIGINAL, 0)
+    assert deduplicator.offer(AMENDED, 1)
+    assert not deduplicator.offer(ORIGINAL, 2)
+    assert (deduplicator.seen, deduplicator.dropped, deduplicator.superseded) == (
+        3,
+        1,
+        1,
+    )
+
+    deduplicator.retract()
+    assert (deduplicator.dropped, deduplicator.superseded) == (2, 0)
+    assert "3 documents, 1 unique, 2 duplicates dropped" in deduplicator.report()
+
+
+def test_content_key_only_removes_exact_duplicates():
+    deduplicator = Deduplicator("content")
+    assert deduplicator.offer(ORIGINAL)
+    assert deduplicator.offer(dict(AMENDED, Name="GREATER CLEVELAND FOODBANK"))
+    assert not deduplicator.offer(dict(ORIGINAL))
+    assert len(deduplicator.winners) == 2
+
+
+def test_deduplicator_rejects_unknown_options():
+    with pytest.raises(ValueError):
+        Deduplicator("name")
+    with pytest.raises(ValueError):
+        Deduplicator("filing", "best")
@@ -0,0 +1,155 @@
+import math
+
+import pytest
+
+from query_gpt import lexical_index
+from query_gpt.lexical_index import (
+    BM25_B,
+    BM25_K1,
+    LexicalIndexWriter,
+    get_lexical_index,
+    reciprocal_rank_fusion,
+    tokenize,
+)
+
+
+def make_doc(ein, name, year="2022", **fields):
+    return {
+        "EIN": ein,
+        "Name": name,
+        "Tax Year": year,
+        "Tax Period": f"{year}-01-01 to {year}-12-31",
+        **fields,
+    }
+
+
+DOCS = [
+    make_doc("12-3456789", "CLEVELAND FOODBANK INC", Purpose="Feed the hungry"),
+    make_doc("12-3456789", "CLEVELAND FOODBANK INC", "2021", Purpose="Feed people"),
+    make_doc("23-4567890", "YOUTH SOCCER LEAGUE INC", Address="Austin TX"),
+    make_doc("34-5678901", "NORTH YOUTH SOCCER LEAGUE", Address="Dallas TX"),
+    make_doc("45-6789012", "SOUTH YOUTH SOCCER LEAGUE", Address="Houston TX"),
+    make_doc("56-7890123", "RIVER ARTS COUNCIL", Activities="Soccer camps for youth"),
+]
+
+
+@pytest.fixture(autouse=True)
+def index_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(lexical_index, "LEXICAL_INDEX_DIR", str(tmp_path))
+    monkeypatch.setattr(lexical_index, "_indexes", {})
+
+
+@pytest.fixture
+def index():
+    writer = LexicalIndexWriter("test")
+    writer.add(DOCS)
+    writer.commit()
+    return get_lexical_index("test")
+
+
+def test_tokenize_drops_stop_words_and_single_characters():
+    assert tokenize("What is the Revenue of X-Ray Inc. in 2021?") == [
+        "revenue",
+        "ray",
+        "2021",
+    ]
+
+
+def test_search_scores_match_bm25(index):
+    # "arts" occurs once, in the name of the last document.
+    doc_lengths = [
+        sum(
+            weight * len(tokenize(doc.get(field) or ""))
+            for field, weight in lexical_index.INDEXED_FIELDS.items()
+        )
+        for doc in DOCS
+    ]
+    average_length = sum(doc_lengths) / len(DOCS)
+    idf = math.log(1 + (len(DOCS) - 1 + 0.5) / (1 + 0.5))
+    term_freq = lexical_index.INDEXED_FIELDS["Name"]
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_lengths[5] / average_length)
+    expected = idf * term_freq * (BM25_K1 + 1) / (term_freq + norm)
+
+    [(doc_id, score)] = index.search("arts", 10)
+    assert doc_id == 5
+    assert score == pytest.approx(expected, rel=1e-5)
+
+
+def test_search_weights_name_terms(index):
+    results = index.search("youth soccer", 10)
+    # The arts council only mentions youth soccer in its activities.
+    assert results[-1][0] == 5
+    assert len(results) == 4
+
+
+def test_search_prefers_years_but_falls_back(index):
+    assert [doc_id for doc_id, _ in index.search("foodbank", 10, {"2021"})] == [1]
+    assert len(index.search("foodbank", 10, {"2019"})) == 2
+
+
+def test_confident_matches_by_ein(index):
+    matches = index.confident_matches("Revenue of EIN 123456789?", 10)
+    assert [doc["Tax Year"] for doc in matches] == ["2022", "2021"]
+    matches = index.confident_matches(
+        "What did 12-3456789 spend in 2021?", 10, {"2021"}
+    )
+    assert [doc["Tax Year"] for doc in matches] == ["2021"]
+
+
+def test_confident_matches_by_unique_name(index):
+    matches = index.confident_matches("Where is the Cleveland Foodbank?", 10)
+    assert {doc["EIN"] for doc in matches} == {"12-3456789"}
+
+
+def test_confident_matches_ignores_generic_names_in_broad_questions(index):
+    question = "List youth soccer league organizations in TX"
+    assert index.confident_matches(question, 10) is None
+
+
+def test_confident_matches_without_a_name_or_ein(index):
+    assert index.confident_matches("Which charities feed the hungry?", 10) is None
+    assert index.confident_matches("What about 99-9999999?", 10) is None
+
+
+def test_get_lexical_index_reopens_rebuilt_index(index):
+    assert get_lexical_index("test") is index
+
+    writer = LexicalIndexWriter("test")
+    writer.add(DOCS[:2])
+    writer.commit()
+
+    reopened = get_lexical_index("test")
+    assert reopened is not index
+    assert len(reopened) == 2
+
+
+def test_vocabulary_is_sorted_and_looked_up_by_bisection(index):
+    terms = [term.decode() for term in index.vocabulary]
+    assert terms == sorted(set(terms))
+    assert index.vocabulary.get(terms[0]) == 0
+    assert index.vocabulary.get(terms[-1]) == len(terms) - 1
+    assert index.vocabulary.get("soccer") == terms.index("soccer")
+    for missing in ("", "0", "zzzz", "socce", "soccers"):
+        assert index.vocabulary.get(missing) is None
+
+
+def test_empty_index():
+    writer = LexicalIndexWriter("empty")
+    writer.add([])
+    writer.commit()
+    empty = get_lexical_index("empty")
+    assert len(empty.vocabulary) == 0
+    assert empty.search("soccer", 10) == []
+
+
+def test_get_lexical_index_without_index():
+    assert get_lexical_index("missing") is None
+
+
+def test_reciprocal_rank_fusion_merges_filings():
+    a, b, c = DOCS[0], DOCS[2], DOCS[5]
+    # The same filing, as returned by another retriever.
+    b_copy = dict(b)
+    fused = reciprocal_rank_fusion([[a, b], [b_copy, c]], 10)
+    assert fused == [b, a, c]
+    assert reciprocal_rank_fusion([[a, b], [b_copy, c]], 1) == [b]
@@ -0,0 +1,156 @@
+import os
+import random
+import threading
+
+import pytest
+
+from query_gpt import irs_data
+from query_gpt.benchmark.synthetic_990 import make_return_xml
+from query_gpt.dedup import Deduplicator
+from query_gpt.pipeline import Deduplicate, Pipeline, PreScan, Stage
+
+
+def write_return(directory, name, index, amended=False):
+    filename = os.path.join(directory, f"{name}.xml")
+    with open(filename, "w") as xml_file:
+        xml_file.write(make_return_xml(random.Random(index), index, amended=amended))
+    return filename
+
+
+@pytest.fixture
+def indexes():
+    """Indexes of synthetic returns that `parse` keeps."""
+    kept = []
+    for index in range(100):
+        xml = make_return_xml(random.Random(index), index)
+        if "ForeignAddress" not in xml and "990PF" not in xml:
+            kept.append(index)
+    return kept
+
+
+def run_prescan(deduplicator, items):
+    pre_scan = PreScan(deduplicator)
+    outputs = [output for item in items for output in pre_scan(item)]
+    return outputs + list(pre_scan.finish())
+
+
+def test_parse_header_matches_parse(tmp_path):
+    for index in range(100):
+        filename = write_return(tmp_path, str(index), index, amended=index % 2 == 0)
+        header = irs_data.parse_header(filename)
+        doc = irs_data.parse(filename)
+        if doc is None:
+            assert header is None
+        else:
+            assert header == {field: doc.get(field) for field in header}
+            assert header.get("Amended Return") == doc.get("Amended Return")
+
+
+def test_prescan_drops_originals_amended_in_the_same_segment(tmp_path, indexes):
+    first, second = indexes[:2]
+    original = write_return(tmp_path, "original", first)
+    amended = write_return(tmp_path, "amended", first, amended=True)
+    other = write_return(tmp_path, "other", second)
+    deduplicator = Deduplicator()
+
+    items = [(2022, "01A", filename) for filename in (original, amended, other)]
+    assert run_prescan(deduplicator, items) == items[1:]
+    assert not os.path.exists(original)
+    assert (deduplicator.dropped, deduplicator.superseded) == (1, 0)
+
+
+def test_prescan_emits_each_segment_when_the_next_starts(tmp_path, indexes):
+    first = indexes[0]
+    original = write_return(tmp_path, "original", first)
+    amended = write_return(tmp_path, "amended", first, amended=True)
+    deduplicator = Deduplicator()
+    pre_scan = PreScan(deduplicator)
+
+    assert list(pre_scan((2022, "01A", original))) == []
+    # The original was already passed on when the amendment arrived.
+    assert list(pre_scan((2022, "01B", amended))) == [(2022, "01A", original)]
+    assert list(pre_scan.finish()) == [(2022, "01B", amended)]
+    assert (deduplicator.dropped, deduplicator.superseded) == (0, 1)
+
+
+def test_prescan_passes_on_returns_it_cannot_match(tmp_path):
+    skipped = None
+    for index in range(100):
+        if "990PF" in make_return_xml(random.Random(index), index):
+            skipped = write_return(tmp_path, "skipped", index)
+            break
+    assert skipped is not None
+
+    deduplicator = Deduplicator()
+    items = [(2022, "01A", skipped)]
+    assert run_prescan(deduplicator, items) == items
+    assert deduplicator.seen == 0
+
+
+def test_deduplicate_only_offers_documents_without_a_filing_key():
+    deduplicator = Deduplicator()
+    deduplicate = Deduplicate(deduplicator, prescanned=True)
+    filing = {"EIN": "12-3456789", "Tax Period": "2022-01-01 to 2022-12-31"}
+    anonymous = {"EIN": None, "Tax Period": "None to None", "Name": "X"}
+
+    items = [(2022, "01A", doc) for doc in (filing, filing, anonymous, anonymous)]
+    outputs = [output for item in items for output in deduplicate(item)]
+    assert outputs == items[:3]
+    assert deduplicator.seen == 2
+
+
+class Collect:
+    def __init__(self):
+        self.items = []
+        self.lock = threading.Lock()
+
+    def __call__(self, item):
+        with self.lock:
+            self.items.append(item)
+        return []
+
+
+def test_pipeline_runs_items_through_stages():
+    collect = Collect()
+    batches = []
+
+    def batch(item):
+        batches.append(item)
+        if len(batches) == 3:
+            yield list(batches)
+            batches.clear()
+
+    stages = [
+        Stage("double", lambda item: [item, item], workers=3),
+        Stage("batch", batch, finish=lambda: [batches] if batches else []),
+        Stage("collect", collect, size=len),
+    ]
+    Pipeline(stages, queue_size=4).run(range(10))
+
+    assert sorted(item for items in collect.items for item in items) == sorted(
+        list(range(10)) * 2
+    )
+    assert [stage.items for stage in stages] == [20, 7, 0]
+
+
+def test_pipeline_bounds_batch_queues_in_documents():
+    stages = [Stage("a", lambda item: [item]), Stage("b", list, batch_size=50)]
+    pipeline = Pipeline(stages, queue_size=100)
+    assert [q.maxsize for q in pipeline.queues] == [100, 100, 2]
+
+
+def test_pipeline_raises_the_first_error_and_closes_stages():
+    closed = []
+
+    def fail(item):
+        if item == 5:
+            raise RuntimeError("boom")
+        yield item
+
+    stages = [
+        Stage("fail", fail, close=lambda: closed.append("fail")),
+        Stage("collect", Collect(), close=lambda: closed.append("collect")),
+    ]
+    with pytest.raises(RuntimeError, match="boom"):
+        Pipeline(stages).run(range(10))
+    assert sorted(closed) == ["collect", "fail"]
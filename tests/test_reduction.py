@@ -0,0 +1,97 @@
+import os
+
+import numpy as np
+import pytest
+
+from query_gpt import reduction
+from query_gpt.databases import qdrant
+from query_gpt.reduction import (
+    VectorReduction,
+    latest_reduction,
+    reduction_path,
+    remove_old_reductions,
+)
+
+DIMENSION = 16
+REDUCED_DIMENSION = 4
+
+
+@pytest.fixture(autouse=True)
+def reduction_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(reduction, "REDUCTION_DIR", str(tmp_path))
+    monkeypatch.setattr(qdrant, "QDRANT_LOCATION", ":memory:")
+    monkeypatch.setattr(qdrant, "_clients", {})
+    monkeypatch.setattr(qdrant, "_reductions", {})
+    monkeypatch.setattr(qdrant, "_shards", {})
+
+
+def fit(seed, dimension=DIMENSION):
+    vectors = np.random.default_rng(seed).standard_normal((100, dimension))
+    return VectorReduction.fit(vectors, REDUCED_DIMENSION), vectors
+
+
+def load(collection, fitted, vectors):
+    fitted.save(reduction_path(collection))
+    qdrant.remove_and_recreate_schema(collection, DIMENSION, REDUCED_DIMENSION)
+    qdrant.load_vectors(
+        collection,
+        [{"EIN": str(index)} for index in range(len(vectors))],
+        list(vectors),
+        fitted,
+    )
+
+
+def test_latest_reduction_and_remove_old_reductions():
+    first, _ = fit(0)
+    second, _ = fit(1)
+    first.save(reduction_path("irs990-2022-2023-01-01-10-00-00.5"))
+    second.save(reduction_path("irs990-2023-2023-01-02-10-00-00"))
+    os.utime(reduction_path("irs990-2022-2023-01-01-10-00-00.5"), (0, 0))
+    # Another collection, not a shard of irs990.
+    first.save(reduction_path("irs990-test"))
+
+    assert latest_reduction("irs990") == reduction_path(
+        "irs990-2023-2023-01-02-10-00-00"
+    )
+    assert latest_reduction("other") is None
+
+    remove_old_reductions("irs990-2023", keep="irs990-2023-2023-01-02-10-00-00")
+    assert os.path.exists(reduction_path("irs990-2023-2023-01-02-10-00-00"))
+    remove_old_reductions("irs990-2023")
+    assert latest_reduction("irs990") == reduction_path(
+        "irs990-2022-2023-01-01-10-00-00.5"
+    )
+    assert os.path.exists(reduction_path("irs990-test"))
+
+
+def test_search_switches_reduction_with_the_alias():
+    old, vectors = fit(0)
+    load("irs990-2023-01-01-10-00-00", old, vectors)
+    qdrant.rename("irs990-2023-01-01-10-00-00", "irs990")
+    assert qdrant.get_reduction("irs990").reduction.components.tolist() == (
+        old.components.tolist()
+    )
+    assert len(qdrant.search("irs990", vectors[0], 5)) == 5
+
+    # A refit, loaded and switched by another process: the cache is kept.
+    cached = qdrant._reductions.copy()
+    new, _ = fit(1)
+    load("irs990-2023-01-02-10-00-00", new, vectors)
+    qdrant.rename("irs990-2023-01-02-10-00-00", "irs990")
+    qdrant._reductions.update(cached)
+
+    assert not os.path.exists(reduction_path("irs990-2023-01-01-10-00-00"))
+    [hit, *_] = qdrant.search("irs990", vectors[0], 5)
+    assert hit.payload == {"EIN": "0"}
+    collection, current, *_ = qdrant.get_reduction("irs990")
+    assert collection == "irs990-2023-01-02-10-00-00"
+    assert current.components.tolist() == new.components.tolist()
+
+
+def test_get_reduction_checks_both_dimensions():
+    fitted, vectors = fit(0)
+    load("irs990-2023-01-01-10-00-00", fitted, vectors)
+    # Embeddings of another provider, with another full dimension.
+    fit(0, DIMENSION * 2)[0].save(reduction_path("irs990-2023-01-01-10-00-00"))
+    with pytest.raises(RuntimeError, match="full dimensions"):
+        qdrant.get_reduction("irs990-2023-01-01-10-00-00")
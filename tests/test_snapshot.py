@@ -0,0 +1,144 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import os
+import shutil
+import threading
+
+from click.testing import CliRunner
+import numpy as np
+import pytest
+
+from query_gpt import restore_vector_db, snapshot
+from query_gpt.databases import UnsupportedError, get_vector_store, qdrant
+from query_gpt.restore_vector_db import restore_vector_db_command
+
+DIMENSION = 8
+
+
+@pytest.fixture(autouse=True)
+def local_qdrant(monkeypatch):
+    monkeypatch.setattr(qdrant, "QDRANT_LOCATION", ":memory:")
+    monkeypatch.setattr(qdrant, "_clients", {})
+    monkeypatch.setattr(qdrant, "_reductions", {})
+    monkeypatch.setattr(qdrant, "_shards", {})
+
+
+def load(alias, timestamp, count=3):
+    collection = f"{alias}-2023-01-0{timestamp}-10-00-00"
+    qdrant.remove_and_recreate_schema(collection, DIMENSION)
+    vectors = np.random.default_rng(timestamp).standard_normal((count, DIMENSION))
+    qdrant.load_vectors(
+        collection, [{"EIN": str(index)} for index in range(count)], list(vectors)
+    )
+    qdrant.rename(collection, alias)
+    return collection
+
+
+def aliases():
+    return {
+        alias.alias_name: alias.collection_name
+        for alias in qdrant.client_factory().get_aliases().aliases
+    }
+
+
+def test_export_removes_superseded_artifacts(tmp_path):
+    old = snapshot.export_collection("irs990", load("irs990", 1), str(tmp_path))
+    new = snapshot.export_collection("irs990", load("irs990", 2), str(tmp_path))
+    assert not os.path.exists(old) and not os.path.exists(f"{old}.sha256")
+    assert os.path.exists(new)
+
+    # A sharded load replaces the unsharded alias, but not the other shards.
+    shard_2022 = snapshot.export_collection(
+        "irs990-2022", load("irs990-2022", 3), str(tmp_path), source="irs990"
+    )
+    shard_2023 = snapshot.export_collection(
+        "irs990-2023", load("irs990-2023", 4), str(tmp_path), source="irs990"
+    )
+    assert sorted(os.listdir(tmp_path)) == sorted(
+        os.path.basename(filename)
+        for artifact in (shard_2022, shard_2023)
+        for filename in (artifact, f"{artifact}.sha256")
+    )
+
+
+def test_restore_only_restores_the_newest_artifacts(tmp_path):
+    exports = [tmp_path / str(index) for index in range(3)]
+    stale = snapshot.export_collection(
+        "irs990-2022", load("irs990-2022", 1), str(exports[0]), source="irs990"
+    )
+    old = snapshot.export_collection("irs990", load("irs990", 2), str(exports[1]))
+    new = snapshot.export_collection("irs990", load("irs990", 3, 5), str(exports[2]))
+    # Copies of the exports, e.g., synced from another node.
+    artifacts = tmp_path / "artifacts"
+    artifacts.mkdir()
+    for artifact in (stale, old, new):
+        for filename in (artifact, f"{artifact}.sha256"):
+            shutil.copy(filename, artifacts)
+    copies = sorted(str(filename) for filename in artifacts.glob("*.tar"))
+    assert snapshot.newest_artifacts(copies) == [str(artifacts / os.path.basename(new))]
+
+    # On a fresh node that still serves the sharded collection.
+    qdrant._clients.clear()
+    load("irs990-2023", 4)
+    result = CliRunner().invoke(restore_vector_db_command, [str(artifacts)])
+    assert result.exit_code == 0, result.output
+
+    restored = aliases()
+    assert list(restored) == ["irs990"]
+    assert qdrant.client_factory().count(restored["irs990"]).count == 5
+
+
+def test_backends_without_snapshots(tmp_path, monkeypatch):
+    weaviate_store = get_vector_store("weaviate")
+    with pytest.raises(UnsupportedError):
+        weaviate_store.measure_recall("irs990", [], 10)
+
+    artifact = snapshot.export_collection("irs990", load("irs990", 1), str(tmp_path))
+    monkeypatch.setattr(restore_vector_db, "get_vector_store", lambda: weaviate_store)
+    result = CliRunner().invoke(restore_vector_db_command, [artifact])
+    assert result.exit_code == 1
+    assert "doesn't support snapshots" in result.output
+
+
+class Upload(BaseHTTPRequestHandler):
+    received: list = []
+
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        Upload.received.append((self.headers["Content-Type"], self.rfile.read(length)))
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def test_upload_snapshot_streams_a_multipart_body(tmp_path, monkeypatch):
+    filename = tmp_path / "collection.snapshot"
+    data = os.urandom(100_000)
+    filename.write_bytes(data)
+
+    server = HTTPServer(("localhost", 0), Upload)
+    thread = threading.Thread(target=server.handle_request)
+    thread.start()
+    monkeypatch.setattr(
+        qdrant,
+        "snapshot_url",
+        lambda schema, path: f"http://localhost:{server.server_port}{path}",
+    )
+    qdrant.upload_snapshot("irs990", str(filename))
+    thread.join()
+    server.server_close()
+
+    [(content_type, body)] = Upload.received
+    boundary = content_type.split("boundary=")[1]
+    head, rest = body.split(b"\r\n\r\n", 1)
+    assert head.startswith(f"--{boundary}\r\n".encode())
+    assert b'name="snapshot"; filename="collection.snapshot"' in head
+    assert rest == data + f"\r\n--{boundary}--\r\n".encode()
+
+    # Read in blocks, as http.client sends it.
+    with open(filename, "rb") as snapshot_file:
+        body_file = qdrant.MultipartFile("snapshot", snapshot_file)
+        blocks = list(iter(lambda: body_file.read(8192), b""))
+    assert all(len(block) == 8192 for block in blocks[:-1])
+    assert len(b"".join(blocks)) == len(body_file) == len(body)